@@ -0,0 +1,147 @@
+import asyncio
+import math
+from contextvars import ContextVar
+from fnmatch import fnmatchcase
+from typing import Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import settings
+
+CRITICAL = 0
+NORMAL = 1
+BULK = 2
+
+# Long-lived streams and file transfers are neither counted as in flight nor
+# given a deadline
+streaming_paths = ("/items/events*", "/items/*/attachments*")
+
+deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+in_flight = [0, 0, 0]
+# Exponentially weighted moving average of the pool acquire wait in seconds,
+# as of the loop time acquire_wait_at
+acquire_wait = 0.0
+acquire_wait_at = 0.0
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left before the current request's deadline, if it has one.
+    """
+    request_deadline = deadline.get()
+    if request_deadline is None:
+        return None
+    return max(0.0, request_deadline - asyncio.get_event_loop().time())
+
+
+def get_acquire_wait() -> float:
+    # Decays while nothing is measured, e.g. because everything is shed
+    elapsed = asyncio.get_event_loop().time() - acquire_wait_at
+    return acquire_wait * 0.5 ** (elapsed / settings.ADMISSION_WAIT_HALF_LIFE)
+
+
+def record_acquire_wait(seconds: float) -> None:
+    global acquire_wait, acquire_wait_at
+    wait = get_acquire_wait()
+    acquire_wait = wait + settings.ADMISSION_WAIT_SMOOTHING * (seconds - wait)
+    acquire_wait_at = asyncio.get_event_loop().time()
+
+
+def strip_prefix(path: str) -> str:
+    if path.startswith(settings.API_V1_STR):
+        return path[len(settings.API_V1_STR) :]  # noqa: E203
+    return path
+
+
+def is_streaming(path: str) -> bool:
+    path = strip_prefix(path)
+    return any(fnmatchcase(path, pattern) for pattern in streaming_paths)
+
+
+def get_priority(method: str, path: str) -> int:
+    path = strip_prefix(path).rstrip("/")
+    if path in ("/login/access-token", "/reset-password") or path.startswith(
+        "/password-recovery/"
+    ):
+        return CRITICAL
+    if method == "GET" and path in ("/items", "/users"):
+        return BULK
+    return NORMAL
+
+
+def get_deadline(path: str) -> float:
+    path = strip_prefix(path)
+    matches = [p for p in settings.REQUEST_DEADLINES if path.startswith(p)]
+    if matches:
+        return settings.REQUEST_DEADLINES[max(matches, key=len)]
+    return settings.REQUEST_DEADLINE_SECONDS
+
+
+def should_shed(priority: int) -> bool:
+    if priority == CRITICAL:
+        # Logins are cheap on the pool and must keep working under load
+        return sum(in_flight) >= settings.ADMISSION_MAX_IN_FLIGHT * 2
+    # Bulk traffic gets half the capacity and is shed at half the wait
+    share = 1 if priority == NORMAL else 0.5
+    return (
+        sum(in_flight[NORMAL:]) >= settings.ADMISSION_MAX_IN_FLIGHT * share
+        or get_acquire_wait() >= settings.ADMISSION_MAX_ACQUIRE_WAIT * share
+    )
+
+
+def unavailable(detail: str, status_code: int = 503) -> JSONResponse:
+    return JSONResponse(
+        {"detail": detail},
+        status_code=status_code,
+        headers={"Retry-After": str(math.ceil(settings.ADMISSION_RETRY_AFTER))},
+    )
+
+
+class AdmissionMiddleware:
+    """
+    Sheds requests with 503 when the worker is overloaded and answers 504
+    when a request runs past its deadline.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope["type"] != "http"
+            or not settings.ADMISSION_ENABLED
+            or is_streaming(scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+        priority = get_priority(scope["method"], scope["path"])
+        if should_shed(priority):
+            await unavailable("Server overloaded, retry later")(scope, receive, send)
+            return
+
+        # A deadline of 0 disables it, e.g. for streaming routes
+        timeout = get_deadline(scope["path"]) or None
+        token = deadline.set(
+            asyncio.get_event_loop().time() + timeout if timeout else None
+        )
+        response_started = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        in_flight[priority] += 1
+        try:
+            await asyncio.wait_for(self.app(scope, receive, send_wrapper), timeout)
+        except asyncio.TimeoutError:
+            if response_started:
+                raise
+            response = unavailable("Request deadline exceeded", status_code=504)
+            await response(scope, receive, send)
+        finally:
+            in_flight[priority] -= 1
+            deadline.reset(token)
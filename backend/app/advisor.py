@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import difflib
+import json
+import logging
+import re
+import statistics
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple
+
+from edgedb import AsyncIOConnection
+
+from app import crud, schemas
+from app.config import settings
+from app.initial_data import check_db
+from app.signatures import Signature
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+schema_path = Path(__file__).parent.parent / "dbschema" / "database.esdl"
+
+entity_types = {"items": "Item", "users": "User"}
+entity_crud = {"items": crud.item, "users": crud.user}
+entity_filters = {"items": schemas.ItemFilterParams, "users": schemas.UserFilterParams}
+
+# (type, index expression)
+Candidate = Tuple[str, str]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Propose indexes from the query signatures recorded with "
+        "SIGNATURES_ENABLED."
+    )
+    parser.add_argument("command", choices=["report", "replay"])
+    parser.add_argument("--path", default=settings.SIGNATURES_PATH)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=20,
+        help="Times each signature is run per measurement when replaying",
+    )
+    parser.add_argument(
+        "--apply",
+        action="store_true",
+        help="Confirm replay may create and drop indexes on the database",
+    )
+    return parser.parse_args()
+
+
+def load(path: str) -> Dict[Signature, List[Any]]:
+    """
+    Merge the lines flushed by every worker into count, total ms and max ms
+    per signature.
+    """
+    merged: Dict[Signature, List[Any]] = {}
+    with open(path) as f:
+        for line in f:
+            data = json.loads(line)
+            signature = (data["entity"], tuple(data["filter"]), tuple(data["order"]))
+            stats = merged.setdefault(signature, [0, 0.0, 0.0])
+            stats[0] += data["count"]
+            stats[1] += data["total_ms"]
+            stats[2] = max(stats[2], data["max_ms"])
+    return merged
+
+
+def parse_schema(text: str) -> Tuple[Dict[str, Set[str]], Dict[Tuple[str, str], str]]:
+    """
+    Return the index expressions of each type, counting exclusive properties
+    as indexed, and the target type of each link.
+    """
+    indexes: Dict[str, Set[str]] = defaultdict(set)
+    links: Dict[Tuple[str, str], str] = {}
+    current_type = current_property = None
+    for line in text.splitlines():
+        line = line.strip()
+        match = re.match(r"type (\w+)", line)
+        if match:
+            current_type = match.group(1)
+            continue
+        match = re.match(
+            r"(?:required )?(?:multi )?(property|link) (\w+) -> (\w+)", line
+        )
+        if match:
+            current_property = match.group(2)
+            if match.group(1) == "link":
+                links[(current_type, current_property)] = match.group(3)
+            continue
+        if line.startswith("constraint exclusive") and current_property:
+            indexes[current_type].add(f".{current_property}")
+        match = re.match(r"index on \((.*)\);", line)
+        if match:
+            indexes[current_type].add(match.group(1))
+    return indexes, links
+
+
+def candidates_for(
+    signature: Signature, links: Dict[Tuple[str, str], str]
+) -> List[Candidate]:
+    entity, filter_fields, order_fields = signature
+    type_name = entity_types[entity]
+    own: List[str] = []
+    candidates: List[Candidate] = []
+    for field in filter_fields:
+        path = field.split("__")
+        if len(path) == 1:
+            own.append(f".{field}")
+            candidates.append((type_name, f".{field}"))
+        elif len(path) == 2 and path[1] != "id":
+            # Links are indexed, the target's property may not be
+            target = links.get((type_name, path[0]))
+            if target:
+                candidates.append((target, f".{path[1]}"))
+    if len(own) > 1:
+        candidates.append((type_name, f"({', '.join(own)})"))
+    if order_fields:
+        first = order_fields[0].lstrip("-")
+        if "__" not in first:
+            candidates.append((type_name, f".{first}"))
+            if own and f".{first}" not in own:
+                candidates.append((type_name, f"({', '.join(own + [f'.{first}'])})"))
+    return candidates
+
+
+def rank(
+    observed: Dict[Signature, List[Any]], schema_text: str
+) -> List[Tuple[Candidate, float, List[Signature]]]:
+    """
+    Score each candidate index missing from the schema by the total time
+    spent in the signatures it could serve.
+    """
+    indexes, links = parse_schema(schema_text)
+    served: Dict[Candidate, List[Signature]] = defaultdict(list)
+    for signature in observed:
+        for candidate in candidates_for(signature, links):
+            if candidate[1] not in indexes[candidate[0]]:
+                served[candidate].append(signature)
+    ranked = [
+        (candidate, sum(observed[s][1] for s in signatures), signatures)
+        for candidate, signatures in served.items()
+    ]
+    return sorted(ranked, key=lambda c: c[1], reverse=True)
+
+
+def schema_diff(schema_text: str, candidates: List[Candidate]) -> str:
+    lines = schema_text.splitlines(keepends=True)
+    new_lines = list(lines)
+    for type_name, expr in candidates:
+        start = next(
+            i
+            for i, line in enumerate(new_lines)
+            if line.strip() == f"type {type_name} {{"
+        )
+        indent = re.match(r"\s*", new_lines[start]).group(0)  # type: ignore
+        end = next(
+            i
+            for i in range(start + 1, len(new_lines))
+            if new_lines[i].rstrip() == f"{indent}}}"
+        )
+        new_lines.insert(end, f"{indent}    index on ({expr});\n")
+    return "".join(
+        difflib.unified_diff(
+            lines, new_lines, "a/dbschema/database.esdl", "b/dbschema/database.esdl"
+        )
+    )
+
+
+def report(ranked: List[Tuple[Candidate, float, List[Signature]]]) -> None:
+    for position, ((type_name, expr), score, signatures) in enumerate(ranked, 1):
+        print(f"{position}. {type_name}: index on ({expr})")
+        print(f"   {score:.0f} ms spent in {len(signatures)} signatures:")
+        for entity, filter_fields, order_fields in signatures:
+            print(
+                f"     {entity} filter={','.join(filter_fields) or '-'} "
+                f"order={','.join(order_fields) or '-'}"
+            )
+
+
+def render_shape(tree: Dict[str, Any]) -> str:
+    return ", ".join(
+        f"{name}: {{ {render_shape(child)} }}" if child else name
+        for name, child in tree.items()
+    )
+
+
+async def sample_filtering(
+    con: AsyncIOConnection, signature: Signature
+) -> Dict[str, Any]:
+    """
+    Filter values to replay a signature with, taken from an object of the
+    entity since only the field names are recorded.
+    """
+    entity, filter_fields, _ = signature
+    if not filter_fields:
+        return {}
+    tree: Dict[str, Any] = {}
+    for field in filter_fields:
+        node = tree
+        for name in field.split("__"):
+            node = node.setdefault(name, {})
+    result = await con.query_json(
+        f"SELECT {entity_types[entity]} {{ {render_shape(tree)} }} LIMIT 1"
+    )
+    objects = json.loads(result)
+    sample = {}
+    for field in filter_fields:
+        value = objects[0] if objects else None
+        for name in field.split("__"):
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is not None:
+            sample[field] = value
+    return entity_filters[entity](**sample).dict_exclude_unset()
+
+
+async def measure(
+    con: AsyncIOConnection,
+    signature: Signature,
+    filtering: Dict[str, Any],
+    runs: int,
+) -> float:
+    entity, _, order_fields = signature
+    get_multi = entity_crud[entity].get_multi.__wrapped__  # type: ignore
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        await get_multi(
+            con, filtering=filtering, ordering=",".join(order_fields) or None
+        )
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+async def replay(
+    con: AsyncIOConnection,
+    ranked: List[Tuple[Candidate, float, List[Signature]]],
+    runs: int,
+) -> None:
+    """
+    Time each candidate's signatures without and with the index, created and
+    dropped again on the connected database.
+    """
+    for (type_name, expr), _, signatures in ranked:
+        samples = [await sample_filtering(con, s) for s in signatures]
+        before = [
+            await measure(con, s, filtering, runs)
+            for s, filtering in zip(signatures, samples)
+        ]
+        await con.execute(f"ALTER TYPE {type_name} {{ CREATE INDEX ON ({expr}); }};")
+        try:
+            after = [
+                await measure(con, s, filtering, runs)
+                for s, filtering in zip(signatures, samples)
+            ]
+        finally:
+            await con.execute(f"ALTER TYPE {type_name} {{ DROP INDEX ON ({expr}); }};")
+        print(f"{type_name}: index on ({expr})")
+        for signature, ms_before, ms_after in zip(signatures, before, after):
+            entity, filter_fields, order_fields = signature
+            print(
+                f"   {entity} filter={','.join(filter_fields) or '-'} "
+                f"order={','.join(order_fields) or '-'}: "
+                f"{ms_before:.2f} ms -> {ms_after:.2f} ms median"
+            )
+
+
+async def main() -> None:
+    args = parse_args()
+    # Measure the database, not the list cache
+    settings.CACHE_ENABLED = False
+    settings.SIGNATURES_ENABLED = False
+    observed = load(args.path)
+    schema_text = schema_path.read_text()
+    ranked = rank(observed, schema_text)[: args.top]
+    if not ranked:
+        logger.info("No missing index found")
+        return
+    if args.command == "report":
+        report(ranked)
+        print(schema_diff(schema_text, [candidate for candidate, _, _ in ranked]))
+        return
+    if not args.apply:
+        logger.error(
+            "replay creates and drops indexes on the database, run it against "
+            "a local copy of the data with --apply"
+        )
+        return
+    logger.info("Replaying signatures")
+    con = await check_db()
+    if con:
+        try:
+            await replay(con, ranked, args.runs)
+        finally:
+            await con.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
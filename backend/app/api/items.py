@@ -1,81 +1,199 @@
-from typing import Any
+from typing import Any, AsyncGenerator, Optional
 from uuid import UUID
 
 from edgedb import AsyncIOConnection
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 
-from app import auth, crud, db, schemas
+from app import auth, blobs, crud, db, events, loaders, schemas, shards, sync, tracing
+from app.config import settings
+from app.responses import RangedFileResponse
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
 
 
 @router.get("/", response_model=schemas.PaginatedItems)
 async def read_items(
-    con: AsyncIOConnection = Depends(db.get_con),
+    current_user: schemas.User = Depends(auth.get_current_active_user),
+    con: AsyncIOConnection = Depends(db.get_ro_con),
     filtering: schemas.ItemFilterParams = Depends(),
     commons: schemas.CommonQueryParams = Depends(),
-    current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
     Retrieve items.
     """
     if not current_user.is_superuser:
         filtering.owner__id = current_user.id
-    items = await crud.item.get_multi(
+    if filtering.owner__id or not shards.enabled():
+        shard = shards.shard_for(filtering.owner__id)
+        async with shards.connection(shard, con) as shard_con:
+            items = await crud.item.get_multi(
+                shard_con,
+                filtering=filtering.dict_exclude_unset(),
+                ordering=commons.ordering,
+                offset=commons.offset,
+                limit=commons.limit,
+                shard=shard,
+                replica=db.is_replica(shard_con),
+            )
+        return items
+    # Each shard's first offset + limit items, merged on the ordering
+    if commons.offset + commons.limit > settings.SHARD_MAX_MERGE_WINDOW:
+        raise HTTPException(
+            status_code=400,
+            detail=f"offset + limit can't exceed {settings.SHARD_MAX_MERGE_WINDOW} "
+            "without an owner__id filter",
+        )
+    pages = await shards.scatter(
         con,
-        filtering=filtering.dict_exclude_unset(),
-        ordering=commons.ordering,
-        offset=commons.offset,
-        limit=commons.limit,
+        lambda shard_con, shard: crud.item.get_multi(
+            shard_con,
+            filtering=filtering.dict_exclude_unset(),
+            ordering=commons.ordering,
+            offset=0,
+            limit=commons.offset + commons.limit,
+            shard=shard,
+            replica=db.is_replica(shard_con),
+        ),
+    )
+    return schemas.PaginatedItems(
+        count=sum(page.count for page in pages),
+        data=shards.merge(
+            [page.data for page in pages],
+            commons.ordering,
+            commons.offset,
+            commons.limit,
+        ),
     )
-    return items
 
 
 @router.post("/", response_model=schemas.Item, status_code=201)
 async def create_item(
     *,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
     con: AsyncIOConnection = Depends(db.get_con),
     item_in: schemas.ItemCreate,
-    current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
     Create new item.
     """
-    item = await crud.item.create(con, obj_in=item_in, owner_id=current_user.id)
+    shard = shards.shard_for(current_user.id)
+    async with shards.connection(shard, con) as shard_con:
+        await shards.ensure_owner(shard_con, shard, current_user)
+        item = await crud.item.create(
+            shard_con, obj_in=item_in, owner_id=current_user.id
+        )
+    if shard:
+        await crud.user.add_num_items(con, id=current_user.id, delta=1)
     return item
 
 
+@router.get("/events", response_class=StreamingResponse)
+async def read_item_events(
+    request: Request,
+    last_event_id: Optional[str] = Header(None),
+    current_user: schemas.User = Depends(auth.get_current_active_user),
+) -> Any:
+    """
+    Stream item changes as server-sent events. Only the changes made through
+    this worker are streamed.
+    """
+    owner_id = None if current_user.is_superuser else current_user.id
+    subscriber = events.hub.subscribe(owner_id, last_event_id)
+
+    async def stream() -> AsyncGenerator[bytes, None]:
+        try:
+            while not await request.is_disconnected():
+                batch = await subscriber.get(settings.EVENTS_KEEPALIVE_SECONDS)
+                if not batch:
+                    yield b": keepalive\n\n"
+                for event in batch:
+                    yield event.encode(events.hub.epoch)
+        finally:
+            events.hub.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/changes", response_model=schemas.ItemChanges)
+async def read_item_changes(
+    current_user: schemas.User = Depends(auth.get_current_active_user),
+    con: AsyncIOConnection = Depends(db.get_con),
+    since: Optional[str] = None,
+    limit: int = 100,
+) -> Any:
+    """
+    Get the items changed and deleted since a cursor from a previous call.
+    """
+    # On reset tombstones may be gone, the client must resync from scratch
+    seqs, reset = sync.decode_cursor(since)
+    limit = max(1, min(limit, settings.SYNC_MAX_LIMIT))
+    if not current_user.is_superuser:
+        shard = shards.shard_for(current_user.id)
+        async with shards.connection(shard, con) as shard_con:
+            items, deleted, seqs[shard], has_more = await crud.item.get_changes(
+                shard_con, since=seqs[shard], owner_id=current_user.id, limit=limit
+            )
+        return schemas.ItemChanges(
+            items=items,
+            deleted=deleted,
+            cursor=sync.encode_cursor(seqs),
+            has_more=has_more,
+            reset=reset,
+        )
+    # Sequences are per database, the cursor has one for each shard
+    changes = await shards.scatter(
+        con,
+        lambda shard_con, shard: crud.item.get_changes(
+            shard_con,
+            since=seqs[shard],
+            limit=max(1, limit // shards.count()),
+        ),
+    )
+    return schemas.ItemChanges(
+        items=[item for shard_items, _, _, _ in changes for item in shard_items],
+        deleted=[id for _, shard_deleted, _, _ in changes for id in shard_deleted],
+        cursor=sync.encode_cursor([last_seq for _, _, last_seq, _ in changes]),
+        has_more=any(has_more for _, _, _, has_more in changes),
+        reset=reset,
+    )
+
+
 @router.put("/{item_id}", response_model=schemas.Item)
 async def update_item(
     *,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
     con: AsyncIOConnection = Depends(db.get_con),
     item_id: UUID,
     item_in: schemas.ItemUpdate,
-    current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
     Update an item.
     """
-    item = await crud.item.get(con, id=item_id)
+    item = await loaders.item.load(item_id, con)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     if not current_user.is_superuser and (item.owner.id != current_user.id):
         raise HTTPException(status_code=400, detail="Not enough permissions")
-    item = await crud.item.update(con, id=item_id, obj_in=item_in)
+    async with shards.connection(shards.shard_for(item.owner.id), con) as shard_con:
+        item = await crud.item.update(shard_con, id=item_id, obj_in=item_in)
     return item
 
 
 @router.get("/{item_id}", response_model=schemas.Item)
 async def read_item(
     *,
-    con: AsyncIOConnection = Depends(db.get_con),
     item_id: UUID,
     current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
     Get item by id.
     """
-    item = await crud.item.get(con, id=item_id)
+    item = await loaders.item.load(item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     if not current_user.is_superuser and (item.owner.id != current_user.id):
@@ -86,17 +204,93 @@ async def read_item(
 @router.delete("/{item_id}", response_model=schemas.Item)
 async def delete_item(
     *,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
     con: AsyncIOConnection = Depends(db.get_con),
     item_id: UUID,
-    current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
     Delete an item.
     """
-    item = await crud.item.get(con, id=item_id)
+    item = await loaders.item.load(item_id, con)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     if not current_user.is_superuser and (item.owner.id != current_user.id):
         raise HTTPException(status_code=400, detail="Not enough permissions")
-    item = await crud.item.remove(con, id=item_id)
+    shard = shards.shard_for(item.owner.id)
+    async with shards.connection(shard, con) as shard_con:
+        item = await crud.item.remove(shard_con, id=item_id)
+    if shard:
+        await crud.user.add_num_items(con, id=item.owner.id, delta=-1)
     return item
+
+
+@router.post(
+    "/{item_id}/attachments", response_model=schemas.Attachment, status_code=201
+)
+async def create_attachment(
+    *,
+    request: Request,
+    item_id: UUID,
+    filename: str,
+    content_type: str = Header("application/octet-stream"),
+    current_user: schemas.User = Depends(auth.get_current_active_user),
+) -> Any:
+    """
+    Upload an attachment to an item, the request body is the file.
+    """
+    item = await loaders.item.load(item_id)
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if not current_user.is_superuser and (item.owner.id != current_user.id):
+        raise HTTPException(status_code=400, detail="Not enough permissions")
+    # No connection is held while the body is received
+    sha256, size = await blobs.save(request.stream())
+    pool = shards.get_pool(shards.shard_for(item.owner.id))
+    con = await db.acquire(pool)
+    try:
+        attachment = await crud.attachment.create(
+            con,
+            item_id=item_id,
+            filename=filename,
+            content_type=content_type,
+            size=size,
+            sha256=sha256,
+        )
+    finally:
+        await pool.release(con)
+    return attachment
+
+
+@router.get("/{item_id}/attachments/{attachment_id}", response_class=Response)
+async def read_attachment(
+    *,
+    request: Request,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
+    item_id: UUID,
+    attachment_id: UUID,
+) -> Any:
+    """
+    Download an attachment of an item.
+    """
+    item = await loaders.item.load(item_id)
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if not current_user.is_superuser and (item.owner.id != current_user.id):
+        raise HTTPException(status_code=400, detail="Not enough permissions")
+    # No connection is held while the file is sent
+    pool = shards.get_pool(shards.shard_for(item.owner.id))
+    con = await db.acquire(pool)
+    try:
+        attachment = await crud.attachment.get(con, id=attachment_id, item_id=item_id)
+    finally:
+        await pool.release(con)
+    if not attachment:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return RangedFileResponse(
+        str(blobs.blob_path(attachment.sha256)),
+        request.headers,
+        size=attachment.size,
+        etag=f'"{attachment.sha256}"',
+        media_type=attachment.content_type,
+        filename=attachment.filename,
+    )
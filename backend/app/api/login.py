@@ -5,7 +5,7 @@ from edgedb import AsyncIOConnection
 from fastapi import APIRouter, Body, Depends, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
 
-from app import auth, crud, db, schemas
+from app import auth, crud, db, ratelimit, schemas, tracing
 from app.config import settings
 from app.security import (
     create_access_token,
@@ -15,10 +15,14 @@ from app.security import (
 )
 from app.utils import send_reset_password_email
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
 
 
-@router.post("/login/access-token", response_model=schemas.Token)
+@router.post(
+    "/login/access-token",
+    response_model=schemas.Token,
+    dependencies=[Depends(ratelimit.limit_login)],
+)
 async def login_access_token(
     con: AsyncIOConnection = Depends(db.get_con),
     form_data: OAuth2PasswordRequestForm = Depends(),
@@ -51,14 +55,21 @@ async def test_token(
     return current_user
 
 
-@router.post("/password-recovery/{email}", response_model=schemas.Msg)
+@router.post(
+    "/password-recovery/{email}",
+    response_model=schemas.Msg,
+    dependencies=[Depends(ratelimit.limit_password_recovery)],
+)
 async def recover_password(
     email: str, con: AsyncIOConnection = Depends(db.get_con)
 ) -> Any:
     """
     Password Recovery
     """
-    user = await crud.user.get_by_email(con, email=email)
+    # Most floods are of unknown addresses, which the email index answers
+    user = None
+    if await crud.user.exists_by_email(con, email=email):
+        user = await crud.user.get_by_email(con, email=email)
     if not user:
         raise HTTPException(
             status_code=404,
@@ -6,19 +6,19 @@ from fastapi import APIRouter, Body, Depends, HTTPException
 from fastapi.encoders import jsonable_encoder
 from pydantic.networks import EmailStr
 
-from app import auth, crud, db, schemas
+from app import auth, crud, db, loaders, schemas, tracing
 from app.config import settings
 from app.utils import send_new_account_email
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
 
 
 @router.get("/", response_model=schemas.PaginatedUsers)
 async def read_users(
-    con: AsyncIOConnection = Depends(db.get_con),
+    current_user: schemas.User = Depends(auth.get_current_active_superuser),
+    con: AsyncIOConnection = Depends(db.get_ro_con),
     filtering: schemas.UserFilterParams = Depends(),
     commons: schemas.CommonQueryParams = Depends(),
-    current_user: schemas.User = Depends(auth.get_current_active_superuser),
 ) -> Any:
     """
     Retrieve users.
@@ -29,6 +29,7 @@ async def read_users(
         ordering=commons.ordering,
         offset=commons.offset,
         limit=commons.limit,
+        replica=db.is_replica(con),
     )
     return paginated_users
 
@@ -36,15 +37,14 @@ async def read_users(
 @router.post("/", response_model=schemas.User, status_code=201)
 async def create_user(
     *,
+    current_user: schemas.User = Depends(auth.get_current_active_superuser),
     con: AsyncIOConnection = Depends(db.get_con),
     user_in: schemas.UserCreate,
-    current_user: schemas.User = Depends(auth.get_current_active_superuser),
 ) -> Any:
     """
     Create new user.
     """
-    user = await crud.user.get_by_email(con, email=user_in.email)
-    if user:
+    if await crud.user.exists_by_email(con, email=user_in.email):
         raise HTTPException(
             status_code=400,
             detail="The user with this username already exists in the system.",
@@ -60,11 +60,11 @@ async def create_user(
 @router.put("/me", response_model=schemas.User)
 async def update_user_me(
     *,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
     con: AsyncIOConnection = Depends(db.get_con),
     password: str = Body(None),
     full_name: str = Body(None),
     email: EmailStr = Body(None),
-    current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
     Update own user.
@@ -83,7 +83,6 @@ async def update_user_me(
 
 @router.get("/me", response_model=schemas.User)
 async def read_user_me(
-    con: AsyncIOConnection = Depends(db.get_con),
     current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
@@ -108,8 +107,7 @@ async def create_user_open(
             status_code=403,
             detail="Open user registration is forbidden on this server",
         )
-    user = await crud.user.get_by_email(con, email=email)
-    if user:
+    if await crud.user.exists_by_email(con, email=email):
         raise HTTPException(
             status_code=400,
             detail="The user with this username already exists in the system",
@@ -122,14 +120,13 @@ async def create_user_open(
 @router.get("/{user_id}", response_model=schemas.User)
 async def read_user(
     *,
-    con: AsyncIOConnection = Depends(db.get_con),
     user_id: UUID,
     current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
     Get user by id.
     """
-    user = await crud.user.get(con, id=user_id)
+    user = await loaders.user.load(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     if user == current_user:
@@ -144,10 +141,10 @@ async def read_user(
 @router.put("/{user_id}", response_model=schemas.User)
 async def update_user(
     *,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
     con: AsyncIOConnection = Depends(db.get_con),
     user_id: UUID,
     user_in: schemas.UserUpdate,
-    current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
     Update a user.
@@ -162,20 +159,38 @@ async def update_user(
     return user
 
 
-@router.delete("/{user_id}", response_model=schemas.User)
+@router.delete("/{user_id}", response_model=schemas.DeletionJob, status_code=202)
 async def delete_user(
     *,
+    current_user: schemas.User = Depends(auth.get_current_active_user),
     con: AsyncIOConnection = Depends(db.get_con),
     user_id: UUID,
-    current_user: schemas.User = Depends(auth.get_current_active_user),
 ) -> Any:
     """
-    Delete a user.
+    Deactivate a user and queue the deletion of the user and its items.
     """
     user = await crud.user.get(con, id=user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     if not current_user.is_superuser and (user.id != current_user.id):
         raise HTTPException(status_code=400, detail="Not enough permissions")
-    user = await crud.user.remove(con, id=user_id)
-    return user
+    job = await crud.deletion.create(con, user_id=user_id)
+    return job
+
+
+@router.get("/deletions/{job_id}", response_model=schemas.DeletionJob)
+async def read_deletion(
+    *,
+    current_user: schemas.User = Depends(auth.get_current_user),
+    con: AsyncIOConnection = Depends(db.get_con),
+    job_id: UUID,
+) -> Any:
+    """
+    Get the progress of a user deletion.
+    """
+    job = await crud.deletion.get(con, id=job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Deletion not found")
+    if not current_user.is_superuser and (job.user_id != current_user.id):
+        raise HTTPException(status_code=400, detail="Not enough permissions")
+    return job
@@ -1,12 +1,12 @@
 from typing import Any
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from pydantic.networks import EmailStr
 
-from app import auth, schemas
+from app import auth, email_index, schemas, stats, tracing, warmup
 from app.utils import send_test_email
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
 
 
 @router.post("/test-email/", response_model=schemas.Msg, status_code=201)
@@ -20,3 +20,33 @@ def test_email(
     send_test_email(email_to=email_to)
     msg = schemas.Msg(msg="Test email sent")
     return msg
+
+
+@router.get("/stats", response_model=schemas.Stats)
+def read_stats(
+    current_user: schemas.User = Depends(auth.get_current_active_superuser),
+) -> Any:
+    """
+    Get system totals and the items-per-owner distribution.
+    """
+    return stats.rollup.snapshot()
+
+
+@router.get("/email-index", response_model=schemas.EmailIndexStats)
+def read_email_index(
+    current_user: schemas.User = Depends(auth.get_current_active_superuser),
+) -> Any:
+    """
+    Get the size and false positive rates of the email index.
+    """
+    return email_index.index.stats()
+
+
+@router.get("/ready", response_model=schemas.Msg)
+def read_ready() -> Any:
+    """
+    Readiness probe, OK once the worker has warmed up.
+    """
+    if not warmup.ready:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return schemas.Msg(msg="Ready")
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
+from uuid import UUID
+
+from edgedb import AsyncIOConnection
+
+from . import db
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+DEACTIVATE = "deactivate"
+
+redacted_fields = ("password", "hashed_password")
+
+# The authenticated user making the current request, set by auth
+actor: ContextVar[Optional[UUID]] = ContextVar("actor", default=None)
+
+buffer: Deque[Dict[str, Any]] = deque()
+dropped = 0
+flush_wanted: Optional[asyncio.Event] = None
+task: Optional["asyncio.Task[None]"] = None
+
+
+def record(
+    action: str, entity: str, entity_id: UUID, changes: Dict[str, Any] = {}
+) -> None:
+    """
+    Queue an audit event without waiting. When the buffer is full, the
+    oldest or this event is dropped, following AUDIT_OVERFLOW.
+    """
+    global dropped
+    if not settings.AUDIT_ENABLED:
+        return
+    if len(buffer) >= settings.AUDIT_BUFFER_SIZE:
+        dropped += 1
+        if settings.AUDIT_OVERFLOW == "drop_newest":
+            return
+        buffer.popleft()
+    actor_id = actor.get()
+    buffer.append(
+        {
+            "actor_id": str(actor_id) if actor_id else None,
+            "action": action,
+            "entity": entity,
+            "entity_id": str(entity_id),
+            "changes": {
+                k: "***" if k in redacted_fields else v for k, v in changes.items()
+            },
+            "occurred_at": datetime.now(timezone.utc).isoformat(),
+        }
+    )
+    if flush_wanted and len(buffer) >= settings.AUDIT_FLUSH_SIZE:
+        flush_wanted.set()
+
+
+async def flush(con: Optional[AsyncIOConnection] = None) -> int:
+    """
+    Insert up to AUDIT_FLUSH_SIZE buffered events in one statement, on con
+    or else a connection of the pool, and return how many.
+    """
+    events: List[Dict[str, Any]] = []
+    while buffer and len(events) < settings.AUDIT_FLUSH_SIZE:
+        events.append(buffer.popleft())
+    if not events:
+        return 0
+    try:
+        flush_con = con or await db.acquire(db.pool)
+        try:
+            await flush_con.query(
+                """FOR event IN {json_array_unpack(<json>$events)}
+                UNION (
+                    INSERT AuditEvent {
+                        actor_id := <uuid>json_get(event, 'actor_id'),
+                        action := <str>event['action'],
+                        entity := <str>event['entity'],
+                        entity_id := <uuid>event['entity_id'],
+                        changes := event['changes'],
+                        occurred_at := <datetime>event['occurred_at']
+                    }
+                )""",
+                events=json.dumps(events, default=str),
+            )
+        finally:
+            if not con:
+                await db.pool.release(flush_con)
+    except BaseException:
+        # Put them back in order for the next attempt, room permitting
+        room = settings.AUDIT_BUFFER_SIZE - len(buffer)
+        buffer.extendleft(reversed(events[:room]))
+        raise
+    return len(events)
+
+
+async def run_flush(wanted: asyncio.Event) -> None:
+    reported = 0
+    while True:
+        try:
+            await asyncio.wait_for(wanted.wait(), settings.AUDIT_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        wanted.clear()
+        try:
+            while await flush() == settings.AUDIT_FLUSH_SIZE:
+                pass
+        except Exception as e:
+            logger.error(f"Writing audit events failed: {e}")
+            await asyncio.sleep(settings.AUDIT_FLUSH_SECONDS)
+        if dropped != reported:
+            logger.warning(f"Audit buffer full, {dropped - reported} events dropped")
+            reported = dropped
+
+
+async def start() -> None:
+    global task, flush_wanted
+    if settings.AUDIT_ENABLED:
+        flush_wanted = asyncio.Event()
+        task = asyncio.ensure_future(run_flush(flush_wanted))
+
+
+async def stop(con: Optional[AsyncIOConnection] = None) -> None:
+    """
+    Stop flushing in the background and write the events left, on con if
+    given, for scripts that have no pool.
+    """
+    if task:
+        task.cancel()
+        try:
+            # Let a flush in progress put its events back first
+            await task
+        except asyncio.CancelledError:
+            pass
+    try:
+        while await flush(con):
+            pass
+    except Exception as e:
+        logger.error(f"{len(buffer)} audit events lost at shutdown: {e}")
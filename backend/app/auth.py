@@ -1,10 +1,9 @@
-from edgedb import AsyncIOConnection
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from pydantic import ValidationError
 
-from . import crud, db, schemas, security
+from . import audit, loaders, schemas, security, tracing
 from .config import settings
 
 reusable_oauth2 = OAuth2PasswordBearer(
@@ -12,22 +11,22 @@ reusable_oauth2 = OAuth2PasswordBearer(
 )
 
 
-async def get_current_user(
-    con: AsyncIOConnection = Depends(db.get_con), token: str = Depends(reusable_oauth2)
-) -> schemas.User:
+async def get_current_user(token: str = Depends(reusable_oauth2)) -> schemas.User:
     try:
-        payload = jwt.decode(
-            token, settings.SECRET_KEY, algorithms=[security.ALGORITHM]
-        )
-        token_data = schemas.TokenPayload(**payload)
+        with tracing.span("auth.decode_token"):
+            payload = jwt.decode(
+                token, settings.SECRET_KEY, algorithms=[security.ALGORITHM]
+            )
+            token_data = schemas.TokenPayload(**payload)
     except (jwt.JWTError, ValidationError):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Could not validate credentials",
         )
-    user = await crud.user.get(con, id=token_data.sub)
+    user = await loaders.user.load(token_data.sub)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    audit.actor.set(user.id)
     return user
 
 
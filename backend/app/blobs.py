@@ -0,0 +1,57 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import IO, AsyncIterator, Tuple
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from .config import settings
+
+
+def blob_path(sha256: str) -> Path:
+    return Path(settings.ATTACHMENTS_DIR) / sha256[:2] / sha256[2:4] / sha256
+
+
+def open_temp() -> IO[bytes]:
+    tmp_dir = Path(settings.ATTACHMENTS_DIR) / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+
+
+def commit(tmp_name: str, sha256: str) -> None:
+    path = blob_path(sha256)
+    if path.exists():
+        # Same content already stored
+        os.unlink(tmp_name)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp_name, path)
+
+
+async def save(chunks: AsyncIterator[bytes]) -> Tuple[str, int]:
+    """
+    Write the chunks to a temporary file while hashing them, then move it to
+    its content address. Returns the SHA-256 hex digest and the size.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    f = await run_in_threadpool(open_temp)
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > settings.ATTACHMENTS_MAX_SIZE:
+                raise HTTPException(status_code=413, detail="Attachment too large")
+            digest.update(chunk)
+            await run_in_threadpool(f.write, chunk)
+        await run_in_threadpool(f.flush)
+        await run_in_threadpool(os.fsync, f.fileno())
+    except BaseException:
+        f.close()
+        os.unlink(f.name)
+        raise
+    f.close()
+    sha256 = digest.hexdigest()
+    await run_in_threadpool(commit, f.name, sha256)
+    return sha256, size
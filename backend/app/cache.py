@@ -0,0 +1,267 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BaseBackend:
+    """
+    Cached values are stored under their key plus the current version of each
+    of their tags, so invalidating a tag is bumping its version: entries
+    stored under the old versions are never read again and expire.
+    """
+
+    async def lookup(
+        self, key: str, tags: List[str], lock_seconds: float
+    ) -> Tuple[str, Optional[str], bool]:
+        """
+        Return the versioned key, the value stored under it if any, and on a
+        miss whether the caller got the lock to compute it.
+        """
+        raise NotImplementedError
+
+    async def store(self, versioned_key: str, value: str, ttl: float) -> None:
+        """
+        Store value and release the lock taken by lookup.
+        """
+        raise NotImplementedError
+
+    async def release(self, versioned_key: str) -> None:
+        """
+        Release the lock taken by lookup without storing a value.
+        """
+        raise NotImplementedError
+
+    async def invalidate(self, tags: List[str]) -> None:
+        raise NotImplementedError
+
+
+class MemoryBackend(BaseBackend):
+    """
+    Cache of a single worker. Versions are drawn from one clock, and at most
+    max_entries tags keep their own, in order of invalidation: the others
+    share the version set when the last one was forgotten, which is newer
+    than any they had.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.clock = 0
+        self.forgotten_version = 0
+        self.versions: "OrderedDict[str, int]" = OrderedDict()
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.locks: Dict[str, float] = {}
+
+    def versioned_key(self, key: str, tags: List[str]) -> str:
+        versions = ",".join(
+            str(self.versions.get(tag, self.forgotten_version)) for tag in tags
+        )
+        return f"{key}:{versions}"
+
+    async def lookup(
+        self, key: str, tags: List[str], lock_seconds: float
+    ) -> Tuple[str, Optional[str], bool]:
+        now = time.monotonic()
+        versioned_key = self.versioned_key(key, tags)
+        entry = self.entries.get(versioned_key)
+        if entry and entry[0] > now:
+            self.entries.move_to_end(versioned_key)
+            return versioned_key, entry[1], False
+        if self.locks.get(versioned_key, 0.0) > now:
+            return versioned_key, None, False
+        if len(self.locks) >= self.max_entries:
+            self.locks = {k: v for k, v in self.locks.items() if v > now}
+        self.locks[versioned_key] = now + lock_seconds
+        return versioned_key, None, True
+
+    async def store(self, versioned_key: str, value: str, ttl: float) -> None:
+        self.locks.pop(versioned_key, None)
+        self.entries.pop(versioned_key, None)
+        self.entries[versioned_key] = (time.monotonic() + ttl, value)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def release(self, versioned_key: str) -> None:
+        self.locks.pop(versioned_key, None)
+
+    async def invalidate(self, tags: List[str]) -> None:
+        for tag in tags:
+            self.clock += 1
+            self.versions.pop(tag, None)
+            self.versions[tag] = self.clock
+        if len(self.versions) > self.max_entries:
+            while len(self.versions) > self.max_entries:
+                self.versions.popitem(last=False)
+            self.clock += 1
+            self.forgotten_version = self.clock
+
+
+LOOKUP_SCRIPT = """
+local versions = {}
+for i, tag in ipairs(KEYS) do
+    versions[i] = redis.call("GET", "cache:tag:" .. tag) or "0"
+end
+local key = "cache:" .. ARGV[1] .. ":" .. table.concat(versions, ",")
+local value = redis.call("GET", key)
+if value then
+    return {key, value, 0}
+end
+local locked = redis.call("SET", key .. ":lock", 1, "PX", ARGV[2], "NX")
+return {key, false, locked and 1 or 0}
+"""
+
+STORE_SCRIPT = """
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+redis.call("DEL", KEYS[1] .. ":lock")
+"""
+
+RELEASE_SCRIPT = """
+redis.call("DEL", KEYS[1] .. ":lock")
+"""
+
+INVALIDATE_SCRIPT = """
+for _, tag in ipairs(KEYS) do
+    redis.call("INCR", "cache:tag:" .. tag)
+end
+"""
+
+
+class RedisBackend(BaseBackend):
+    """
+    Cache shared by several workers. Like ratelimit.RedisStore, the client
+    only needs an aioredis-style `eval(script, keys, args)` coroutine.
+    """
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+
+    async def lookup(
+        self, key: str, tags: List[str], lock_seconds: float
+    ) -> Tuple[str, Optional[str], bool]:
+        versioned_key, value, locked = await self.client.eval(
+            LOOKUP_SCRIPT, keys=tags, args=[key, int(lock_seconds * 1000)]
+        )
+        if isinstance(versioned_key, bytes):
+            versioned_key = versioned_key.decode()
+        if isinstance(value, bytes):
+            value = value.decode()
+        return versioned_key, value, bool(locked)
+
+    async def store(self, versioned_key: str, value: str, ttl: float) -> None:
+        await self.client.eval(
+            STORE_SCRIPT, keys=[versioned_key], args=[value, int(ttl * 1000)]
+        )
+
+    async def release(self, versioned_key: str) -> None:
+        await self.client.eval(RELEASE_SCRIPT, keys=[versioned_key], args=[])
+
+    async def invalidate(self, tags: List[str]) -> None:
+        await self.client.eval(INVALIDATE_SCRIPT, keys=tags, args=[])
+
+
+backend: BaseBackend = MemoryBackend(settings.CACHE_MAX_ENTRIES)
+redis_client: Any = None
+
+
+def set_backend(new_backend: BaseBackend) -> None:
+    global backend
+    backend = new_backend
+
+
+async def start() -> None:
+    global redis_client
+    if not settings.CACHE_ENABLED:
+        return
+    if settings.CACHE_REDIS_URL:
+        import aioredis
+
+        redis_client = await aioredis.create_redis_pool(settings.CACHE_REDIS_URL)
+        set_backend(RedisBackend(redis_client))
+    elif isinstance(backend, MemoryBackend) and settings.WEB_CONCURRENCY > 1:
+        # A worker's writes only invalidate its own pages, the other workers
+        # would serve stale pages until they expire
+        raise RuntimeError("CACHE_ENABLED with several workers needs CACHE_REDIS_URL")
+    logger.info(f"List cache enabled, using {type(backend).__name__}")
+
+
+async def stop() -> None:
+    global redis_client
+    if redis_client:
+        redis_client.close()
+        await redis_client.wait_closed()
+        redis_client = None
+
+
+def list_tags(entity: str, owner_id: Optional[UUID]) -> List[str]:
+    """
+    Tags of a list page: owner-scoped item lists only depend on that owner's
+    items, any other list on the whole entity.
+    """
+    if entity == "items" and owner_id:
+        return [f"items:owner:{owner_id}"]
+    return [entity]
+
+
+def mutation_tags(owner_id: UUID) -> List[str]:
+    """
+    Tags to invalidate when an owner's items or the owner change. Item lists
+    embed owners and user lists embed items, so both entities go.
+    """
+    return ["items", "users", f"items:owner:{owner_id}"]
+
+
+async def invalidate(*owner_ids: UUID) -> None:
+    if not settings.CACHE_ENABLED:
+        return
+    tags = sorted({tag for owner_id in owner_ids for tag in mutation_tags(owner_id)})
+    await backend.invalidate(tags)
+
+
+async def get_or_fetch(
+    entity: str,
+    params: Dict[str, Any],
+    owner_id: Optional[UUID],
+    fetch: Callable[[], Awaitable[str]],
+    replica: bool = False,
+) -> str:
+    """
+    Return the serialized list page for the canonical params from the cache,
+    or fetch and store it. On a miss only the caller holding the lock
+    fetches, the others wait for its result for up to CACHE_LOCK_SECONDS.
+    Pages fetched from the read replica aren't stored.
+    """
+    if not settings.CACHE_ENABLED:
+        return await fetch()
+    key = f"{entity}:{json.dumps(params, sort_keys=True, default=str)}"
+    tags = list_tags(entity, owner_id)
+    deadline = time.monotonic() + settings.CACHE_LOCK_SECONDS
+    while True:
+        versioned_key, value, locked = await backend.lookup(
+            key, tags, settings.CACHE_LOCK_SECONDS
+        )
+        if value is not None:
+            return value
+        if locked or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(settings.CACHE_LOCK_POLL_SECONDS)
+    try:
+        value = await fetch()
+    except BaseException:
+        if locked:
+            await backend.release(versioned_key)
+        raise
+    if replica:
+        # The replica may not have caught up with the writes that bumped the
+        # versions yet, its page could outlive them under the new versions
+        if locked:
+            await backend.release(versioned_key)
+        return value
+    await backend.store(versioned_key, value, settings.CACHE_TTL_SECONDS)
+    return value
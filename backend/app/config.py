@@ -1,3 +1,4 @@
+import multiprocessing
 import secrets
 from typing import Any, Dict, List, Optional, Union
 
@@ -27,6 +28,149 @@ class Settings(BaseSettings):
     EDGEDB_USER: str
     EDGEDB_PASSWORD: str
     EDGEDB_DB: str
+    EDGEDB_PORT: Optional[int] = None
+
+    # Optional read replica for read-only routes
+    EDGEDB_RO_HOST: Optional[str] = None
+    EDGEDB_RO_PORT: Optional[int] = None
+    EDGEDB_RO_DB: Optional[str] = None
+    EDGEDB_RO_ACQUIRE_TIMEOUT: float = 0.5
+    EDGEDB_RO_HEALTH_CHECK_SECONDS: float = 5
+    EDGEDB_RO_RETRY_SECONDS: float = 30
+    # After a write, the session reads from the primary for this long
+    EDGEDB_RO_STICKY_SECONDS: float = 5
+    EDGEDB_RO_MAX_STICKY_SESSIONS: int = 100_000
+
+    # Databases items are sharded over by owner besides the primary, each
+    # "database", "host/database" or "host:port/database",
+    # e.g: '["app_shard1", "localhost:5657/app"]'
+    EDGEDB_SHARDS: List[str] = []
+    SHARD_VIRTUAL_NODES: int = 64
+    SHARD_KNOWN_OWNERS: int = 100_000
+    # Deepest offset + limit of a list merged from every shard
+    SHARD_MAX_MERGE_WINDOW: int = 10_000
+
+    SERVER_HOST: str = "0.0.0.0"
+    SERVER_PORT: int = 8000
+    WEB_CONCURRENCY: int = multiprocessing.cpu_count()
+    GRACEFUL_TIMEOUT: int = 30
+    # Total connections the backend may open, split evenly between workers
+    EDGEDB_POOL_BUDGET: int = 40
+    EDGEDB_POOL_MIN_SIZE: int = 1
+    EDGEDB_POOL_MAX_SIZE: Optional[int] = None
+    # Retries of writes conflicting with a concurrent transaction, e.g. two
+    # new items of one owner both updating its num_items
+    EDGEDB_CONFLICT_RETRIES: int = 5
+    EDGEDB_CONFLICT_BACKOFF_SECONDS: float = 0.01
+
+    @validator("EDGEDB_POOL_MAX_SIZE", pre=True, always=True)
+    def get_pool_max_size(cls, v: Optional[int], values: Dict[str, Any]) -> int:
+        if v:
+            return v
+        return max(1, values["EDGEDB_POOL_BUDGET"] // values["WEB_CONCURRENCY"])
+
+    # get_multi filter/ordering combinations compiled on every connection at
+    # startup, e.g: '[{"entity": "items", "filter": ["owner__id"]}]'
+    WARMUP_TEMPLATES: List[Dict[str, Any]] = [
+        {"entity": "items"},
+        {"entity": "items", "filter": ["owner__id"]},
+        {"entity": "users"},
+        {"entity": "users", "ordering": "email"},
+    ]
+    WARMUP_TIMEOUT_SECONDS: float = 30
+
+    # Cache list pages, in the worker or shared by all workers in Redis,
+    # e.g: "redis://localhost:6379/0". Several workers need Redis
+    CACHE_ENABLED: bool = False
+    CACHE_REDIS_URL: Optional[str] = None
+    CACHE_TTL_SECONDS: float = 30
+    CACHE_MAX_ENTRIES: int = 10_000
+    CACHE_LOCK_SECONDS: float = 5
+    CACHE_LOCK_POLL_SECONDS: float = 0.05
+
+    # Trace a share of the requests, and those an upstream traceparent
+    # header marks as sampled. TRACING_EXPORTER is "json" or "otlp"
+    TRACING_ENABLED: bool = False
+    TRACING_SAMPLE_RATE: float = 0.01
+    TRACING_EXPORTER: str = "json"
+    TRACING_JSON_PATH: str = "traces.jsonl"
+    TRACING_OTLP_ENDPOINT: str = "http://localhost:4318/v1/traces"
+    TRACING_EXPORT_SECONDS: float = 5
+    TRACING_MAX_BUFFERED_SPANS: int = 10_000
+    TRACING_MAX_TEMPLATE_LENGTH: int = 500
+
+    # Content-addressed store of the item attachments
+    ATTACHMENTS_DIR: str = "/app/attachments"
+    ATTACHMENTS_MAX_SIZE: int = 100 * 1024 * 1024
+    ATTACHMENTS_CHUNK_SIZE: int = 64 * 1024
+
+    # Record the filter and ordering shapes of list queries with their
+    # latencies, for `python -m app.advisor`
+    SIGNATURES_ENABLED: bool = False
+    SIGNATURES_PATH: str = "signatures.jsonl"
+    SIGNATURES_FLUSH_SECONDS: float = 60
+
+    # Bloom filter of the user emails, so unknown ones need no query
+    EMAIL_INDEX_ENABLED: bool = True
+    EMAIL_INDEX_FALSE_POSITIVE_RATE: float = 0.01
+    EMAIL_INDEX_MIN_CAPACITY: int = 10_000
+    EMAIL_INDEX_CACHE_SIZE: int = 10_000
+    EMAIL_INDEX_CACHE_TTL_SECONDS: float = 10
+    EMAIL_INDEX_REFRESH_SECONDS: float = 1
+    EMAIL_INDEX_REBUILD_SECONDS: float = 60 * 60
+
+    # Audit events are buffered and written in batches. When the buffer is
+    # full, AUDIT_OVERFLOW "drop_oldest" or "drop_newest" picks what is lost
+    AUDIT_ENABLED: bool = True
+    AUDIT_BUFFER_SIZE: int = 100_000
+    AUDIT_FLUSH_SIZE: int = 500
+    AUDIT_FLUSH_SECONDS: float = 1
+    AUDIT_OVERFLOW: str = "drop_oldest"
+
+    @validator("AUDIT_OVERFLOW")
+    def check_audit_overflow(cls, v: str) -> str:
+        if v not in ("drop_oldest", "drop_newest"):
+            raise ValueError("must be drop_oldest or drop_newest")
+        return v
+
+    # Share one in-flight query between concurrent identical CRUD reads
+    COALESCE_READS: bool = True
+    # Batch user and item lookups by id requested within this window
+    LOADER_WINDOW_SECONDS: float = 0.002
+    LOADER_MAX_BATCH_SIZE: int = 500
+    STATS_RECOMPUTE_SECONDS: int = 60 * 5
+    # Users are deleted in the background, DELETION_BATCH_SIZE items at a time
+    DELETION_BATCH_SIZE: int = 1000
+    DELETION_BATCH_PAUSE_SECONDS: float = 0.05
+    DELETION_POLL_SECONDS: float = 5
+    DELETION_STALE_SECONDS: int = 60
+
+    ADMISSION_ENABLED: bool = True
+    REQUEST_DEADLINE_SECONDS: float = 10
+    # Per route deadlines, keyed by path prefix after API_V1_STR, 0 disables
+    # e.g: '{"/items/": 5, "/login/": 2}'
+    REQUEST_DEADLINES: Dict[str, float] = {}
+    ADMISSION_MAX_IN_FLIGHT: int = 200
+    ADMISSION_MAX_ACQUIRE_WAIT: float = 0.5
+    ADMISSION_WAIT_SMOOTHING: float = 0.2
+    # Without new measurements the average acquire wait halves this often
+    ADMISSION_WAIT_HALF_LIFE: float = 1
+    ADMISSION_RETRY_AFTER: float = 1
+
+    EVENTS_HISTORY_SIZE: int = 10_000
+    EVENTS_QUEUE_SIZE: int = 1000
+    EVENTS_KEEPALIVE_SECONDS: float = 15
+
+    # Deleted items are reported to syncing clients for this long
+    SYNC_TOMBSTONE_RETENTION_DAYS: int = 30
+    SYNC_PRUNE_SECONDS: int = 60 * 60
+    SYNC_MAX_LIMIT: int = 1000
+    # Changes are synced once older than the longest item write transaction
+    SYNC_SETTLE_SECONDS: float = 2
+
+    COMPRESSION_MINIMUM_SIZE: int = 1024
+    GZIP_LEVEL: int = 6
+    BROTLI_QUALITY: int = 4
 
     SMTP_TLS: bool = True
     SMTP_PORT: Optional[int] = None
@@ -60,6 +204,30 @@ class Settings(BaseSettings):
     FIRST_SUPERUSER_PASSWORD: str
     USERS_OPEN_REGISTRATION: bool = False
 
+    # Replay the stored response of mutations retried with an Idempotency-Key,
+    # stored in the worker or shared in Redis, e.g: "redis://localhost:6379/0"
+    IDEMPOTENCY_ENABLED: bool = True
+    IDEMPOTENCY_REDIS_URL: Optional[str] = None
+    IDEMPOTENCY_TTL_SECONDS: float = 24 * 60 * 60
+    IDEMPOTENCY_MAX_KEYS: int = 100_000
+    IDEMPOTENCY_MAX_RESPONSE_SIZE: int = 64 * 1024
+    # Larger request bodies aren't buffered and run without idempotency
+    IDEMPOTENCY_MAX_REQUEST_SIZE: int = 1024 * 1024
+    # How long the original request may run before duplicates may run again
+    IDEMPOTENCY_LOCK_SECONDS: float = 60
+    IDEMPOTENCY_WAIT_SECONDS: float = 10
+    IDEMPOTENCY_POLL_SECONDS: float = 0.05
+
+    # Buckets are per worker unless shared in Redis,
+    # e.g: "redis://localhost:6379/0"
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_REDIS_URL: Optional[str] = None
+    RATE_LIMIT_MAX_KEYS: int = 100_000
+    LOGIN_RATE_PER_MINUTE: int = 10
+    LOGIN_RATE_BURST: int = 5
+    PASSWORD_RECOVERY_RATE_PER_MINUTE: int = 2
+    PASSWORD_RECOVERY_RATE_BURST: int = 3
+
     class Config:
         case_sensitive = True
         env_file = ".env"
@@ -1 +1 @@
-from . import item, user
+from . import attachment, deletion, item, user
@@ -0,0 +1,67 @@
+from typing import Optional
+from uuid import UUID
+
+from edgedb import AsyncIOConnection, NoDataError
+from fastapi import HTTPException
+
+from app.schemas import Attachment
+
+shape = """{
+    id,
+    item_id := .item.id,
+    filename,
+    content_type,
+    size,
+    sha256,
+    created_at
+}"""
+
+
+async def get(
+    con: AsyncIOConnection, *, id: UUID, item_id: UUID
+) -> Optional[Attachment]:
+    try:
+        result = await con.query_one_json(
+            f"""SELECT Attachment {shape}
+            FILTER .id = <uuid>$id AND .item.id = <uuid>$item_id""",
+            id=id,
+            item_id=item_id,
+        )
+    except NoDataError:
+        return None
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    attachment = Attachment.parse_raw(result)
+    return attachment
+
+
+async def create(
+    con: AsyncIOConnection,
+    *,
+    item_id: UUID,
+    filename: str,
+    content_type: str,
+    size: int,
+    sha256: str,
+) -> Attachment:
+    try:
+        result = await con.query_one_json(
+            f"""SELECT (
+                INSERT Attachment {{
+                    item := (SELECT Item FILTER .id = <uuid>$item_id),
+                    filename := <str>$filename,
+                    content_type := <str>$content_type,
+                    size := <int64>$size,
+                    sha256 := <str>$sha256
+                }}
+            ) {shape}""",
+            item_id=item_id,
+            filename=filename,
+            content_type=content_type,
+            size=size,
+            sha256=sha256,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    attachment = Attachment.parse_raw(result)
+    return attachment
@@ -0,0 +1,155 @@
+from datetime import timedelta
+from typing import Optional
+from uuid import UUID
+
+from edgedb import AsyncIOConnection, NoDataError
+from fastapi import HTTPException
+
+from app import audit, cache, stats
+from app.schemas import DeletionJob
+
+shape = """{
+    id,
+    user_id,
+    status,
+    items_total,
+    items_deleted,
+    error,
+    created_at,
+    finished_at
+}"""
+
+
+async def get(con: AsyncIOConnection, *, id: UUID) -> Optional[DeletionJob]:
+    try:
+        result = await con.query_one_json(
+            f"""SELECT DeletionJob {shape}
+            FILTER .id = <uuid>$id""",
+            id=id,
+        )
+    except NoDataError:
+        return None
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    job = DeletionJob.parse_raw(result)
+    return job
+
+
+async def create(con: AsyncIOConnection, *, user_id: UUID) -> DeletionJob:
+    """
+    Deactivate the user and queue its deletion. Queuing the same user twice
+    returns the existing job, queued again if it failed.
+    """
+    try:
+        async with con.transaction():
+            user = await con.query_one(
+                """SELECT (
+                    UPDATE User
+                    FILTER .id = <uuid>$user_id
+                    SET {
+                        is_active := false
+                    }
+                ) {
+                    num_items,
+                    was_active := (
+                        SELECT DETACHED User FILTER .id = <uuid>$user_id
+                    ).is_active
+                }""",
+                user_id=user_id,
+            )
+            await con.query(
+                """UPDATE DeletionJob
+                FILTER .user_id = <uuid>$user_id AND .status = "failed"
+                SET {
+                    status := "pending",
+                    items_total := <int64>$items_total,
+                    items_deleted := 0,
+                    error := {},
+                    updated_at := datetime_current(),
+                    finished_at := {}
+                }""",
+                user_id=user_id,
+                items_total=user.num_items,
+            )
+            result = await con.query_one_json(
+                f"""SELECT (
+                    INSERT DeletionJob {{
+                        user_id := <uuid>$user_id,
+                        items_total := <int64>$items_total
+                    }}
+                    UNLESS CONFLICT ON .user_id
+                ) ?? (
+                    SELECT DeletionJob FILTER .user_id = <uuid>$user_id
+                ) {shape}""",
+                user_id=user_id,
+                items_total=user.num_items,
+            )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    stats.rollup.user_changed(bool(user.was_active), False, False, False)
+    audit.record(audit.DEACTIVATE, "users", user_id)
+    await cache.invalidate(user_id)
+    job = DeletionJob.parse_raw(result)
+    return job
+
+
+async def claim(con: AsyncIOConnection, *, stale_seconds: int) -> Optional[DeletionJob]:
+    """
+    Take the oldest pending job, or a running one whose worker stopped
+    reporting progress for stale_seconds.
+    """
+    try:
+        result = await con.query_one_json(
+            f"""SELECT (
+                UPDATE (
+                    SELECT DeletionJob
+                    FILTER .status = "pending" OR (
+                        .status = "running"
+                        AND .updated_at < datetime_current() - <duration>$stale
+                    )
+                    ORDER BY .created_at
+                    LIMIT 1
+                )
+                SET {{
+                    status := "running",
+                    updated_at := datetime_current()
+                }}
+            ) {shape}""",
+            stale=timedelta(seconds=stale_seconds),
+        )
+    except NoDataError:
+        return None
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    job = DeletionJob.parse_raw(result)
+    return job
+
+
+async def add_progress(con: AsyncIOConnection, *, id: UUID, deleted: int) -> None:
+    await con.query(
+        """UPDATE DeletionJob
+        FILTER .id = <uuid>$id
+        SET {
+            items_deleted := .items_deleted + <int64>$deleted,
+            updated_at := datetime_current()
+        }""",
+        id=id,
+        deleted=deleted,
+    )
+
+
+async def finish(
+    con: AsyncIOConnection, *, id: UUID, error: Optional[str] = None
+) -> None:
+    await con.query(
+        """UPDATE DeletionJob
+        FILTER .id = <uuid>$id
+        SET {
+            status := "failed" IF EXISTS <OPTIONAL str>$error ELSE "done",
+            error := <OPTIONAL str>$error,
+            updated_at := datetime_current(),
+            finished_at := datetime_current()
+        }""",
+        id=id,
+        error=error,
+    )
@@ -1,10 +1,15 @@
-from typing import Any, Dict, Optional
+import json
+from collections import Counter
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import UUID
 
 from edgedb import AsyncIOConnection, NoDataError
 from fastapi import HTTPException
+from pydantic import parse_obj_as
 
-from app import utils
+from app import audit, cache, db, events, signatures, stats, utils
+from app.config import settings
 from app.schemas import (
     Item,
     ItemCreate,
@@ -12,8 +17,10 @@ from app.schemas import (
     PaginatedItems,
     item_ordering_fields,
 )
+from app.singleflight import coalesce
 
 
+@coalesce
 async def get(con: AsyncIOConnection, *, id: UUID) -> Optional[Item]:
     try:
         result = await con.query_one_json(
@@ -38,6 +45,29 @@ async def get(con: AsyncIOConnection, *, id: UUID) -> Optional[Item]:
     return item
 
 
+async def get_many(con: AsyncIOConnection, *, ids: List[UUID]) -> List[Item]:
+    try:
+        result = await con.query_json(
+            """SELECT Item {
+                id,
+                title,
+                description,
+                owner: {
+                    id,
+                    email,
+                    full_name
+                }
+            }
+            FILTER .id IN array_unpack(<array<uuid>>$ids)""",
+            ids=ids,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    items = parse_obj_as(List[Item], json.loads(result))
+    return items
+
+
+@coalesce
 async def get_multi(
     con: AsyncIOConnection,
     *,
@@ -45,7 +75,11 @@ async def get_multi(
     ordering: str = None,
     offset: int = 0,
     limit: int = 100,
+    shard: int = 0,
+    replica: bool = False,
 ) -> PaginatedItems:
+    # shard only tells apart the coalescing and cache keys of each shard,
+    # replica says con reads from the read replica
     filter_expr = None
     order_expr = None
     if filtering:
@@ -53,32 +87,49 @@ async def get_multi(
     if ordering:
         order_expr = utils.get_order(ordering, item_ordering_fields)
     try:
-        result = await con.query_one_json(
-            f"""WITH items := (
-                SELECT Item
-                FILTER {filter_expr or 'true'}
-            )
-            SELECT <json>(
-                count:= count(items),
-                data := array_agg((
-                    SELECT items {{
-                        id,
-                        title,
-                        description,
-                        owner: {{
-                            id,
-                            email,
-                            full_name
-                        }}
-                    }}
-                    ORDER BY {order_expr or '{}'}
-                    OFFSET <int64>$offset
-                    LIMIT <int64>$limit
-                ))
-            )""",
-            **filtering,
-            offset=offset,
-            limit=limit,
+        result = await cache.get_or_fetch(
+            "items",
+            {
+                "filtering": filtering,
+                "ordering": ordering,
+                "offset": offset,
+                "limit": limit,
+                "shard": shard,
+            },
+            filtering.get("owner__id"),
+            lambda: signatures.timed(
+                "items",
+                filtering,
+                ordering,
+                con.query_one_json(
+                    f"""WITH items := (
+                        SELECT Item
+                        FILTER {filter_expr or 'true'}
+                    )
+                    SELECT <json>(
+                        count:= count(items),
+                        data := array_agg((
+                            SELECT items {{
+                                id,
+                                title,
+                                description,
+                                owner: {{
+                                    id,
+                                    email,
+                                    full_name
+                                }}
+                            }}
+                            ORDER BY {order_expr or '{}'}
+                            OFFSET <int64>$offset
+                            LIMIT <int64>$limit
+                        ))
+                    )""",
+                    **filtering,
+                    offset=offset,
+                    limit=limit,
+                ),
+            ),
+            replica=replica,
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"{e}")
@@ -90,33 +141,114 @@ async def create(con: AsyncIOConnection, *, obj_in: ItemCreate, owner_id: UUID)
     data_in = obj_in.dict(exclude_unset=True)
     shape_expr = utils.get_shape(data_in)
     try:
-        result = await con.query_one_json(
-            f"""SELECT (
-                INSERT Item {{
-                    {shape_expr},
-                    owner := (
-                        SELECT User FILTER .id = <uuid>$owner_id
-                    )
-                }}
-            ) {{
-                id,
-                title,
-                description,
-                owner: {{
+        # Concurrent creates for one owner conflict on its num_items
+        result = await db.retry_conflicts(
+            lambda: con.query_one_json(
+                f"""WITH owner := (
+                    UPDATE User
+                    FILTER .id = <uuid>$owner_id
+                    SET {{
+                        num_items := .num_items + 1
+                    }}
+                )
+                SELECT (
+                    INSERT Item {{
+                        {shape_expr},
+                        owner := owner
+                    }}
+                ) {{
                     id,
-                    email,
-                    full_name
-                }}
-            }}""",
-            **data_in,
-            owner_id=owner_id,
+                    title,
+                    description,
+                    owner: {{
+                        id,
+                        email,
+                        full_name,
+                        num_items
+                    }}
+                }}""",
+                **data_in,
+                owner_id=owner_id,
+            )
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"{e}")
-    item = Item.parse_raw(result)
+    data = json.loads(result)
+    stats.rollup.items_added(data["owner"]["num_items"])
+    item = Item.parse_obj(data)
+    events.hub.publish(events.CREATED, item)
+    audit.record(audit.CREATE, "items", item.id, data_in)
+    await cache.invalidate(owner_id)
     return item
 
 
+async def create_bulk(con: AsyncIOConnection, *, data_in: List[Dict[str, Any]]) -> int:
+    """
+    Insert items from dicts with title, description and owner_id, keeping
+    the owners' num_items counters in step. Returns the number inserted.
+    """
+    counts = Counter(str(item["owner_id"]) for item in data_in)
+    try:
+        async with con.transaction():
+            result = await con.query_json(
+                """FOR item IN {json_array_unpack(<json>$data)}
+                UNION (
+                    INSERT Item {
+                        title := <str>item['title'],
+                        description := <str>json_get(item, 'description'),
+                        owner := (
+                            SELECT User
+                            FILTER .id = <uuid><str>item['owner_id']
+                        )
+                    }
+                ) {
+                    id,
+                    title,
+                    description,
+                    owner: {
+                        id,
+                        email,
+                        full_name
+                    }
+                }""",
+                data=json.dumps(data_in, default=str),
+            )
+            owners = await con.query(
+                """FOR owner IN {json_array_unpack(<json>$counts)}
+                UNION (
+                    UPDATE User
+                    FILTER .id = <uuid><str>owner['id']
+                    SET {
+                        num_items := .num_items + <int64>owner['count']
+                    }
+                ) {
+                    id,
+                    num_items
+                }""",
+                counts=json.dumps([{"id": k, "count": v} for k, v in counts.items()]),
+            )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    for owner in owners:
+        stats.rollup.items_added(owner.num_items, counts[str(owner.id)])
+    for item in parse_obj_as(List[Item], json.loads(result)):
+        events.hub.publish(events.CREATED, item)
+        audit.record(
+            audit.CREATE,
+            "items",
+            item.id,
+            {
+                "title": item.title,
+                "description": item.description,
+                "owner_id": item.owner.id,
+            },
+        )
+    await cache.invalidate(*(owner.id for owner in owners))
+    return len(data_in)
+
+
 async def update(
     con: AsyncIOConnection, *, id: UUID, obj_in: ItemUpdate
 ) -> Optional[Item]:
@@ -131,7 +263,9 @@ async def update(
                 UPDATE Item
                 FILTER .id = <uuid>$id
                 SET {{
-                    {shape_expr}
+                    {shape_expr},
+                    change_seq := sequence_next(INTROSPECT ChangeSeq),
+                    changed_at := datetime_current()
                 }}
             ) {{
                 id,
@@ -149,28 +283,245 @@ async def update(
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"{e}")
     item = Item.parse_raw(result)
+    events.hub.publish(events.UPDATED, item)
+    audit.record(audit.UPDATE, "items", id, data_in)
+    await cache.invalidate(item.owner.id)
     return item
 
 
 async def remove(con: AsyncIOConnection, *, id: UUID) -> Item:
+    async def delete() -> Tuple[Item, Any]:
+        async with con.transaction():
+            result = await con.query_one_json(
+                """SELECT (
+                    DELETE Item
+                    FILTER .id = <uuid>$id
+                ) {
+                    id,
+                    title,
+                    description,
+                    owner: {
+                        id,
+                        email,
+                        full_name
+                    }
+                }""",
+                id=id,
+            )
+            item = Item.parse_raw(result)
+            # Referencing the tombstone in the shape makes sure it is inserted
+            owner = await con.query_one(
+                """WITH tombstone := (
+                    INSERT ItemTombstone {
+                        item_id := <uuid>$id,
+                        owner_id := <uuid>$owner_id
+                    }
+                )
+                SELECT (
+                    UPDATE User
+                    FILTER .id = <uuid>$owner_id
+                    SET {
+                        num_items := .num_items - 1
+                    }
+                ) {
+                    num_items,
+                    change_seq := tombstone.change_seq
+                }""",
+                id=id,
+                owner_id=item.owner.id,
+            )
+        return item, owner
+
     try:
-        result = await con.query_one_json(
-            """SELECT (
-                DELETE Item
-                FILTER .id = <uuid>$id
-            ) {
-                id,
-                title,
-                description,
-                owner: {
+        # Concurrent removals for one owner conflict on its num_items
+        item, owner = await db.retry_conflicts(delete)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    stats.rollup.items_removed(owner.num_items)
+    events.hub.publish(events.DELETED, item)
+    audit.record(audit.DELETE, "items", id)
+    await cache.invalidate(item.owner.id)
+    return item
+
+
+async def remove_by_owner(con: AsyncIOConnection, *, owner_id: UUID, limit: int) -> int:
+    """
+    Delete up to limit items of an owner and return how many were deleted.
+    """
+    try:
+        async with con.transaction():
+            result = await con.query_json(
+                """SELECT (
+                    DELETE (
+                        SELECT Item
+                        FILTER .owner.id = <uuid>$owner_id
+                        LIMIT <int64>$limit
+                    )
+                ) {
                     id,
-                    email,
-                    full_name
-                }
-            }""",
-            id=id,
+                    title,
+                    description,
+                    owner: {
+                        id,
+                        email,
+                        full_name
+                    }
+                }""",
+                owner_id=owner_id,
+                limit=limit,
+            )
+            items = parse_obj_as(List[Item], json.loads(result))
+            deleted = len(items)
+            owner = await con.query_one(
+                """WITH tombstones := (
+                    FOR item_id IN {array_unpack(<array<uuid>>$ids)}
+                    UNION (
+                        INSERT ItemTombstone {
+                            item_id := item_id,
+                            owner_id := <uuid>$owner_id
+                        }
+                    )
+                )
+                SELECT (
+                    UPDATE User
+                    FILTER .id = <uuid>$owner_id
+                    SET {
+                        num_items := .num_items - <int64>$deleted
+                    }
+                ) {
+                    num_items,
+                    tombstones := count(tombstones)
+                }""",
+                owner_id=owner_id,
+                ids=[item.id for item in items],
+                deleted=deleted,
+            )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    if deleted:
+        stats.rollup.items_removed(owner.num_items, deleted)
+    for item in items:
+        events.hub.publish(events.DELETED, item)
+        audit.record(audit.DELETE, "items", item.id)
+    if deleted:
+        await cache.invalidate(owner_id)
+    return deleted
+
+
+async def get_changes(
+    con: AsyncIOConnection,
+    *,
+    since: int,
+    owner_id: Optional[UUID] = None,
+    limit: int = 100,
+) -> Tuple[List[Item], List[UUID], int, bool]:
+    """
+    Return the items created or updated and the ids of the items deleted
+    after change sequence number since, oldest first and at most limit of
+    them, with the last sequence number returned and whether there are more.
+
+    Sequence numbers are taken before their transaction commits, so a
+    change may become visible after a higher one. Changes stop before the
+    first one younger than SYNC_SETTLE_SECONDS, which lower ones still in
+    flight could commit behind.
+    """
+    item_filter = tombstone_filter = ""
+    params: Dict[str, Any] = {}
+    if owner_id:
+        item_filter = "AND .owner.id = <uuid>$owner_id"
+        tombstone_filter = "AND .owner_id = <uuid>$owner_id"
+        params["owner_id"] = owner_id
+    try:
+        result = await con.query_one_json(
+            f"""WITH
+                horizon := datetime_current() - <duration>$settle,
+                unsettled := min({{
+                    (
+                        SELECT Item
+                        FILTER .change_seq > <int64>$since
+                        AND .changed_at > horizon
+                        {item_filter}
+                    ).change_seq,
+                    (
+                        SELECT ItemTombstone
+                        FILTER .change_seq > <int64>$since
+                        AND .deleted_at > horizon
+                        {tombstone_filter}
+                    ).change_seq
+                }}) ?? <int64>9223372036854775807
+            SELECT <json>(
+                items := array_agg((
+                    SELECT Item {{
+                        id,
+                        title,
+                        description,
+                        owner: {{
+                            id,
+                            email,
+                            full_name
+                        }},
+                        change_seq
+                    }}
+                    FILTER .change_seq > <int64>$since
+                    AND .change_seq < unsettled
+                    {item_filter}
+                    ORDER BY .change_seq
+                    LIMIT <int64>$limit
+                )),
+                tombstones := array_agg((
+                    SELECT ItemTombstone {{
+                        item_id,
+                        change_seq
+                    }}
+                    FILTER .change_seq > <int64>$since
+                    AND .change_seq < unsettled
+                    {tombstone_filter}
+                    ORDER BY .change_seq
+                    LIMIT <int64>$limit
+                ))
+            )""",
+            since=since,
+            settle=timedelta(seconds=settings.SYNC_SETTLE_SECONDS),
+            limit=limit + 1,
+            **params,
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"{e}")
-    item = Item.parse_raw(result)
-    return item
+    data = json.loads(result)
+    # Both lists hold the oldest changes of their kind, so the oldest
+    # changes overall are the head of their merge
+    changes = sorted(
+        [(item["change_seq"], item) for item in data["items"]]
+        + [(tombstone["change_seq"], tombstone) for tombstone in data["tombstones"]],
+        key=lambda change: change[0],
+    )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    items = [Item.parse_obj(change) for _, change in changes if "id" in change]
+    deleted = [UUID(change["item_id"]) for _, change in changes if "item_id" in change]
+    last_seq = changes[-1][0] if changes else since
+    return items, deleted, last_seq, has_more
+
+
+async def prune_tombstones(con: AsyncIOConnection, *, older_than: timedelta) -> int:
+    result = await con.query_one(
+        """SELECT count((
+            DELETE ItemTombstone
+            FILTER .deleted_at < datetime_current() - <duration>$older_than
+        ))""",
+        older_than=older_than,
+    )
+    return result
+
+
+async def count_by_owner(con: AsyncIOConnection) -> Dict[UUID, int]:
+    result = await con.query_json(
+        """SELECT User {
+            id,
+            num := count(.<owner[IS Item])
+        }
+        FILTER EXISTS .<owner[IS Item]"""
+    )
+    return {UUID(owner["id"]): owner["num"] for owner in json.loads(result)}
@@ -1,10 +1,12 @@
-from typing import Any, Dict, Optional
+import json
+from typing import Any, Dict, List, Optional
 from uuid import UUID
 
-from edgedb import AsyncIOConnection, NoDataError
+from edgedb import AsyncIOConnection, ConstraintViolationError, NoDataError
 from fastapi import HTTPException
+from pydantic import parse_obj_as
 
-from app import utils
+from app import audit, cache, db, email_index, shards, signatures, stats, utils
 from app.schemas import (
     PaginatedUsers,
     User,
@@ -14,8 +16,10 @@ from app.schemas import (
     user_ordering_fields,
 )
 from app.security import get_password_hash, verify_password
+from app.singleflight import coalesce
 
 
+@coalesce
 async def get(con: AsyncIOConnection, *, id: UUID) -> Optional[User]:
     try:
         result = await con.query_one_json(
@@ -42,6 +46,31 @@ async def get(con: AsyncIOConnection, *, id: UUID) -> Optional[User]:
     return user
 
 
+async def get_many(con: AsyncIOConnection, *, ids: List[UUID]) -> List[User]:
+    try:
+        result = await con.query_json(
+            """SELECT User {
+                id,
+                email,
+                full_name,
+                is_superuser,
+                is_active,
+                num_items,
+                items: {
+                    id,
+                    title
+                }
+            }
+            FILTER .id IN array_unpack(<array<uuid>>$ids)""",
+            ids=ids,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    users = parse_obj_as(List[User], json.loads(result))
+    return users
+
+
+@coalesce
 async def get_by_email(con: AsyncIOConnection, *, email: str) -> Optional[User]:
     try:
         result = await con.query_one_json(
@@ -68,6 +97,29 @@ async def get_by_email(con: AsyncIOConnection, *, email: str) -> Optional[User]:
     return user
 
 
+async def query_exists_by_email(con: AsyncIOConnection, *, email: str) -> bool:
+    try:
+        return await con.query_one(
+            """SELECT EXISTS (
+                SELECT User
+                FILTER .email = <str>$email
+            )""",
+            email=email,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+
+
+async def exists_by_email(con: AsyncIOConnection, *, email: str) -> bool:
+    known = email_index.index.lookup(email)
+    if known is not None:
+        return known
+    result = await query_exists_by_email(con, email=email)
+    email_index.index.remember(email, result)
+    return result
+
+
+@coalesce
 async def get_multi(
     con: AsyncIOConnection,
     *,
@@ -75,6 +127,7 @@ async def get_multi(
     ordering: str = None,
     offset: int = 0,
     limit: int = 100,
+    replica: bool = False,
 ) -> PaginatedUsers:
     filter_expr = None
     order_expr = None
@@ -83,34 +136,50 @@ async def get_multi(
     if ordering:
         order_expr = utils.get_order(ordering, user_ordering_fields)
     try:
-        result = await con.query_one_json(
-            f"""WITH users := (
-                SELECT User
-                FILTER {filter_expr or 'true'}
-            )
-            SELECT <json>(
-                count:= count(users),
-                data := array_agg((
-                    SELECT users {{
-                        id,
-                        email,
-                        full_name,
-                        is_superuser,
-                        is_active,
-                        num_items,
-                        items: {{
-                            id,
-                            title
-                        }}
-                    }}
-                    ORDER BY {order_expr or '{}'}
-                    OFFSET <int64>$offset
-                    LIMIT <int64>$limit
-                ))
-            )""",
-            **filtering,
-            offset=offset,
-            limit=limit,
+        result = await cache.get_or_fetch(
+            "users",
+            {
+                "filtering": filtering,
+                "ordering": ordering,
+                "offset": offset,
+                "limit": limit,
+            },
+            None,
+            lambda: signatures.timed(
+                "users",
+                filtering,
+                ordering,
+                con.query_one_json(
+                    f"""WITH users := (
+                        SELECT User
+                        FILTER {filter_expr or 'true'}
+                    )
+                    SELECT <json>(
+                        count:= count(users),
+                        data := array_agg((
+                            SELECT users {{
+                                id,
+                                email,
+                                full_name,
+                                is_superuser,
+                                is_active,
+                                num_items,
+                                items: {{
+                                    id,
+                                    title
+                                }}
+                            }}
+                            ORDER BY {order_expr or '{}'}
+                            OFFSET <int64>$offset
+                            LIMIT <int64>$limit
+                        ))
+                    )""",
+                    **filtering,
+                    offset=offset,
+                    limit=limit,
+                ),
+            ),
+            replica=replica,
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"{e}")
@@ -144,12 +213,69 @@ async def create(con: AsyncIOConnection, *, obj_in: UserCreate) -> User:
             }}""",
             **data_in,
         )
+    except ConstraintViolationError:
+        # The email index of this worker hadn't seen the user yet
+        raise HTTPException(
+            status_code=400,
+            detail="The user with this username already exists in the system",
+        )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"{e}")
-    user = User.parse_raw(result)
+    data = json.loads(result)
+    user = User.parse_obj(data)
+    stats.rollup.user_added(bool(user.is_active), bool(user.is_superuser))
+    email_index.index.added([user.email])
+    audit.record(audit.CREATE, "users", user.id, data_in)
+    await cache.invalidate(user.id)
     return user
 
 
+async def create_bulk(
+    con: AsyncIOConnection, *, data_in: List[Dict[str, Any]]
+) -> List[UUID]:
+    """
+    Insert users from dicts that already contain a hashed_password, in one
+    statement. Returns the new ids in input order.
+    """
+    try:
+        result = await con.query(
+            """FOR user IN {json_array_unpack(<json>$data)}
+            UNION (
+                INSERT User {
+                    email := <str>user['email'],
+                    hashed_password := <str>user['hashed_password'],
+                    full_name := <str>json_get(user, 'full_name'),
+                    is_active := <bool>json_get(user, 'is_active') ?? true,
+                    is_superuser := <bool>json_get(user, 'is_superuser') ?? false
+                }
+            ) {
+                id,
+                email,
+                is_active,
+                is_superuser
+            }""",
+            data=json.dumps(data_in),
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    for user in result:
+        stats.rollup.user_added(user.is_active, user.is_superuser)
+        audit.record(
+            audit.CREATE,
+            "users",
+            user.id,
+            {
+                "email": user.email,
+                "is_active": user.is_active,
+                "is_superuser": user.is_superuser,
+            },
+        )
+    email_index.index.added([user.email for user in result])
+    await cache.invalidate(*(user.id for user in result))
+    ids = {user.email: user.id for user in result}
+    return [ids[user["email"]] for user in data_in]
+
+
 async def update(
     con: AsyncIOConnection, *, id: UUID, obj_in: UserUpdate
 ) -> Optional[User]:
@@ -167,7 +293,8 @@ async def update(
                 UPDATE User
                 FILTER .id = <uuid>$id
                 SET {{
-                    {shape_expr}
+                    {shape_expr},
+                    change_seq := sequence_next(INTROSPECT UserSeq)
                 }}
                 ) {{
                     id,
@@ -179,14 +306,36 @@ async def update(
                     items: {{
                         id,
                         title
-                    }}
+                    }},
+                    was_active := (
+                        SELECT DETACHED User FILTER .id = <uuid>$id
+                    ).is_active,
+                    was_superuser := (
+                        SELECT DETACHED User FILTER .id = <uuid>$id
+                    ).is_superuser,
+                    was_email := (
+                        SELECT DETACHED User FILTER .id = <uuid>$id
+                    ).email
                 }}""",
             id=id,
             **data_in,
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"{e}")
-    user = User.parse_raw(result)
+    # The DETACHED subqueries see the user as it was before the update
+    data = json.loads(result)
+    user = User.parse_obj(data)
+    stats.rollup.user_changed(
+        bool(data["was_active"]),
+        bool(data["is_active"]),
+        bool(data["was_superuser"]),
+        bool(data["is_superuser"]),
+    )
+    email_index.index.changed(data["was_email"], data["email"])
+    audit.record(audit.UPDATE, "users", id, data_in)
+    await cache.invalidate(id)
+    if shards.enabled() and ("email" in data_in or "full_name" in data_in):
+        await shards.owner_changed(user)
     return user
 
 
@@ -213,6 +362,14 @@ async def remove(con: AsyncIOConnection, *, id: UUID) -> User:
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"{e}")
     user = User.parse_raw(result)
+    stats.rollup.user_removed(
+        bool(user.is_active), bool(user.is_superuser), user.num_items
+    )
+    email_index.index.removed(user.email)
+    audit.record(audit.DELETE, "users", id)
+    await cache.invalidate(id)
+    if shards.enabled():
+        await shards.owner_removed(id)
     return user
 
 
@@ -237,3 +394,57 @@ async def authenticate(
     if not verify_password(password, user.hashed_password):
         return None
     return user
+
+
+async def add_num_items(con: AsyncIOConnection, *, id: UUID, delta: int) -> None:
+    """
+    Keep the counter of an owner whose items are on another shard in step.
+    """
+    try:
+        await db.retry_conflicts(
+            lambda: con.query(
+                """UPDATE User
+                FILTER .id = <uuid>$id
+                SET {
+                    num_items := .num_items + <int64>$delta
+                }""",
+                id=id,
+                delta=delta,
+            )
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+
+
+async def set_num_items(con: AsyncIOConnection, *, counts: Dict[UUID, int]) -> int:
+    """
+    Set every user's counter to their number of items in counts, for items
+    counted across shards. Returns the number of users repaired.
+    """
+    result = await con.query_one(
+        """WITH counts := <json>$counts
+        SELECT count((
+            UPDATE User
+            FILTER .num_items != (<int64>json_get(counts, <str>.id) ?? 0)
+            SET {
+                num_items := <int64>json_get(counts, <str>.id) ?? 0
+            }
+        ))""",
+        counts=json.dumps({str(id): num for id, num in counts.items()}),
+    )
+    return result
+
+
+async def reconcile_num_items(con: AsyncIOConnection) -> int:
+    result = await con.query_one(
+        """SELECT count((
+            UPDATE User
+            FILTER .num_items != count(.<owner[IS Item])
+            SET {
+                num_items := count(.<owner[IS Item])
+            }
+        ))"""
+    )
+    return result
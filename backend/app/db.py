@@ -1,28 +1,206 @@
-from typing import AsyncGenerator
+import asyncio
+import logging
+import math
+import random
+from collections import OrderedDict
+from typing import AsyncGenerator, Awaitable, Callable, Optional, Set, TypeVar
 
-from edgedb import AsyncIOConnection, AsyncIOPool, create_async_pool
+from edgedb import (
+    AsyncIOConnection,
+    AsyncIOPool,
+    TransactionDeadlockError,
+    TransactionSerializationError,
+    create_async_pool,
+)
+from fastapi import HTTPException, Request
 
+from . import admission, tracing
 from .config import settings
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
 pool: AsyncIOPool
+ro_pool: Optional[AsyncIOPool] = None
+# Until this loop time, reads go to the primary instead of the replica
+ro_unhealthy_until = 0.0
+# Sessions that wrote recently read from the primary until their expiry
+sticky_sessions: "OrderedDict[str, float]" = OrderedDict()
+# Ids of the replica connections handed out by get_ro_con
+replica_cons: Set[int] = set()
+health_check_task: Optional["asyncio.Task[None]"] = None
 
 
 async def create_pool() -> None:
-    global pool
+    global pool, ro_pool, health_check_task
     pool = await create_async_pool(
         host=settings.EDGEDB_HOST,
+        port=settings.EDGEDB_PORT,
         database=settings.EDGEDB_DB,
         user=settings.EDGEDB_USER,
+        min_size=min(settings.EDGEDB_POOL_MIN_SIZE, settings.EDGEDB_POOL_MAX_SIZE),
+        max_size=settings.EDGEDB_POOL_MAX_SIZE,
+        connection_class=tracing.TracedConnection,
     )
+    if settings.EDGEDB_RO_HOST:
+        # Connect lazily so a replica that is down doesn't block startup
+        ro_pool = await create_async_pool(
+            host=settings.EDGEDB_RO_HOST,
+            port=settings.EDGEDB_RO_PORT,
+            database=settings.EDGEDB_RO_DB or settings.EDGEDB_DB,
+            user=settings.EDGEDB_USER,
+            min_size=0,
+            max_size=settings.EDGEDB_POOL_MAX_SIZE,
+            connection_class=tracing.TracedConnection,
+        )
+        health_check_task = asyncio.ensure_future(run_health_check())
 
 
 async def close_pool() -> None:
+    if health_check_task:
+        health_check_task.cancel()
+    if ro_pool:
+        await ro_pool.aclose()
     await pool.aclose()
 
 
-async def get_con() -> AsyncGenerator[AsyncIOConnection, None]:
+def mark_ro_unhealthy() -> None:
+    global ro_unhealthy_until
+    loop = asyncio.get_event_loop()
+    ro_unhealthy_until = loop.time() + settings.EDGEDB_RO_RETRY_SECONDS
+
+
+async def run_health_check() -> None:
+    global ro_unhealthy_until
+    assert ro_pool
+    while True:
+        try:
+            con = await asyncio.wait_for(
+                ro_pool.acquire(), settings.EDGEDB_RO_ACQUIRE_TIMEOUT
+            )
+            try:
+                await asyncio.wait_for(
+                    con.query_one("SELECT 1"), settings.EDGEDB_RO_ACQUIRE_TIMEOUT
+                )
+            finally:
+                await ro_pool.release(con)
+            ro_unhealthy_until = 0.0
+        except Exception as e:
+            logger.error(f"Read replica health check failed: {e}")
+            mark_ro_unhealthy()
+        await asyncio.sleep(settings.EDGEDB_RO_HEALTH_CHECK_SECONDS)
+
+
+def session_key(request: Request) -> Optional[str]:
+    return request.headers.get("authorization")
+
+
+def stick_to_primary(request: Request) -> None:
+    key = session_key(request)
+    if not key:
+        return
+    loop = asyncio.get_event_loop()
+    sticky_sessions.pop(key, None)
+    sticky_sessions[key] = loop.time() + settings.EDGEDB_RO_STICKY_SECONDS
+    while len(sticky_sessions) > settings.EDGEDB_RO_MAX_STICKY_SESSIONS:
+        sticky_sessions.popitem(last=False)
+
+
+def is_sticky(request: Request) -> bool:
+    key = session_key(request)
+    if not key or key not in sticky_sessions:
+        return False
+    if sticky_sessions[key] < asyncio.get_event_loop().time():
+        del sticky_sessions[key]
+        return False
+    return True
+
+
+async def acquire(from_pool: AsyncIOPool) -> AsyncIOConnection:
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    try:
+        # Don't wait for a connection past the request's deadline
+        with tracing.span("edgedb.acquire", pool="primary"):
+            con = await asyncio.wait_for(from_pool.acquire(), admission.remaining())
+    except asyncio.TimeoutError:
+        admission.record_acquire_wait(loop.time() - started)
+        raise HTTPException(
+            status_code=503,
+            detail="Database busy, retry later",
+            headers={"Retry-After": str(math.ceil(settings.ADMISSION_RETRY_AFTER))},
+        )
+    admission.record_acquire_wait(loop.time() - started)
+    return con
+
+
+async def retry_conflicts(write: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run write, again after a random backoff while it conflicts with a
+    concurrent transaction. write must be a single statement or a whole
+    transaction. Answers 503 when it still conflicts after
+    EDGEDB_CONFLICT_RETRIES retries.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await write()
+        except (TransactionSerializationError, TransactionDeadlockError) as e:
+            if attempt >= settings.EDGEDB_CONFLICT_RETRIES:
+                logger.error(f"Write still conflicting after {attempt} retries: {e}")
+                raise HTTPException(
+                    status_code=503,
+                    detail="Conflicting concurrent writes, retry later",
+                    headers={
+                        "Retry-After": str(math.ceil(settings.ADMISSION_RETRY_AFTER))
+                    },
+                )
+        # Exponential backoff with full jitter, like initial_data.check_db
+        backoff = settings.EDGEDB_CONFLICT_BACKOFF_SECONDS * 2 ** attempt
+        attempt += 1
+        await asyncio.sleep(random.uniform(0, backoff))
+
+
+async def get_con(request: Request) -> AsyncGenerator[AsyncIOConnection, None]:
+    if request.method not in ("GET", "HEAD", "OPTIONS"):
+        # Read your writes: keep this session's reads on the primary for a while
+        stick_to_primary(request)
+    con = await acquire(pool)
     try:
-        con = await pool.acquire()
         yield con
     finally:
         await pool.release(con)
+
+
+async def get_ro_con(request: Request) -> AsyncGenerator[AsyncIOConnection, None]:
+    """
+    Connection for read-only routes, from the read replica when one is
+    configured and healthy and the session didn't write recently.
+    """
+    loop = asyncio.get_event_loop()
+    from_pool = pool
+    con = None
+    if ro_pool and ro_unhealthy_until < loop.time() and not is_sticky(request):
+        try:
+            with tracing.span("edgedb.acquire", pool="replica"):
+                con = await asyncio.wait_for(
+                    ro_pool.acquire(), settings.EDGEDB_RO_ACQUIRE_TIMEOUT
+                )
+            from_pool = ro_pool
+        except Exception as e:
+            logger.error(f"Read replica unavailable, using primary: {e}")
+            mark_ro_unhealthy()
+    if con is None:
+        con = await acquire(pool)
+    if from_pool is ro_pool:
+        replica_cons.add(id(con))
+    try:
+        yield con
+    finally:
+        replica_cons.discard(id(con))
+        await from_pool.release(con)
+
+
+def is_replica(con: AsyncIOConnection) -> bool:
+    return id(con) in replica_cons
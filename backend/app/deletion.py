@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Optional
+
+from fastapi import HTTPException
+
+from . import crud, db, shards
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+task: Optional["asyncio.Task[None]"] = None
+
+
+async def process_next() -> bool:
+    """
+    Process one queued deletion job and return whether there was one.
+    """
+    con = await db.acquire(db.pool)
+    try:
+        job = await crud.deletion.claim(
+            con, stale_seconds=settings.DELETION_STALE_SECONDS
+        )
+    finally:
+        await db.pool.release(con)
+    if not job:
+        return False
+    logger.info(f"Deleting user {job.user_id} ({job.items_total} items)")
+    shard = shards.shard_for(job.user_id)
+    try:
+        while True:
+            # One short transaction per batch, releasing the connection
+            # in between so regular requests can keep using the pool
+            con = await db.acquire(db.pool)
+            try:
+                async with shards.connection(shard, con) as shard_con:
+                    deleted = await crud.item.remove_by_owner(
+                        shard_con,
+                        owner_id=job.user_id,
+                        limit=settings.DELETION_BATCH_SIZE,
+                    )
+                if deleted:
+                    await crud.deletion.add_progress(con, id=job.id, deleted=deleted)
+                else:
+                    # Otherwise a job whose user is already gone would be
+                    # claimed again and fail to find it
+                    async with con.transaction():
+                        await crud.user.remove(con, id=job.user_id)
+                        await crud.deletion.finish(con, id=job.id)
+            finally:
+                await db.pool.release(con)
+            if not deleted:
+                break
+            await asyncio.sleep(settings.DELETION_BATCH_PAUSE_SECONDS)
+    except Exception as e:
+        error = e.detail if isinstance(e, HTTPException) else repr(e)
+        logger.error(f"Deleting user {job.user_id} failed: {error}")
+        con = await db.acquire(db.pool)
+        try:
+            await crud.deletion.finish(con, id=job.id, error=error)
+        finally:
+            await db.pool.release(con)
+    else:
+        logger.info(f"Deleted user {job.user_id}")
+    return True
+
+
+async def run_worker() -> None:
+    while True:
+        try:
+            if await process_next():
+                continue
+        except Exception as e:
+            logger.error(f"Deletion worker failed: {e}")
+        await asyncio.sleep(settings.DELETION_POLL_SECONDS)
+
+
+async def start() -> None:
+    global task
+    task = asyncio.ensure_future(run_worker())
+
+
+async def stop() -> None:
+    if task:
+        task.cancel()
@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+from . import db
+from .config import settings
+from .schemas import EmailIndexStats
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, false_positive_rate: float) -> None:
+        self.capacity = capacity
+        self.size = math.ceil(
+            -capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value: str) -> Iterable[int]:
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value: str) -> None:
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(value)
+        )
+
+    def false_positive_rate(self) -> float:
+        # Expected rate at the current fill
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class EmailIndex:
+    """
+    Answers whether a user with an email may exist. Emails missing from the
+    bloom filter don't exist; the DB answer for the others is cached in a
+    small LRU for EMAIL_INDEX_CACHE_TTL_SECONDS.
+
+    Removed emails stay in the filter until the next rebuild, which only
+    costs a query. Every user write bumps User.change_seq, and every
+    EMAIL_INDEX_REFRESH_SECONDS the emails of the users written since the
+    refresh before the last are added, so a write still committing during
+    one refresh is read by the next.
+    """
+
+    def __init__(self) -> None:
+        self.bloom: Optional[BloomFilter] = None
+        self.cache: "OrderedDict[str, Tuple[float, bool]]" = OrderedDict()
+        # Highest User.change_seq read by the last and the previous refresh
+        self.seq = 0
+        self.settled_seq = 0
+        # Emails added while a rebuild is reading the current ones
+        self.pending: Optional[List[str]] = None
+        self.definite_misses = 0
+        self.cache_hits = 0
+        self.queries = 0
+        self.false_positives = 0
+
+    def lookup(self, email: str) -> Optional[bool]:
+        """
+        Whether the email exists if that's known without a query.
+        """
+        if self.bloom is None:
+            return None
+        if email not in self.bloom:
+            self.definite_misses += 1
+            return False
+        entry = self.cache.get(email)
+        if entry and entry[0] > time.monotonic():
+            self.cache_hits += 1
+            self.cache.move_to_end(email)
+            return entry[1]
+        self.queries += 1
+        return None
+
+    def remember(self, email: str, exists: bool) -> None:
+        if self.bloom is None:
+            return
+        if not exists:
+            self.false_positives += 1
+        self.cache.pop(email, None)
+        self.cache[email] = (
+            time.monotonic() + settings.EMAIL_INDEX_CACHE_TTL_SECONDS,
+            exists,
+        )
+        while len(self.cache) > settings.EMAIL_INDEX_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def added(self, emails: List[str]) -> None:
+        for email in emails:
+            self.cache.pop(email, None)
+            # Refreshes read emails again, don't count them twice
+            if self.bloom is not None and email not in self.bloom:
+                self.bloom.add(email)
+        if self.pending is not None:
+            self.pending.extend(emails)
+
+    def changed(self, old_email: str, new_email: str) -> None:
+        if old_email != new_email:
+            self.cache.pop(old_email, None)
+            self.added([new_email])
+
+    def refreshed(self, emails: List[str], seq: int) -> None:
+        self.added(emails)
+        self.settled_seq, self.seq = self.seq, seq
+
+    def removed(self, email: str) -> None:
+        self.cache.pop(email, None)
+
+    def needs_rebuild(self) -> bool:
+        return self.bloom is not None and self.bloom.count > self.bloom.capacity
+
+    def load(self, emails: List[str], seq: int) -> None:
+        capacity = max(settings.EMAIL_INDEX_MIN_CAPACITY, len(emails) * 2)
+        bloom = BloomFilter(capacity, settings.EMAIL_INDEX_FALSE_POSITIVE_RATE)
+        for email in emails + (self.pending or []):
+            bloom.add(email)
+        self.bloom = bloom
+        # Writes still committing while the emails were read are below seq,
+        # the next refresh reads from the last refresh's (all of them after
+        # the first build)
+        self.settled_seq, self.seq = min(self.seq, seq), seq
+        self.cache.clear()
+
+    def stats(self) -> EmailIndexStats:
+        # Lookups of missing emails: the definite misses and the false hits
+        misses = self.definite_misses + self.false_positives
+        return EmailIndexStats(
+            capacity=self.bloom.capacity if self.bloom else 0,
+            emails=self.bloom.count if self.bloom else 0,
+            size_bytes=len(self.bloom.bits) if self.bloom else 0,
+            hashes=self.bloom.hashes if self.bloom else 0,
+            target_false_positive_rate=settings.EMAIL_INDEX_FALSE_POSITIVE_RATE,
+            expected_false_positive_rate=(
+                self.bloom.false_positive_rate() if self.bloom else 0
+            ),
+            observed_false_positive_rate=(
+                self.false_positives / misses if misses else 0
+            ),
+            definite_misses=self.definite_misses,
+            cache_hits=self.cache_hits,
+            queries=self.queries,
+        )
+
+
+index = EmailIndex()
+task: Optional["asyncio.Task[None]"] = None
+
+
+async def rebuild() -> None:
+    started = time.perf_counter()
+    index.pending = []
+    con = await db.acquire(db.pool)
+    try:
+        # Read first: users written meanwhile are in the emails read next
+        seq = await con.query_one("SELECT max(User.change_seq) ?? 0")
+        emails = await con.query("SELECT User.email")
+    finally:
+        await db.pool.release(con)
+    index.load(list(emails), seq)
+    index.pending = None
+    logger.info(
+        f"Built email index of {len(emails)} users in "
+        f"{(time.perf_counter() - started) * 1000:.0f} ms"
+    )
+
+
+async def refresh() -> None:
+    con = await db.acquire(db.pool)
+    try:
+        seq, emails = await con.query_one(
+            """SELECT (
+                max(User.change_seq) ?? 0,
+                array_agg((
+                    SELECT User FILTER .change_seq > <int64>$since
+                ).email)
+            )""",
+            since=index.settled_seq,
+        )
+    finally:
+        await db.pool.release(con)
+    index.refreshed(list(emails), seq)
+
+
+async def run_refresh() -> None:
+    rebuilt = time.monotonic()
+    while True:
+        await asyncio.sleep(settings.EMAIL_INDEX_REFRESH_SECONDS)
+        try:
+            if (
+                index.needs_rebuild()
+                or time.monotonic() - rebuilt > settings.EMAIL_INDEX_REBUILD_SECONDS
+            ):
+                await rebuild()
+                rebuilt = time.monotonic()
+            else:
+                await refresh()
+        except Exception as e:
+            logger.error(f"Email index refresh failed: {e}")
+
+
+async def start() -> None:
+    global task
+    if not settings.EMAIL_INDEX_ENABLED:
+        return
+    try:
+        await rebuild()
+    except Exception as e:
+        # Without the filter every lookup queries the database
+        logger.error(f"Building the email index failed: {e}")
+    task = asyncio.ensure_future(run_refresh())
+
+
+async def stop() -> None:
+    if task:
+        task.cancel()
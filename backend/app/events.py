@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, List, NamedTuple, Optional, Set
+from uuid import UUID
+
+from .config import settings
+from .schemas import Item
+
+CREATED = "created"
+UPDATED = "updated"
+DELETED = "deleted"
+# Sent when a subscriber can't be resumed and must refetch everything
+RESET = "reset"
+
+
+class Event(NamedTuple):
+    seq: int
+    type: str
+    owner_id: Optional[UUID]
+    data: str
+
+    def encode(self, epoch: str) -> bytes:
+        lines = [f"id: {epoch}-{self.seq}", f"event: {self.type}", f"data: {self.data}"]
+        return ("\n".join(lines) + "\n\n").encode()
+
+
+class Subscriber:
+    """
+    Bounded queue of events for one client, dropping the oldest ones when
+    the client can't keep up. The client is then sent a reset before the
+    events left.
+    """
+
+    def __init__(self, owner_id: Optional[UUID], maxsize: int) -> None:
+        self.owner_id = owner_id
+        self.queue: Deque[Event] = deque(maxlen=maxsize)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def accepts(self, event: Event) -> bool:
+        return self.owner_id is None or event.owner_id in (None, self.owner_id)
+
+    def put(self, event: Event) -> None:
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(event)
+        self.ready.set()
+
+    async def get(self, timeout: float) -> List[Event]:
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        events = list(self.queue)
+        self.queue.clear()
+        self.ready.clear()
+        if self.dropped:
+            # Resuming from the reset picks up with the events sent after it
+            events.insert(0, Event(events[0].seq - 1, RESET, None, "{}"))
+            self.dropped = 0
+        return events
+
+
+class Hub:
+    """
+    In-process broadcast of item changes. Keeps the last events so clients
+    can resume from the id of the last event they received.
+    """
+
+    def __init__(self, history_size: int, queue_size: int) -> None:
+        # Event ids restart with the process, the epoch tells them apart
+        self.epoch = f"{int(time.time() * 1000):x}"
+        self.seq = 0
+        self.history: Deque[Event] = deque(maxlen=history_size)
+        self.queue_size = queue_size
+        self.subscribers: Set[Subscriber] = set()
+
+    def publish(self, type: str, item: Item) -> None:
+        self.seq += 1
+        event = Event(self.seq, type, item.owner.id, item.json())
+        self.history.append(event)
+        for subscriber in self.subscribers:
+            if subscriber.accepts(event):
+                subscriber.put(event)
+
+    def subscribe(
+        self, owner_id: Optional[UUID], last_event_id: Optional[str] = None
+    ) -> Subscriber:
+        subscriber = Subscriber(owner_id, self.queue_size)
+        if last_event_id:
+            epoch, _, seq = last_event_id.partition("-")
+            oldest = self.history[0].seq if self.history else self.seq + 1
+            if epoch != self.epoch or not seq.isdigit() or int(seq) + 1 < oldest:
+                subscriber.put(Event(self.seq, RESET, None, "{}"))
+            else:
+                for event in self.history:
+                    if event.seq > int(seq) and subscriber.accepts(event):
+                        subscriber.put(event)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.discard(subscriber)
+
+
+hub = Hub(settings.EVENTS_HISTORY_SIZE, settings.EVENTS_QUEUE_SIZE)
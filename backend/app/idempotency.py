@@ -0,0 +1,317 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import admission
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+methods = ("POST", "PUT", "PATCH", "DELETE")
+
+
+class BaseStore:
+    async def begin(self, key: str, value: str, ttl: float) -> Optional[str]:
+        """
+        Return the record stored at key, or store value there for ttl seconds
+        and return None if there is none.
+        """
+        raise NotImplementedError
+
+    async def complete(self, key: str, value: str, ttl: float) -> None:
+        raise NotImplementedError
+
+    async def abort(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryStore(BaseStore):
+    def __init__(self, max_keys: int) -> None:
+        self.max_keys = max_keys
+        self.records: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    async def begin(self, key: str, value: str, ttl: float) -> Optional[str]:
+        now = time.monotonic()
+        record = self.records.get(key)
+        if record and record[0] > now:
+            return record[1]
+        await self.complete(key, value, ttl)
+        return None
+
+    async def complete(self, key: str, value: str, ttl: float) -> None:
+        self.records.pop(key, None)
+        self.records[key] = (time.monotonic() + ttl, value)
+        while len(self.records) > self.max_keys:
+            self.records.popitem(last=False)
+
+    async def abort(self, key: str) -> None:
+        self.records.pop(key, None)
+
+
+BEGIN_SCRIPT = """
+local record = redis.call("GET", KEYS[1])
+if record then
+    return record
+end
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+return false
+"""
+
+COMPLETE_SCRIPT = """
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+"""
+
+ABORT_SCRIPT = """
+redis.call("DEL", KEYS[1])
+"""
+
+
+class RedisStore(BaseStore):
+    """
+    Store shared by several workers. Like ratelimit.RedisStore, the client
+    only needs an aioredis-style `eval(script, keys, args)` coroutine.
+    """
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+
+    async def begin(self, key: str, value: str, ttl: float) -> Optional[str]:
+        record = await self.client.eval(
+            BEGIN_SCRIPT, keys=[f"idempotency:{key}"], args=[value, int(ttl * 1000)]
+        )
+        if isinstance(record, bytes):
+            record = record.decode()
+        return record or None
+
+    async def complete(self, key: str, value: str, ttl: float) -> None:
+        await self.client.eval(
+            COMPLETE_SCRIPT, keys=[f"idempotency:{key}"], args=[value, int(ttl * 1000)]
+        )
+
+    async def abort(self, key: str) -> None:
+        await self.client.eval(ABORT_SCRIPT, keys=[f"idempotency:{key}"], args=[])
+
+
+store: BaseStore = MemoryStore(settings.IDEMPOTENCY_MAX_KEYS)
+# Requests of this worker in progress, for duplicates to wait on
+in_flight: Dict[str, "asyncio.Future[None]"] = {}
+redis_client: Any = None
+
+
+def set_store(new_store: BaseStore) -> None:
+    global store
+    store = new_store
+
+
+async def start() -> None:
+    global redis_client
+    if not settings.IDEMPOTENCY_ENABLED:
+        return
+    if settings.IDEMPOTENCY_REDIS_URL:
+        import aioredis
+
+        redis_client = await aioredis.create_redis_pool(settings.IDEMPOTENCY_REDIS_URL)
+        set_store(RedisStore(redis_client))
+    elif isinstance(store, MemoryStore) and settings.WEB_CONCURRENCY > 1:
+        logger.warning(
+            "Idempotency keys are per worker, set IDEMPOTENCY_REDIS_URL to share "
+            "them"
+        )
+
+
+async def stop() -> None:
+    global redis_client
+    if redis_client:
+        redis_client.close()
+        await redis_client.wait_closed()
+        redis_client = None
+
+
+def get_store_key(scope: Scope, headers: Headers, idempotency_key: str) -> str:
+    # Same principal, same route and same content negotiation
+    principal = headers.get("authorization") or (
+        scope["client"][0] if scope.get("client") else "unknown"
+    )
+    parts = [
+        principal,
+        scope["method"],
+        scope["path"],
+        headers.get("accept", ""),
+        headers.get("accept-encoding", ""),
+        idempotency_key,
+    ]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def is_stored(status: int) -> bool:
+    # Server errors and throttling are worth retrying for real
+    return status < 500 and status not in (408, 429)
+
+
+def replay(record: Dict[str, Any]) -> List[Message]:
+    headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in record["headers"]]
+    headers.append((b"idempotent-replayed", b"true"))
+    return [
+        {"type": "http.response.start", "status": record["status"], "headers": headers},
+        {"type": "http.response.body", "body": base64.b64decode(record["body"])},
+    ]
+
+
+def replay_body(chunks: List[bytes], receive: Receive) -> Receive:
+    """
+    Receive the chunks already read from receive again, then the rest.
+    """
+    pending = list(chunks)
+
+    async def receive_body() -> Message:
+        if pending:
+            return {"type": "http.request", "body": pending.pop(0), "more_body": True}
+        return await receive()
+
+    return receive_body
+
+
+class IdempotencyMiddleware:
+    """
+    Runs a mutation with an Idempotency-Key header once per principal and
+    key: retries get the stored response, and duplicates arriving while it
+    runs wait for it. Reusing a key for a different body answers 422.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope["type"] != "http"
+            or not settings.IDEMPOTENCY_ENABLED
+            or scope["method"] not in methods
+            or admission.is_streaming(scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        idempotency_key = headers.get("idempotency-key")
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+        if len(idempotency_key) > 255:
+            response = JSONResponse(
+                {"detail": "Idempotency-Key too long"}, status_code=400
+            )
+            await response(scope, receive, send)
+            return
+
+        body_chunks: List[bytes] = []
+        body_size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            body_chunks.append(message.get("body", b""))
+            body_size += len(body_chunks[-1])
+            more_body = message.get("more_body", False)
+            if more_body and body_size > settings.IDEMPOTENCY_MAX_REQUEST_SIZE:
+                # Too large to buffer, run it without idempotency
+                await self.app(scope, replay_body(body_chunks, receive), send)
+                return
+        body = b"".join(body_chunks)
+        fingerprint = hashlib.sha256(body).hexdigest()
+        key = get_store_key(scope, headers, idempotency_key)
+        marker = json.dumps({"fingerprint": fingerprint, "in_flight": True})
+
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            stored = await store.begin(key, marker, settings.IDEMPOTENCY_LOCK_SECONDS)
+            if stored is None:
+                break
+            record = json.loads(stored)
+            if record["fingerprint"] != fingerprint:
+                response = JSONResponse(
+                    {"detail": "Idempotency-Key reused for a different request"},
+                    status_code=422,
+                )
+                await response(scope, receive, send)
+                return
+            if not record.get("in_flight"):
+                for message in replay(record):
+                    await send(message)
+                return
+            if time.monotonic() > deadline:
+                response = JSONResponse(
+                    {"detail": "A request with this Idempotency-Key is in progress"},
+                    status_code=409,
+                    headers={"Retry-After": "1"},
+                )
+                await response(scope, receive, send)
+                return
+            if key in in_flight:
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(in_flight[key]), deadline - time.monotonic()
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # The original runs in another worker
+                await asyncio.sleep(settings.IDEMPOTENCY_POLL_SECONDS)
+
+        body_sent = False
+
+        async def receive_body() -> Message:
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        status = 0
+        response_headers: List[Tuple[str, str]] = []
+        chunks: List[bytes] = []
+        size = 0
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_headers.extend(
+                    (k.decode("latin-1"), v.decode("latin-1"))
+                    for k, v in message.get("headers", [])
+                )
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if size <= settings.IDEMPOTENCY_MAX_RESPONSE_SIZE:
+                    chunks.append(chunk)
+            await send(message)
+
+        done = in_flight[key] = asyncio.get_event_loop().create_future()
+        try:
+            await self.app(scope, receive_body, send_wrapper)
+        except BaseException:
+            await store.abort(key)
+            raise
+        else:
+            if is_stored(status) and size <= settings.IDEMPOTENCY_MAX_RESPONSE_SIZE:
+                record = {
+                    "fingerprint": fingerprint,
+                    "status": status,
+                    "headers": response_headers,
+                    "body": base64.b64encode(b"".join(chunks)).decode(),
+                }
+                await store.complete(
+                    key, json.dumps(record), settings.IDEMPOTENCY_TTL_SECONDS
+                )
+            else:
+                await store.abort(key)
+        finally:
+            del in_flight[key]
+            done.set_result(None)
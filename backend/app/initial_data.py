@@ -1,25 +1,33 @@
 import asyncio
+import hashlib
 import logging
+import random
 from pathlib import Path
 from typing import Optional
 
-from edgedb import AsyncIOConnection, async_connect
+from edgedb import AsyncIOConnection, InvalidReferenceError, NoDataError, async_connect
 
-from app import crud, schemas
+from app import audit, crud, schemas, shards
 from app.config import settings
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-max_tries = 60 * 5  # 5 minutes
-wait_seconds = 1
+max_wait_seconds = 60 * 5  # 5 minutes
+min_backoff_seconds = 0.05
+max_backoff_seconds = 5
 
 
 async def check_db() -> Optional[AsyncIOConnection]:
-    for attempt in range(max_tries):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + max_wait_seconds
+    attempt = 0
+    while True:
+        attempt += 1
         try:
             con = await async_connect(
                 host=settings.EDGEDB_HOST,
+                port=settings.EDGEDB_PORT,
                 database=settings.EDGEDB_DB,
                 user=settings.EDGEDB_USER,
             )
@@ -27,26 +35,66 @@ async def check_db() -> Optional[AsyncIOConnection]:
             await con.execute("SELECT 1")
             return con
         except Exception as e:
-            if attempt < max_tries - 1:
-                logger.error(
-                    f"""{e}
-Attempt {attempt + 1}/{max_tries} to connect to database, waiting {wait_seconds}s."""
-                )
-                await asyncio.sleep(wait_seconds)
-            else:
+            # Exponential backoff with full jitter
+            backoff = min(max_backoff_seconds, min_backoff_seconds * 2 ** attempt)
+            wait_seconds = random.uniform(min_backoff_seconds, backoff)
+            if loop.time() + wait_seconds >= deadline:
                 raise e
-    return None
+            logger.error(
+                f"""{e}
+Attempt {attempt} to connect to database, waiting {wait_seconds:.2f}s."""
+            )
+            await asyncio.sleep(wait_seconds)
 
 
-async def init_db(con: AsyncIOConnection) -> None:
+async def get_applied_fingerprint(con: AsyncIOConnection) -> Optional[str]:
+    try:
+        return await con.query_one(
+            """SELECT Migration.fingerprint
+            ORDER BY Migration.applied_at DESC
+            LIMIT 1"""
+        )
+    except (NoDataError, InvalidReferenceError):
+        # Nothing migrated yet, or a schema from before fingerprinting
+        return None
+
+
+async def migrate(con: AsyncIOConnection) -> bool:
     with open(Path("./dbschema/database.esdl")) as f:
         schema = f.read()
+    fingerprint = hashlib.sha256(schema.encode()).hexdigest()
+    if await get_applied_fingerprint(con) == fingerprint:
+        return False
     async with con.transaction():
         await con.execute(f"""START MIGRATION TO {{ {schema} }}""")
         await con.execute("""POPULATE MIGRATION""")
         await con.execute("""COMMIT MIGRATION""")
-    user = await crud.user.get_by_email(con, email=settings.FIRST_SUPERUSER)
-    if not user:
+        await con.query(
+            """INSERT Migration {
+                fingerprint := <str>$fingerprint
+            }
+            UNLESS CONFLICT ON .fingerprint
+            ELSE (
+                # Migrated back to an earlier schema, which is now the newest
+                UPDATE Migration SET {
+                    applied_at := datetime_current()
+                }
+            )""",
+            fingerprint=fingerprint,
+        )
+    return True
+
+
+async def init_db(con: AsyncIOConnection) -> None:
+    if await migrate(con):
+        logger.info("Schema migrated")
+        if shards.enabled():
+            logger.info("Items are sharded, run app.reconcile to check counters")
+        else:
+            await crud.user.reconcile_num_items(con)
+    else:
+        logger.info("Schema unchanged, skipping migration")
+    if not await crud.user.exists_by_email(con, email=settings.FIRST_SUPERUSER):
         user_in = schemas.UserCreate(
             email=settings.FIRST_SUPERUSER,
             password=settings.FIRST_SUPERUSER_PASSWORD,
@@ -55,13 +103,29 @@ async def init_db(con: AsyncIOConnection) -> None:
         await crud.user.create(con, obj_in=user_in)
 
 
+async def init_shards() -> None:
+    for shard in range(1, shards.count()):
+        con = await async_connect(**shards.connect_args(shard))
+        try:
+            if await migrate(con):
+                logger.info(f"Schema migrated on shard {shards.names()[shard]}")
+        finally:
+            await con.aclose()
+
+
 async def main() -> None:
     logger.info("Initializing service")
     con = await check_db()
     logger.info("Service finished initializing")
     if con:
         logger.info("Creating initial data")
-        await init_db(con)
+        try:
+            await init_db(con)
+        finally:
+            # Nothing flushes in the background here
+            await audit.stop(con)
+            await con.aclose()
+        await init_shards()
         logger.info("Initial data created")
 
 
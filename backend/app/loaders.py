@@ -0,0 +1,125 @@
+import asyncio
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    TypeVar,
+)
+from uuid import UUID
+
+from edgedb import AsyncIOConnection
+
+from . import crud, db, schemas, shards
+from .config import settings
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class Loader(Generic[K, V]):
+    """
+    Collects the keys requested within a short window and resolves them
+    with a single batch query on a connection of its own.
+    """
+
+    def __init__(
+        self,
+        batch_load: Callable[[AsyncIOConnection, List[K]], Awaitable[Dict[K, V]]],
+        window: float,
+        max_batch_size: int,
+    ) -> None:
+        self.batch_load = batch_load
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending: Dict[K, List["asyncio.Future[Optional[V]]"]] = {}
+        self.handle: Optional[asyncio.Handle] = None
+        self.loads = 0
+        self.batches = 0
+
+    async def load(
+        self, key: K, con: Optional[AsyncIOConnection] = None
+    ) -> Optional[V]:
+        """
+        Load key with the next batch, or right away on con when the caller
+        holds a connection, so it never waits for a second one.
+        """
+        if con is not None:
+            self.loads += 1
+            self.batches += 1
+            results = await self.batch_load(con, [key])
+            return results.get(key)
+        loop = asyncio.get_event_loop()
+        future: "asyncio.Future[Optional[V]]" = loop.create_future()
+        self.pending.setdefault(key, []).append(future)
+        self.loads += 1
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.handle is None:
+            self.handle = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        pending, self.pending = self.pending, {}
+        if pending:
+            self.batches += 1
+            asyncio.ensure_future(self.dispatch(pending))
+
+    async def dispatch(
+        self, pending: Dict[K, List["asyncio.Future[Optional[V]]"]]
+    ) -> None:
+        try:
+            con = await db.acquire(db.pool)
+            try:
+                results = await self.batch_load(con, list(pending))
+            finally:
+                await db.pool.release(con)
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for key, futures in pending.items():
+            for future in futures:
+                # Callers that were cancelled meanwhile have a done future
+                if not future.done():
+                    future.set_result(results.get(key))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"loads": self.loads, "batches": self.batches}
+
+
+async def load_users(
+    con: AsyncIOConnection, ids: List[UUID]
+) -> Dict[UUID, schemas.User]:
+    users = await crud.user.get_many(con, ids=ids)
+    return {user.id: user for user in users}
+
+
+async def load_items(
+    con: AsyncIOConnection, ids: List[UUID]
+) -> Dict[UUID, schemas.Item]:
+    if shards.enabled():
+        # The owners, and so the shards, of the items aren't known yet
+        pages = await shards.scatter(
+            con, lambda shard_con, _: crud.item.get_many(shard_con, ids=ids)
+        )
+        return {item.id: item for page in pages for item in page}
+    items = await crud.item.get_many(con, ids=ids)
+    return {item.id: item for item in items}
+
+
+user: Loader[UUID, schemas.User] = Loader(
+    load_users, settings.LOADER_WINDOW_SECONDS, settings.LOADER_MAX_BATCH_SIZE
+)
+item: Loader[UUID, schemas.Item] = Loader(
+    load_items, settings.LOADER_WINDOW_SECONDS, settings.LOADER_MAX_BATCH_SIZE
+)
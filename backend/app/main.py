@@ -1,18 +1,75 @@
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
+from app import (
+    audit,
+    cache,
+    deletion,
+    email_index,
+    idempotency,
+    ratelimit,
+    shards,
+    signatures,
+    stats,
+    sync,
+    tracing,
+    warmup,
+)
+from app.admission import AdmissionMiddleware
 from app.api import api_router
 from app.config import settings
 from app.db import close_pool, create_pool
+from app.idempotency import IdempotencyMiddleware
+from app.responses import (
+    CompressionMiddleware,
+    ContentNegotiationMiddleware,
+    NegotiatedResponse,
+)
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
-    on_startup=[create_pool],
-    on_shutdown=[close_pool],
+    default_response_class=NegotiatedResponse,
+    on_startup=[
+        cache.start,
+        ratelimit.start,
+        idempotency.start,
+        create_pool,
+        shards.create_pools,
+        email_index.start,
+        warmup.start,
+        stats.start,
+        deletion.start,
+        sync.start,
+        tracing.start,
+        signatures.start,
+        audit.start,
+    ],
+    on_shutdown=[
+        warmup.stop,
+        signatures.stop,
+        tracing.stop,
+        sync.stop,
+        deletion.stop,
+        stats.stop,
+        email_index.stop,
+        audit.stop,
+        cache.stop,
+        ratelimit.stop,
+        idempotency.stop,
+        shards.close_pools,
+        close_pool,
+    ],
 )
 
-# Set all CORS enabled origins
+app.add_middleware(ContentNegotiationMiddleware)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(IdempotencyMiddleware)
+app.add_middleware(tracing.TracingMiddleware)
+
+# Set all CORS enabled origins, added last to stay outermost so the responses
+# of the other middlewares get the headers too
 if settings.BACKEND_CORS_ORIGINS:
     app.add_middleware(
         CORSMiddleware,
@@ -20,6 +77,7 @@ if settings.BACKEND_CORS_ORIGINS:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["Retry-After"],
     )
 
 app.include_router(api_router, prefix=settings.API_V1_STR)
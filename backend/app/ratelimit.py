@@ -0,0 +1,153 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Any, List, Tuple
+
+from fastapi import Depends, HTTPException, Request
+from fastapi.security import OAuth2PasswordRequestForm
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BaseStore:
+    async def take(self, keys: List[str], rate: float, burst: int) -> float:
+        """
+        Take one token from each of the buckets at keys and return 0 if all of
+        them had one, otherwise take none and return the number of seconds
+        until they will.
+        """
+        raise NotImplementedError
+
+
+class MemoryStore(BaseStore):
+    def __init__(self, max_keys: int) -> None:
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, keys: List[str], rate: float, burst: int) -> float:
+        now = time.monotonic()
+        buckets = []
+        for key in keys:
+            tokens, last = self.buckets.pop(key, (float(burst), now))
+            buckets.append(min(float(burst), tokens + (now - last) * rate))
+        wait = max((1 - tokens) / rate for tokens in buckets)
+        for key, tokens in zip(keys, buckets):
+            self.buckets[key] = (tokens - 1 if wait <= 0 else tokens, now)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return max(wait, 0.0)
+
+
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local buckets = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call("HMGET", key, "tokens", "last")
+    local tokens = tonumber(bucket[1]) or burst
+    local last = tonumber(bucket[2]) or now
+    buckets[i] = math.min(burst, tokens + (now - last) * rate)
+    wait = math.max(wait, (1 - buckets[i]) / rate)
+end
+for i, key in ipairs(KEYS) do
+    local tokens = buckets[i]
+    if wait <= 0 then
+        tokens = tokens - 1
+    end
+    redis.call("HSET", key, "tokens", tokens, "last", now)
+    redis.call("EXPIRE", key, math.ceil(burst / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class RedisStore(BaseStore):
+    """
+    Shared bucket store for several workers. The client only needs an
+    aioredis-style `eval(script, keys, args)` coroutine.
+    """
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+
+    async def take(self, keys: List[str], rate: float, burst: int) -> float:
+        wait = await self.client.eval(
+            TAKE_SCRIPT,
+            keys=[f"ratelimit:{key}" for key in keys],
+            args=[rate, burst, time.time()],
+        )
+        return float(wait)
+
+
+store: BaseStore = MemoryStore(settings.RATE_LIMIT_MAX_KEYS)
+redis_client: Any = None
+
+
+def set_store(new_store: BaseStore) -> None:
+    global store
+    store = new_store
+
+
+async def start() -> None:
+    global redis_client
+    if not settings.RATE_LIMIT_ENABLED:
+        return
+    if settings.RATE_LIMIT_REDIS_URL:
+        import aioredis
+
+        redis_client = await aioredis.create_redis_pool(settings.RATE_LIMIT_REDIS_URL)
+        set_store(RedisStore(redis_client))
+    elif isinstance(store, MemoryStore) and settings.WEB_CONCURRENCY > 1:
+        logger.warning(
+            "Rate limits are per worker, set RATE_LIMIT_REDIS_URL to share them"
+        )
+
+
+async def stop() -> None:
+    global redis_client
+    if redis_client:
+        redis_client.close()
+        await redis_client.wait_closed()
+        redis_client = None
+
+
+async def check(*keys: str, per_minute: int, burst: int) -> None:
+    if not settings.RATE_LIMIT_ENABLED:
+        return
+    # A request denied by one bucket doesn't use up the others
+    wait = await store.take(list(keys), per_minute / 60, burst)
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+async def limit_login(
+    request: Request, form_data: OAuth2PasswordRequestForm = Depends()
+) -> None:
+    await check(
+        f"login:ip:{client_ip(request)}",
+        f"login:user:{form_data.username.lower()}",
+        per_minute=settings.LOGIN_RATE_PER_MINUTE,
+        burst=settings.LOGIN_RATE_BURST,
+    )
+
+
+async def limit_password_recovery(request: Request, email: str) -> None:
+    await check(
+        f"recovery:ip:{client_ip(request)}",
+        f"recovery:user:{email.lower()}",
+        per_minute=settings.PASSWORD_RECOVERY_RATE_PER_MINUTE,
+        burst=settings.PASSWORD_RECOVERY_RATE_BURST,
+    )
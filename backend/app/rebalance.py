@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List
+from uuid import UUID
+
+from edgedb import AsyncIOConnection, async_connect
+
+from app import shards
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Move the items of owners whose shard changed with "
+        "EDGEDB_SHARDS to their new shard."
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=500)
+    return parser.parse_args()
+
+
+async def misplaced(con: AsyncIOConnection, shard: int) -> List[Dict[str, Any]]:
+    result = await con.query_json(
+        """SELECT User {
+            id,
+            email,
+            full_name,
+            num_items := count(.<owner[IS Item])
+        }
+        FILTER EXISTS .<owner[IS Item]"""
+    )
+    return [
+        owner
+        for owner in json.loads(result)
+        if shards.shard_for(UUID(owner["id"])) != shard
+    ]
+
+
+async def copy_owner(con: AsyncIOConnection, owner: Dict[str, Any]) -> None:
+    exists = await con.query_one(
+        "SELECT EXISTS (SELECT User FILTER .id = <uuid>$id)", id=owner["id"]
+    )
+    if not exists:
+        await con.query(
+            """INSERT User {
+                id := <uuid>$id,
+                email := <str>$email,
+                full_name := <OPTIONAL str>$full_name,
+                hashed_password := '',
+                is_active := false
+            }""",
+            id=owner["id"],
+            email=owner["email"],
+            full_name=owner["full_name"],
+        )
+
+
+async def move_batch(
+    source: AsyncIOConnection,
+    source_shard: int,
+    target: AsyncIOConnection,
+    target_shard: int,
+    owner_id: str,
+    batch_size: int,
+) -> int:
+    """
+    Copy a batch of the owner's items and their attachments to the target,
+    then delete them from the source. Items already copied by an interrupted
+    run are skipped. Returns the number moved.
+    """
+    result = await source.query_json(
+        """SELECT Item {
+            id,
+            title,
+            description,
+            attachments := .<item[IS Attachment] {
+                id,
+                filename,
+                content_type,
+                size,
+                sha256,
+                created_at
+            }
+        }
+        FILTER .owner.id = <uuid>$owner_id
+        ORDER BY .id
+        LIMIT <int64>$limit""",
+        owner_id=owner_id,
+        limit=batch_size,
+    )
+    items = json.loads(result)
+    if not items:
+        return 0
+    ids = [item["id"] for item in items]
+    copied = {
+        str(id)
+        for id in await target.query(
+            "SELECT (SELECT Item FILTER .id IN array_unpack(<array<uuid>>$ids)).id",
+            ids=ids,
+        )
+    }
+    new_items = [item for item in items if item["id"] not in copied]
+    attachments = [
+        dict(attachment, item_id=item["id"])
+        for item in new_items
+        for attachment in item["attachments"]
+    ]
+    async with target.transaction():
+        await target.query(
+            """WITH owner := (SELECT User FILTER .id = <uuid>$owner_id)
+            FOR item IN {json_array_unpack(<json>$items)}
+            UNION (
+                INSERT Item {
+                    id := <uuid>item['id'],
+                    title := <str>item['title'],
+                    description := <str>json_get(item, 'description'),
+                    owner := owner
+                }
+            )""",
+            owner_id=owner_id,
+            items=json.dumps(new_items),
+        )
+        await target.query(
+            """FOR attachment IN {json_array_unpack(<json>$attachments)}
+            UNION (
+                INSERT Attachment {
+                    id := <uuid>attachment['id'],
+                    item := (
+                        SELECT Item FILTER .id = <uuid>attachment['item_id']
+                    ),
+                    filename := <str>attachment['filename'],
+                    content_type := <str>attachment['content_type'],
+                    size := <int64>attachment['size'],
+                    sha256 := <str>attachment['sha256'],
+                    created_at := <datetime>attachment['created_at']
+                }
+            )""",
+            attachments=json.dumps(attachments),
+        )
+        if target_shard:
+            # Only the copies count their shard's items, the primary counts all
+            await target.query(
+                """UPDATE User
+                FILTER .id = <uuid>$owner_id
+                SET {
+                    num_items := .num_items + <int64>$moved
+                }""",
+                owner_id=owner_id,
+                moved=len(new_items),
+            )
+    async with source.transaction():
+        # Attachments go with their item
+        await source.query(
+            "DELETE Item FILTER .id IN array_unpack(<array<uuid>>$ids)", ids=ids
+        )
+        if source_shard:
+            await source.query(
+                """UPDATE User
+                FILTER .id = <uuid>$owner_id
+                SET {
+                    num_items := .num_items - <int64>$moved
+                }""",
+                owner_id=owner_id,
+                moved=len(items),
+            )
+    return len(items)
+
+
+async def rebalance(
+    cons: List[AsyncIOConnection], dry_run: bool, batch_size: int
+) -> None:
+    for source_shard, source in enumerate(cons):
+        for owner in await misplaced(source, source_shard):
+            target_shard = shards.shard_for(UUID(owner["id"]))
+            names = shards.names()
+            logger.info(
+                f"Moving {owner['num_items']} items of {owner['email']} from "
+                f"{names[source_shard]} to {names[target_shard]}"
+            )
+            if dry_run:
+                continue
+            target = cons[target_shard]
+            if target_shard:
+                await copy_owner(target, owner)
+            while await move_batch(
+                source, source_shard, target, target_shard, owner["id"], batch_size
+            ):
+                pass
+            if source_shard:
+                await source.query("DELETE User FILTER .id = <uuid>$id", id=owner["id"])
+
+
+async def main() -> None:
+    args = parse_args()
+    if not shards.enabled():
+        logger.info("EDGEDB_SHARDS is empty, nothing to rebalance")
+        return
+    cons = [
+        await async_connect(**shards.connect_args(shard))
+        for shard in range(shards.count())
+    ]
+    try:
+        await rebalance(cons, args.dry_run, args.batch_size)
+    finally:
+        for con in cons:
+            await con.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+
+from edgedb import AsyncIOConnection, async_connect
+
+from app import audit, crud, shards
+from app.initial_data import check_db
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def reconcile(con: AsyncIOConnection) -> None:
+    repaired = await crud.user.reconcile_num_items(con)
+    logger.info(f"Repaired num_items counter for {repaired} users")
+
+
+async def reconcile_shards(con: AsyncIOConnection) -> None:
+    """
+    Count each owner's items on the shards, repairing the shards' copies of
+    the owners along the way, and set the counters on the primary.
+    """
+    counts = await crud.item.count_by_owner(con)
+    for shard in range(1, shards.count()):
+        shard_con = await async_connect(**shards.connect_args(shard))
+        try:
+            await crud.user.reconcile_num_items(shard_con)
+            for owner_id, num in (await crud.item.count_by_owner(shard_con)).items():
+                counts[owner_id] = counts.get(owner_id, 0) + num
+        finally:
+            await shard_con.aclose()
+    repaired = await crud.user.set_num_items(con, counts=counts)
+    logger.info(f"Repaired num_items counter for {repaired} users")
+
+
+async def main() -> None:
+    logger.info("Initializing service")
+    con = await check_db()
+    logger.info("Service finished initializing")
+    if con:
+        logger.info("Reconciling counters")
+        try:
+            if shards.enabled():
+                await reconcile_shards(con)
+            else:
+                await reconcile(con)
+        finally:
+            await audit.stop(con)
+            await con.aclose()
+        logger.info("Counters reconciled")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,229 @@
+import gzip
+import re
+from contextvars import ContextVar
+from typing import Any, List, Optional, Tuple
+from urllib.parse import quote
+
+import msgpack
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import tracing
+from .config import settings
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+SINGLE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+accepts_msgpack: ContextVar[bool] = ContextVar("accepts_msgpack", default=False)
+
+
+class NegotiatedResponse(JSONResponse):
+    """
+    JSON by default, MessagePack when the request's Accept header asks for it.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if accepts_msgpack.get():
+            self.media_type = MSGPACK_MEDIA_TYPE
+            with tracing.span("response.render", format="msgpack"):
+                return msgpack.packb(content, use_bin_type=True)
+        with tracing.span("response.render", format="json"):
+            return super().render(content)
+
+
+class ContentNegotiationMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = Headers(scope=scope).get("accept", "")
+        token = accepts_msgpack.set(MSGPACK_MEDIA_TYPE in accept)
+
+        async def send_with_vary(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).add_vary_header("Accept")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_vary)
+        finally:
+            accepts_msgpack.reset(token)
+
+
+def get_encodings(accept_encoding: str) -> List[str]:
+    encodings = []
+    for part in accept_encoding.split(","):
+        encoding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.append(encoding.strip().lower())
+    return encodings
+
+
+class CompressionMiddleware:
+    """
+    Compress whole response bodies of at least COMPRESSION_MINIMUM_SIZE bytes
+    with brotli or gzip. Streamed responses are passed through untouched.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encodings = get_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        if brotli and "br" in encodings:
+            encoding = "br"
+        elif "gzip" in encodings:
+            encoding = "gzip"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        start: Message = {}
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if not start:
+                await send(message)
+                return
+            headers = MutableHeaders(scope=start)
+            body = message.get("body", b"")
+            if (
+                message.get("more_body", False)
+                or len(body) < settings.COMPRESSION_MINIMUM_SIZE
+                or "content-encoding" in headers
+            ):
+                await send(start)
+                start = {}
+                await send(message)
+                return
+            if encoding == "br":
+                body = brotli.compress(body, quality=settings.BROTLI_QUALITY)
+            else:
+                body = gzip.compress(body, compresslevel=settings.GZIP_LEVEL)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            start = {}
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    First and last byte of a single byte range, None when the header isn't
+    one, and (0, -1) when it can't be satisfied.
+    """
+    match = SINGLE_RANGE.match(range_header.replace(" ", ""))
+    if not match or match.groups() == ("", ""):
+        # Several ranges may be answered with the whole file
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last bytes of the file
+        if not int(last):
+            return 0, -1
+        return max(0, size - int(last)), size - 1
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        return 0, -1
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+class RangedFileResponse(Response):
+    """
+    Streams a file from disk in ATTACHMENTS_CHUNK_SIZE chunks, answering a
+    single-range Range request with 206 and If-None-Match with 304.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        request_headers: Headers,
+        *,
+        size: int,
+        etag: str,
+        media_type: str,
+        filename: str,
+        background: Optional[BackgroundTask] = None,
+    ) -> None:
+        self.path = path
+        self.media_type = media_type
+        self.background = background
+        self.status_code = 200
+        self.offset, self.length = 0, size
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "content-disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+            # The media type is the uploader's, browsers mustn't guess another
+            "x-content-type-options": "nosniff",
+        }
+        if_none_match = request_headers.get("if-none-match")
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if if_none_match and etag in (t.strip() for t in if_none_match.split(",")):
+            self.status_code, self.length = 304, 0
+        elif range_header and (not if_range or if_range == etag):
+            byte_range = parse_range(range_header, size)
+            if byte_range == (0, -1):
+                self.status_code, self.length = 416, 0
+                headers["content-range"] = f"bytes */{size}"
+            elif byte_range:
+                first, last = byte_range
+                self.status_code = 206
+                self.offset, self.length = first, last - first + 1
+                headers["content-range"] = f"bytes {first}-{last}/{size}"
+        headers["content-length"] = str(self.length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if self.length and scope["method"] != "HEAD":
+            f = await run_in_threadpool(open, self.path, "rb")
+            try:
+                await run_in_threadpool(f.seek, self.offset)
+                remaining = self.length
+                while remaining:
+                    chunk = await run_in_threadpool(
+                        f.read, min(remaining, settings.ATTACHMENTS_CHUNK_SIZE)
+                    )
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+            finally:
+                await run_in_threadpool(f.close)
+        # Ending with an empty chunk keeps CompressionMiddleware out of it
+        await send({"type": "http.response.body", "body": b""})
+        if self.background is not None:
+            await self.background()
@@ -1,8 +1,11 @@
+from datetime import datetime
 from typing import Any, Dict, List, Optional
 from uuid import UUID
 
 from pydantic import BaseModel, EmailStr
 
+from . import tracing
+
 user_ordering_fields = [
     "id",
     "full_name",
@@ -21,13 +24,25 @@ item_ordering_fields = [
 ]
 
 
-class CommonQueryParams(BaseModel):
+class TracedModel(BaseModel):
+    @classmethod
+    def parse_obj(cls, obj: Any) -> Any:
+        with tracing.span("pydantic.parse_obj", model=cls.__name__):
+            return super().parse_obj(obj)
+
+    @classmethod
+    def parse_raw(cls, b: Any, **kwargs: Any) -> Any:
+        with tracing.span("pydantic.parse_raw", model=cls.__name__):
+            return super().parse_raw(b, **kwargs)
+
+
+class CommonQueryParams(TracedModel):
     ordering: Optional[str] = None
     offset: int = 0
     limit: int = 100
 
 
-class FilterQueryParams(BaseModel):
+class FilterQueryParams(TracedModel):
     def dict_exclude_unset(self) -> Dict[str, Any]:
         return {k: v for k, v in self.dict().items() if v is not None}
 
@@ -48,31 +63,31 @@ class ItemFilterParams(FilterQueryParams):
     owner__email: Optional[EmailStr] = None
 
 
-class Msg(BaseModel):
+class Msg(TracedModel):
     msg: str
 
 
-class Token(BaseModel):
+class Token(TracedModel):
     access_token: str
     token_type: str
 
 
-class TokenPayload(BaseModel):
+class TokenPayload(TracedModel):
     sub: UUID
 
 
-class NestedUser(BaseModel):
+class NestedUser(TracedModel):
     id: UUID
     email: EmailStr
     full_name: Optional[str] = None
 
 
-class NestedItem(BaseModel):
+class NestedItem(TracedModel):
     id: UUID
     title: str
 
 
-class UserBase(BaseModel):
+class UserBase(TracedModel):
     email: Optional[EmailStr] = None
     is_active: Optional[bool] = True
     is_superuser: Optional[bool] = False
@@ -100,7 +115,7 @@ class UserInDB(UserBase):
     hashed_password: str
 
 
-class ItemBase(BaseModel):
+class ItemBase(TracedModel):
     title: Optional[str] = None
     description: Optional[str] = None
 
@@ -118,11 +133,61 @@ class Item(ItemBase):
     owner: NestedUser
 
 
-class PaginatedUsers(BaseModel):
+class Attachment(TracedModel):
+    id: UUID
+    item_id: UUID
+    filename: str
+    content_type: str
+    size: int
+    sha256: str
+    created_at: datetime
+
+
+class ItemChanges(TracedModel):
+    items: List[Item]
+    deleted: List[UUID]
+    cursor: str
+    has_more: bool
+    reset: bool = False
+
+
+class PaginatedUsers(TracedModel):
     count: int
     data: List[User]
 
 
-class PaginatedItems(BaseModel):
+class PaginatedItems(TracedModel):
     count: int
     data: List[Item]
+
+
+class Stats(TracedModel):
+    users: int
+    active_users: int
+    superusers: int
+    items: int
+    item_distribution: Dict[str, int]
+
+
+class EmailIndexStats(TracedModel):
+    capacity: int
+    emails: int
+    size_bytes: int
+    hashes: int
+    target_false_positive_rate: float
+    expected_false_positive_rate: float
+    observed_false_positive_rate: float
+    definite_misses: int
+    cache_hits: int
+    queries: int
+
+
+class DeletionJob(TracedModel):
+    id: UUID
+    user_id: UUID
+    status: str
+    items_total: int
+    items_deleted: int
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import bisect
+import itertools
+import logging
+import random
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+from edgedb import AsyncIOPool, create_async_pool
+
+from app import crud
+from app.config import settings
+from app.security import get_password_hash
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Seed the database with fake data.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=100_000)
+    parser.add_argument(
+        "--zipf",
+        type=float,
+        default=1.1,
+        help="Zipf exponent of item ownership, 0 means uniform",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--password", default="changethis")
+    parser.add_argument(
+        "--run",
+        default=f"{int(time.time()):x}",
+        help="Added to the emails so that seeding again doesn't clash",
+    )
+    return parser.parse_args()
+
+
+def batched(
+    rows: Iterator[Dict[str, Any]], size: int
+) -> Iterator[List[Dict[str, Any]]]:
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def partitioned(
+    rows: Iterator[Dict[str, Any]], size: int, workers: int
+) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+    """
+    Batches of rows for each worker, all of an owner's items going to the
+    same worker so that concurrent batches never update the same counter.
+    """
+    pending: List[List[Dict[str, Any]]] = [[] for _ in range(workers)]
+    for row in rows:
+        worker = hash(row["owner_id"]) % workers
+        pending[worker].append(row)
+        if len(pending[worker]) == size:
+            yield worker, pending[worker]
+            pending[worker] = []
+    for worker, batch in enumerate(pending):
+        if batch:
+            yield worker, batch
+
+
+def generate_users(
+    rng: random.Random, count: int, hashed_password: str, run: str
+) -> Iterator[Dict[str, Any]]:
+    for i in range(count):
+        yield {
+            "email": f"user{i}.{run}@example.com",
+            "full_name": f"User {i} {rng.getrandbits(32):08x}",
+            "hashed_password": hashed_password,
+            "is_active": rng.random() > 0.05,
+        }
+
+
+def generate_items(
+    rng: random.Random, count: int, owner_ids: List[Any], zipf: float
+) -> Iterator[Dict[str, Any]]:
+    # Owner rank r gets weight 1 / r ** zipf, so a few users own most items
+    cum_weights = list(
+        itertools.accumulate(
+            1 / (rank ** zipf) for rank in range(1, len(owner_ids) + 1)
+        )
+    )
+    total = cum_weights[-1]
+    for i in range(count):
+        owner = bisect.bisect(cum_weights, rng.random() * total)
+        yield {
+            "title": f"Item {i}",
+            "description": f"{rng.getrandbits(64):016x}",
+            "owner_id": owner_ids[min(owner, len(owner_ids) - 1)],
+        }
+
+
+async def insert(
+    pool: AsyncIOPool,
+    batches: Iterator[Tuple[int, List[Dict[str, Any]]]],
+    concurrency: int,
+    create_bulk: Any,
+) -> List[Any]:
+    """
+    Run create_bulk on each (worker, batch) with concurrency workers, and
+    return the results in batch order. The first failure stops them all.
+    """
+    results: List[Any] = []
+    queues: List["asyncio.Queue[Any]"] = [
+        asyncio.Queue(maxsize=2) for _ in range(concurrency)
+    ]
+
+    async def worker(queue: "asyncio.Queue[Any]") -> None:
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            index, batch = job
+            con = await pool.acquire()
+            try:
+                results[index] = await create_bulk(con, data_in=batch)
+            finally:
+                await pool.release(con)
+
+    async def produce() -> None:
+        # Batches are generated sequentially so the data only depends on the
+        # seed
+        for index, (worker_index, batch) in enumerate(batches):
+            results.append(None)
+            await queues[worker_index].put((index, batch))
+        for queue in queues:
+            await queue.put(None)
+
+    tasks = [asyncio.ensure_future(worker(queue)) for queue in queues]
+    tasks.append(asyncio.ensure_future(produce()))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return results
+
+
+def report(name: str, rows: int, started: float) -> None:
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Inserted {rows} {name} in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s)"
+    )
+
+
+async def main() -> None:
+    args = parse_args()
+    # Fake data isn't worth an audit trail, and buffering an event per row
+    # would overflow AUDIT_BUFFER_SIZE
+    settings.AUDIT_ENABLED = False
+    rng = random.Random(args.seed)
+    # Hash once, bcrypt per row would dominate the run time
+    hashed_password = get_password_hash(args.password)
+    pool = await create_async_pool(
+        host=settings.EDGEDB_HOST,
+        port=settings.EDGEDB_PORT,
+        database=settings.EDGEDB_DB,
+        user=settings.EDGEDB_USER,
+        min_size=args.concurrency,
+        max_size=args.concurrency,
+    )
+    try:
+        started = time.perf_counter()
+        users = generate_users(rng, args.users, hashed_password, args.run)
+        results = await insert(
+            pool,
+            (
+                (index % args.concurrency, batch)
+                for index, batch in enumerate(batched(users, args.batch_size))
+            ),
+            args.concurrency,
+            crud.user.create_bulk,
+        )
+        owner_ids = [id for ids in results for id in ids]
+        report("users", len(owner_ids), started)
+
+        if args.items and owner_ids:
+            started = time.perf_counter()
+            items = generate_items(rng, args.items, owner_ids, args.zipf)
+            results = await insert(
+                pool,
+                partitioned(items, args.batch_size, args.concurrency),
+                args.concurrency,
+                crud.item.create_bulk,
+            )
+            report("items", sum(results), started)
+    finally:
+        await pool.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,47 @@
+import asyncio
+from typing import Any, Dict, Optional
+
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker
+
+from app import initial_data
+from app.config import settings
+
+
+class Worker(UvicornWorker):
+    # "auto" picks uvloop and httptools when they are installed
+    CONFIG_KWARGS = {"loop": "auto", "http": "auto"}
+
+
+class Application(BaseApplication):
+    def __init__(self, options: Optional[Dict[str, Any]] = None) -> None:
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self) -> Any:
+        from app.main import app
+
+        return app
+
+
+def main() -> None:
+    # Migrate once in the master process so workers don't race each other
+    asyncio.run(initial_data.main())
+    options = {
+        "bind": f"{settings.SERVER_HOST}:{settings.SERVER_PORT}",
+        "workers": settings.WEB_CONCURRENCY,
+        "worker_class": "app.serve.Worker",
+        "graceful_timeout": settings.GRACEFUL_TIMEOUT,
+        "timeout": settings.GRACEFUL_TIMEOUT * 2,
+        "keepalive": 5,
+    }
+    Application(options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import asyncio
+import bisect
+import hashlib
+import heapq
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from itertools import chain, islice
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+from uuid import UUID
+
+from edgedb import (
+    AsyncIOConnection,
+    AsyncIOPool,
+    ConstraintViolationError,
+    create_async_pool,
+)
+
+from . import db, tracing
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Pools of the shards after the primary, which is shard 0
+pools: List[AsyncIOPool] = []
+# Owners known to have a copy on their shard, (shard, owner id) in LRU order
+known_owners: "OrderedDict[Tuple[int, UUID], None]" = OrderedDict()
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class Ring:
+    """
+    Consistent hash ring placing each shard at SHARD_VIRTUAL_NODES points, by
+    name so that adding or removing a shard only moves the owners it gains
+    or loses.
+    """
+
+    def __init__(self, names: List[str], virtual_nodes: int) -> None:
+        points = sorted(
+            (hash_key(f"{name}#{node}"), shard)
+            for shard, name in enumerate(names)
+            for node in range(virtual_nodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        position = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.shards[position]
+
+
+def connect_args(shard: int) -> Dict[str, Any]:
+    """
+    Connection arguments of a shard. EDGEDB_SHARDS entries are "database",
+    "host/database" or "host:port/database"; a missing host is the primary's.
+    """
+    args = {
+        "host": settings.EDGEDB_HOST,
+        "port": settings.EDGEDB_PORT,
+        "database": settings.EDGEDB_DB,
+        "user": settings.EDGEDB_USER,
+    }
+    if shard:
+        address, _, args["database"] = settings.EDGEDB_SHARDS[shard - 1].rpartition("/")
+        if address:
+            host, _, port = address.partition(":")
+            args["host"] = host
+            args["port"] = int(port) if port else None
+    return args
+
+
+def names() -> List[str]:
+    return [settings.EDGEDB_DB] + settings.EDGEDB_SHARDS
+
+
+ring = Ring(names(), settings.SHARD_VIRTUAL_NODES)
+
+
+def generation() -> str:
+    """
+    Fingerprint of the shards, which owners are placed by.
+    """
+    return f"{hash_key(' '.join(names())):016x}"
+
+
+def enabled() -> bool:
+    return bool(settings.EDGEDB_SHARDS)
+
+
+def count() -> int:
+    return len(settings.EDGEDB_SHARDS) + 1
+
+
+def shard_for(owner_id: Optional[UUID]) -> int:
+    if not enabled() or owner_id is None:
+        return 0
+    return ring.shard_for(str(owner_id))
+
+
+def get_pool(shard: int) -> AsyncIOPool:
+    return pools[shard - 1] if shard else db.pool
+
+
+async def create_pools() -> None:
+    for shard in range(1, count()):
+        pools.append(
+            await create_async_pool(
+                **connect_args(shard),
+                min_size=min(
+                    settings.EDGEDB_POOL_MIN_SIZE, settings.EDGEDB_POOL_MAX_SIZE
+                ),
+                max_size=settings.EDGEDB_POOL_MAX_SIZE,
+                connection_class=tracing.TracedConnection,
+            )
+        )
+
+
+async def close_pools() -> None:
+    for pool in pools:
+        await pool.aclose()
+    pools.clear()
+
+
+@asynccontextmanager
+async def connection(
+    shard: int, con: AsyncIOConnection
+) -> AsyncIterator[AsyncIOConnection]:
+    """
+    A connection to the shard: con itself for the primary, otherwise one
+    from the shard's pool.
+    """
+    if not shard:
+        yield con
+        return
+    pool = get_pool(shard)
+    shard_con = await db.acquire(pool)
+    try:
+        yield shard_con
+    finally:
+        await pool.release(shard_con)
+
+
+async def scatter(
+    con: AsyncIOConnection, fetch: Callable[[AsyncIOConnection, int], Awaitable[T]]
+) -> List[T]:
+    """
+    Run fetch(shard_con, shard) on every shard at once, the primary on con.
+    """
+
+    async def fetch_shard(shard: int) -> T:
+        async with connection(shard, con) as shard_con:
+            return await fetch(shard_con, shard)
+
+    return list(await asyncio.gather(*(fetch_shard(s) for s in range(count()))))
+
+
+class OrderKey:
+    """
+    Sort key of an object on get_multi ordering fields, e.g. "-owner__email",
+    ordering empty values first ascending and last descending like EdgeDB.
+    """
+
+    __slots__ = ("values", "directions")
+
+    def __init__(self, obj: Any, fields: List[Tuple[List[str], bool]]) -> None:
+        self.values = []
+        for path, _ in fields:
+            value = obj
+            for name in path:
+                value = getattr(value, name, None)
+            self.values.append(value)
+        self.directions = [descending for _, descending in fields]
+
+    def __lt__(self, other: "OrderKey") -> bool:
+        for a, b, descending in zip(self.values, other.values, self.directions):
+            if a == b:
+                continue
+            less = a is None or (b is not None and a < b)
+            return less != descending
+        return False
+
+
+def merge(
+    pages: List[List[T]], ordering: Optional[str], offset: int, limit: int
+) -> List[T]:
+    """
+    Page of the k-way merge of pages each sorted on ordering, kept in shard
+    order when there is none.
+    """
+    merged: Iterable[T] = chain.from_iterable(pages)
+    if ordering:
+        fields = [
+            (field.lstrip("-").split("__"), field.startswith("-"))
+            for field in ordering.split(",")
+        ]
+        merged = heapq.merge(*pages, key=lambda obj: OrderKey(obj, fields))
+    return list(islice(merged, offset, offset + limit))
+
+
+async def copy_exists(con: AsyncIOConnection, owner_id: UUID) -> bool:
+    return await con.query_one(
+        "SELECT EXISTS (SELECT User FILTER .id = <uuid>$id)", id=owner_id
+    )
+
+
+async def insert_copy(con: AsyncIOConnection, owner: Any) -> None:
+    await con.query(
+        """INSERT User {
+            id := <uuid>$id,
+            email := <str>$email,
+            full_name := <OPTIONAL str>$full_name,
+            hashed_password := '',
+            is_active := false
+        }""",
+        id=owner.id,
+        email=owner.email,
+        full_name=owner.full_name,
+    )
+
+
+async def update_copy(con: AsyncIOConnection, owner: Any) -> None:
+    await con.query(
+        """UPDATE User
+        FILTER .id = <uuid>$id
+        SET {
+            email := <str>$email,
+            full_name := <OPTIONAL str>$full_name
+        }""",
+        id=owner.id,
+        email=owner.email,
+        full_name=owner.full_name,
+    )
+
+
+async def free_email(con: AsyncIOConnection, email: str, owner_id: UUID) -> None:
+    """
+    Bring the copy of another owner holding email, which missed a change, in
+    line with its user on the primary, or remove it if the user is gone.
+    """
+    holders = await con.query(
+        """SELECT User { id }
+        FILTER .email = <str>$email AND .id != <uuid>$id""",
+        email=email,
+        id=owner_id,
+    )
+    for holder in holders:
+        primary_con = await db.acquire(db.pool)
+        try:
+            users = await primary_con.query(
+                "SELECT User { id, email, full_name } FILTER .id = <uuid>$id",
+                id=holder.id,
+            )
+        finally:
+            await db.pool.release(primary_con)
+        if not users:
+            await con.query("DELETE User FILTER .id = <uuid>$id", id=holder.id)
+        elif users[0].email != email:
+            await update_copy(con, users[0])
+
+
+async def ensure_owner(con: AsyncIOConnection, shard: int, owner: Any) -> None:
+    """
+    Items link to their owner, so the owner's shard keeps a copy of the user
+    with the same id. It's inactive and has no password, so it can't log in.
+    """
+    if not shard or (shard, owner.id) in known_owners:
+        return
+    if not await copy_exists(con, owner.id):
+        try:
+            await insert_copy(con, owner)
+        except ConstraintViolationError:
+            # Either inserted meanwhile by a concurrent request, or the email
+            # is still held by a stale copy
+            if not await copy_exists(con, owner.id):
+                await free_email(con, owner.email, owner.id)
+                await insert_copy(con, owner)
+    known_owners[(shard, owner.id)] = None
+    while len(known_owners) > settings.SHARD_KNOWN_OWNERS:
+        known_owners.popitem(last=False)
+
+
+async def owner_changed(owner: Any) -> None:
+    shard = shard_for(owner.id)
+    if not shard:
+        return
+    try:
+        pool = get_pool(shard)
+        con = await db.acquire(pool)
+        try:
+            try:
+                await update_copy(con, owner)
+            except ConstraintViolationError:
+                await free_email(con, owner.email, owner.id)
+                await update_copy(con, owner)
+        finally:
+            await pool.release(con)
+    except Exception as e:
+        # The user is updated, the copy is repaired when its email is next
+        # needed by another copy
+        logger.error(f"Updating user {owner.id} on shard {shard} failed: {e}")
+
+
+async def owner_removed(owner_id: UUID) -> None:
+    shard = shard_for(owner_id)
+    if not shard:
+        return
+    known_owners.pop((shard, owner_id), None)
+    try:
+        pool = get_pool(shard)
+        con = await db.acquire(pool)
+        try:
+            await con.query("DELETE User FILTER .id = <uuid>$id", id=owner_id)
+        finally:
+            await pool.release(con)
+    except Exception as e:
+        # A leftover copy without items is harmless
+        logger.error(f"Removing user {owner_id} from shard {shard} failed: {e}")
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# (entity, filter fields, order fields) -> [count, total ms, max ms]
+Signature = Tuple[str, Tuple[str, ...], Tuple[str, ...]]
+
+observed: Dict[Signature, List[Any]] = {}
+task: Optional["asyncio.Task[None]"] = None
+
+
+def get_signature(
+    entity: str, filtering: Dict[str, Any], ordering: Optional[str]
+) -> Signature:
+    """
+    Canonical shape of a get_multi query: the fields it filters on, sorted,
+    and the fields it orders by, in order and with their direction.
+    """
+    order_fields = tuple(ordering.split(",")) if ordering else ()
+    return entity, tuple(sorted(filtering)), order_fields
+
+
+async def timed(
+    entity: str,
+    filtering: Dict[str, Any],
+    ordering: Optional[str],
+    query: Awaitable[str],
+) -> str:
+    if not settings.SIGNATURES_ENABLED:
+        return await query
+    started = time.perf_counter()
+    result = await query
+    elapsed = (time.perf_counter() - started) * 1000
+    # Only the field names, the values may be personal data
+    stats = observed.setdefault(
+        get_signature(entity, filtering, ordering), [0, 0.0, 0.0]
+    )
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+    return result
+
+
+def flush() -> None:
+    global observed
+    if not observed:
+        return
+    lines, observed = observed, {}
+    with open(settings.SIGNATURES_PATH, "a") as f:
+        for (entity, filter_fields, order_fields), stats in lines.items():
+            count, total_ms, max_ms = stats
+            line = {
+                "entity": entity,
+                "filter": filter_fields,
+                "order": order_fields,
+                "count": count,
+                "total_ms": total_ms,
+                "max_ms": max_ms,
+            }
+            f.write(json.dumps(line) + "\n")
+
+
+async def run_flush() -> None:
+    while True:
+        await asyncio.sleep(settings.SIGNATURES_FLUSH_SECONDS)
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Writing query signatures failed: {e}")
+
+
+async def start() -> None:
+    global task
+    if settings.SIGNATURES_ENABLED:
+        task = asyncio.ensure_future(run_flush())
+
+
+async def stop() -> None:
+    if task:
+        task.cancel()
+        flush()
@@ -0,0 +1,81 @@
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+from edgedb import AsyncIOConnection
+
+from .config import settings
+
+T = TypeVar("T")
+
+
+def freeze(value: Any) -> Hashable:
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def source(con: AsyncIOConnection) -> Hashable:
+    """
+    Server and database of con, so reads from the primary, the read replica
+    and each shard are never shared with each other.
+    """
+    return (getattr(con, "_addr", None), con.dbname())
+
+
+class Group:
+    """
+    Runs at most one call per key at a time. Callers that arrive while a call
+    is in flight wait for its result instead of starting their own.
+    """
+
+    def __init__(self) -> None:
+        self.calls: Dict[Hashable, "asyncio.Future[Any]"] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        while key in self.calls:
+            call = self.calls[key]
+            self.hits += 1
+            try:
+                # Shielded so a follower going away doesn't cancel the call
+                return await asyncio.shield(call)
+            except asyncio.CancelledError:
+                if not call.cancelled():
+                    raise
+                # The leader was cancelled, retry and maybe lead ourselves
+        self.misses += 1
+        call = asyncio.ensure_future(fn())
+        self.calls[key] = call
+        try:
+            # Not shielded: the call runs on the leader's connection, so it
+            # must not outlive the leader's request
+            return await call
+        finally:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "in_flight": len(self.calls)}
+
+
+group = Group()
+
+
+def coalesce(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """
+    Coalesce concurrent calls of a CRUD read with the same keyword arguments.
+    Callers share the returned object, so it must be treated as read-only.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(con: AsyncIOConnection, **kwargs: Any) -> T:
+        if not settings.COALESCE_READS:
+            return await fn(con, **kwargs)
+        key = (fn.__module__, fn.__name__, source(con), freeze(kwargs))
+        return await group.do(key, lambda: fn(con, **kwargs))
+
+    return wrapper
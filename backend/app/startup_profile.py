@@ -0,0 +1,85 @@
+import argparse
+import json
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# Imported in a fresh interpreter so nothing is cached by this process
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    "import_ms": elapsed * 1000,
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "email_loaded": "emails" in sys.modules,
+}))
+"""
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Report the import time and memory of a cold worker."
+    )
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--import-budget-ms", type=float, default=1500)
+    parser.add_argument("--rss-budget-mb", type=float, default=100)
+    return parser.parse_args()
+
+
+def parse_importtime(stderr: str) -> List[Tuple[int, int, str]]:
+    """
+    Parse `python -X importtime` lines into (self us, cumulative us, module).
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, timings = line.split(":", 1)
+        self_us, cumulative_us, module = timings.split("|")
+        rows.append((int(self_us), int(cumulative_us), module.rstrip()))
+    return rows
+
+
+def top_level_packages(rows: List[Tuple[int, int, str]]) -> Dict[str, int]:
+    totals: Dict[str, int] = {}
+    for self_us, _, module in rows:
+        package = module.strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + self_us
+    return totals
+
+
+def main() -> None:
+    args = parse_args()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode:
+        sys.stderr.write(proc.stderr)
+        sys.exit(proc.returncode)
+    probe = json.loads(proc.stdout.strip().splitlines()[-1])
+    rows = parse_importtime(proc.stderr)
+
+    print(f"Slowest {args.top} imports (cumulative):")
+    for _, cumulative_us, module in sorted(rows, key=lambda r: -r[1])[: args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {module}")
+    print(f"Slowest {args.top} packages (self):")
+    packages = sorted(top_level_packages(rows).items(), key=lambda p: -p[1])
+    for package, self_us in packages[: args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {package}")
+
+    import_ms = probe["import_ms"]
+    # ru_maxrss is in kilobytes on Linux
+    rss_mb = probe["max_rss_kb"] / 1024
+    print(f"Import app.main: {import_ms:.0f} ms (budget {args.import_budget_ms:.0f})")
+    print(f"Max RSS: {rss_mb:.1f} MB (budget {args.rss_budget_mb:.0f})")
+    print(f"Email stack loaded at startup: {probe['email_loaded']}")
+    if import_ms > args.import_budget_ms or rss_mb > args.rss_budget_mb:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
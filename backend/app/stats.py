@@ -0,0 +1,141 @@
+import asyncio
+import bisect
+import json
+import logging
+from typing import List, Optional
+
+from . import db
+from .config import settings
+from .schemas import Stats
+
+logger = logging.getLogger(__name__)
+
+# Lower bounds of the items-per-owner buckets
+bucket_bounds = [0, 1, 10, 100, 1_000, 10_000, 100_000]
+
+
+def bucket_labels() -> List[str]:
+    labels = []
+    for lo, hi in zip(bucket_bounds, bucket_bounds[1:] + [0]):
+        if not hi:
+            labels.append(f"{lo}+")
+        elif hi - lo == 1:
+            labels.append(f"{lo}")
+        else:
+            labels.append(f"{lo}-{hi - 1}")
+    return labels
+
+
+def bucket(num_items: int) -> int:
+    return bisect.bisect_right(bucket_bounds, num_items) - 1
+
+
+class Rollup:
+    """
+    Running totals kept in step by the crud mutation functions. Each worker
+    only sees its own writes, so the totals are also fully recomputed
+    every STATS_RECOMPUTE_SECONDS.
+    """
+
+    def __init__(self) -> None:
+        self.users = 0
+        self.active_users = 0
+        self.superusers = 0
+        self.items = 0
+        self.distribution = [0] * len(bucket_bounds)
+
+    def user_added(self, is_active: bool, is_superuser: bool) -> None:
+        self.users += 1
+        self.active_users += is_active
+        self.superusers += is_superuser
+        self.distribution[bucket(0)] += 1
+
+    def user_changed(
+        self,
+        was_active: bool,
+        is_active: bool,
+        was_superuser: bool,
+        is_superuser: bool,
+    ) -> None:
+        self.active_users += is_active - was_active
+        self.superusers += is_superuser - was_superuser
+
+    def user_removed(self, is_active: bool, is_superuser: bool, num_items: int) -> None:
+        self.users -= 1
+        self.active_users -= is_active
+        self.superusers -= is_superuser
+        self.items -= num_items
+        self.distribution[bucket(num_items)] -= 1
+
+    def items_added(self, owner_num_items: int, count: int = 1) -> None:
+        self.items += count
+        self.distribution[bucket(owner_num_items - count)] -= 1
+        self.distribution[bucket(owner_num_items)] += 1
+
+    def items_removed(self, owner_num_items: int, count: int = 1) -> None:
+        self.items -= count
+        self.distribution[bucket(owner_num_items + count)] -= 1
+        self.distribution[bucket(owner_num_items)] += 1
+
+    def load(self, stats: Stats) -> None:
+        self.users = stats.users
+        self.active_users = stats.active_users
+        self.superusers = stats.superusers
+        self.items = stats.items
+        self.distribution = [stats.item_distribution[k] for k in bucket_labels()]
+
+    def snapshot(self) -> Stats:
+        return Stats(
+            users=self.users,
+            active_users=self.active_users,
+            superusers=self.superusers,
+            items=self.items,
+            item_distribution=dict(zip(bucket_labels(), self.distribution)),
+        )
+
+
+rollup = Rollup()
+task: Optional["asyncio.Task[None]"] = None
+
+
+async def recompute() -> None:
+    buckets = []
+    for lo, hi in zip(bucket_bounds, bucket_bounds[1:] + [0]):
+        upper = f" AND .num_items < {hi}" if hi else ""
+        buckets.append(f"count(User FILTER .num_items >= {lo}{upper})")
+    con = await db.acquire(db.pool)
+    try:
+        result = await con.query_one_json(
+            f"""SELECT <json>(
+                users := count(User),
+                active_users := count(User FILTER .is_active),
+                superusers := count(User FILTER .is_superuser),
+                # Items may be sharded over several databases, counters aren't
+                items := sum(User.num_items),
+                item_distribution := [{", ".join(buckets)}]
+            )"""
+        )
+    finally:
+        await db.pool.release(con)
+    data = json.loads(result)
+    data["item_distribution"] = dict(zip(bucket_labels(), data["item_distribution"]))
+    rollup.load(Stats.parse_obj(data))
+
+
+async def run_recompute() -> None:
+    while True:
+        try:
+            await recompute()
+        except Exception as e:
+            logger.error(f"Stats recompute failed: {e}")
+        await asyncio.sleep(settings.STATS_RECOMPUTE_SECONDS)
+
+
+async def start() -> None:
+    global task
+    task = asyncio.ensure_future(run_recompute())
+
+
+async def stop() -> None:
+    if task:
+        task.cancel()
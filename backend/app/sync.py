@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from . import crud, db, shards
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+task: Optional["asyncio.Task[None]"] = None
+
+
+def encode_cursor(seqs: List[int]) -> str:
+    cursor = f"{'-'.join(str(seq) for seq in seqs)}.{int(time.time())}"
+    generation = shards.generation()
+    return f"{cursor}.{generation}" if generation else cursor
+
+
+def decode_cursor(cursor: Optional[str]) -> Tuple[List[int], bool]:
+    """
+    Return the change sequence number of each shard of a cursor and whether
+    it is too old to resume from, because tombstones it needs may have been
+    pruned or owners moved to other shards since.
+    """
+    start = [0] * shards.count()
+    if not cursor:
+        return start, False
+    try:
+        seqs_part, issued_part, *generation = cursor.split(".")
+        seqs = [int(seq) for seq in seqs_part.split("-")]
+        issued_at = int(issued_part)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    expected = [shards.generation()] if shards.enabled() else []
+    if generation != expected or len(seqs) != len(start):
+        return start, True
+    retention = settings.SYNC_TOMBSTONE_RETENTION_DAYS * 24 * 60 * 60
+    if issued_at < time.time() - retention:
+        return start, True
+    return seqs, False
+
+
+async def run_prune() -> None:
+    while True:
+        try:
+            pruned = 0
+            for shard in range(shards.count()):
+                pool = shards.get_pool(shard)
+                con = await db.acquire(pool)
+                try:
+                    pruned += await crud.item.prune_tombstones(
+                        con,
+                        older_than=timedelta(
+                            days=settings.SYNC_TOMBSTONE_RETENTION_DAYS
+                        ),
+                    )
+                finally:
+                    await pool.release(con)
+            if pruned:
+                logger.info(f"Pruned {pruned} item tombstones")
+        except Exception as e:
+            logger.error(f"Pruning item tombstones failed: {e}")
+        await asyncio.sleep(settings.SYNC_PRUNE_SECONDS)
+
+
+async def start() -> None:
+    global task
+    task = asyncio.ensure_future(run_prune())
+
+
+async def stop() -> None:
+    if task:
+        task.cancel()
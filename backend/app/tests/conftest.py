@@ -0,0 +1,77 @@
+import os
+from typing import Any, AsyncGenerator, List
+
+import pytest
+from edgedb import AsyncIOConnection, async_connect
+from fakeredis.aioredis import create_redis_pool
+
+from app import db, initial_data, shards
+from app.config import settings
+
+
+@pytest.fixture
+async def redis() -> AsyncGenerator[Any, None]:
+    """
+    Client of an in-memory fake Redis server, which runs the Lua scripts of
+    the Redis stores.
+    """
+    client = await create_redis_pool()
+    yield client
+    await client.flushall()
+    client.close()
+    await client.wait_closed()
+
+
+async def connect(shard: int) -> AsyncIOConnection:
+    try:
+        return await async_connect(**shards.connect_args(shard))
+    except Exception as e:
+        pytest.skip(f"EdgeDB database {shards.names()[shard]} unavailable: {e}")
+
+
+def use_shards(monkeypatch: Any, names: List[str]) -> None:
+    """
+    Place owners on the EDGEDB_SHARDS entries names, after the primary.
+    """
+    monkeypatch.setattr(settings, "EDGEDB_SHARDS", names)
+    monkeypatch.setattr(
+        shards, "ring", shards.Ring(shards.names(), settings.SHARD_VIRTUAL_NODES)
+    )
+
+
+@pytest.fixture
+async def databases(monkeypatch: Any) -> AsyncGenerator[List[AsyncIOConnection], None]:
+    """
+    Connections to the primary and the shards listed in EDGEDB_TEST_DATABASES,
+    e.g. "app_test,app_test_shard1,localhost:5657/app_test": the primary's
+    database on EDGEDB_HOST, then EDGEDB_SHARDS entries. They are migrated
+    and emptied, and db.pool and the shard pools are open on them.
+    """
+    names = [n for n in os.environ.get("EDGEDB_TEST_DATABASES", "").split(",") if n]
+    if len(names) < 3:
+        pytest.skip("EDGEDB_TEST_DATABASES needs a primary and two shards")
+    monkeypatch.setattr(settings, "EDGEDB_DB", names[0])
+    monkeypatch.setattr(settings, "EDGEDB_RO_HOST", None)
+    monkeypatch.setattr(settings, "AUDIT_ENABLED", False)
+    monkeypatch.setattr(settings, "CACHE_ENABLED", False)
+    use_shards(monkeypatch, names[1:])
+    cons: List[AsyncIOConnection] = []
+    try:
+        for shard in range(shards.count()):
+            cons.append(await connect(shard))
+            await initial_data.migrate(cons[-1])
+            await cons[-1].execute(
+                """DELETE Attachment;
+                DELETE ItemTombstone;
+                DELETE Item;
+                DELETE User;"""
+            )
+        await db.create_pool()
+        await shards.create_pools()
+        yield cons
+        await shards.close_pools()
+        await db.close_pool()
+    finally:
+        shards.known_owners.clear()
+        for con in cons:
+            await con.aclose()
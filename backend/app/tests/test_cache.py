@@ -0,0 +1,131 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List
+from uuid import uuid4
+
+import pytest
+
+from app import cache
+from app.cache import BaseBackend, MemoryBackend, RedisBackend
+
+owner_id = uuid4()
+other_owner_id = uuid4()
+
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request: Any, redis: Any, monkeypatch: Any) -> BaseBackend:
+    backend: BaseBackend = MemoryBackend(100)
+    if request.param == "redis":
+        backend = RedisBackend(redis)
+    monkeypatch.setattr(cache, "backend", backend)
+    monkeypatch.setattr(cache.settings, "CACHE_ENABLED", True)
+    monkeypatch.setattr(cache.settings, "CACHE_LOCK_POLL_SECONDS", 0.01)
+    return backend
+
+
+def counting_fetch(calls: List[str], value: str) -> Callable[[], Awaitable[str]]:
+    async def fetch() -> str:
+        calls.append(value)
+        return value
+
+    return fetch
+
+
+async def get_page(calls: List[str], entity: str, owner: Any, value: str) -> str:
+    # Like crud, the owner filter is part of the params
+    params = {"filtering": {"owner__id": owner}, "offset": 0, "limit": 10}
+    return await cache.get_or_fetch(entity, params, owner, counting_fetch(calls, value))
+
+
+@pytest.mark.asyncio
+async def test_hit(backend: BaseBackend) -> None:
+    calls: List[str] = []
+    assert await get_page(calls, "items", owner_id, "a") == "a"
+    assert await get_page(calls, "items", owner_id, "b") == "a"
+    assert calls == ["a"]
+    # Other params are another page
+    params = {"filtering": {"owner__id": owner_id}, "offset": 10, "limit": 10}
+    value = await cache.get_or_fetch(
+        "items", params, owner_id, counting_fetch(calls, "c")
+    )
+    assert value == "c"
+
+
+@pytest.mark.asyncio
+async def test_invalidate_tags(backend: BaseBackend) -> None:
+    calls: List[str] = []
+    await get_page(calls, "items", owner_id, "owner")
+    await get_page(calls, "items", other_owner_id, "other owner")
+    await get_page(calls, "items", None, "all items")
+    await get_page(calls, "users", None, "users")
+    calls.clear()
+
+    await cache.invalidate(owner_id)
+    assert await get_page(calls, "items", owner_id, "owner 2") == "owner 2"
+    assert await get_page(calls, "items", None, "all items 2") == "all items 2"
+    assert await get_page(calls, "users", None, "users 2") == "users 2"
+    # Only that owner's lists are stale
+    assert await get_page(calls, "items", other_owner_id, "x") == "other owner"
+    assert calls == ["owner 2", "all items 2", "users 2"]
+
+
+@pytest.mark.asyncio
+async def test_invalidate_across_workers(redis: Any, monkeypatch: Any) -> None:
+    monkeypatch.setattr(cache.settings, "CACHE_ENABLED", True)
+    calls: List[str] = []
+    # Two workers sharing the Redis server
+    monkeypatch.setattr(cache, "backend", RedisBackend(redis))
+    await get_page(calls, "items", owner_id, "a")
+    monkeypatch.setattr(cache, "backend", RedisBackend(redis))
+    assert await get_page(calls, "items", owner_id, "b") == "a"
+    await cache.invalidate(owner_id)
+    monkeypatch.setattr(cache, "backend", RedisBackend(redis))
+    assert await get_page(calls, "items", owner_id, "c") == "c"
+    assert calls == ["a", "c"]
+
+
+@pytest.mark.asyncio
+async def test_single_fetch_on_miss(backend: BaseBackend) -> None:
+    calls: List[str] = []
+    release = asyncio.Event()
+
+    async def slow_fetch() -> str:
+        calls.append("a")
+        await release.wait()
+        return "a"
+
+    pages = [
+        asyncio.ensure_future(cache.get_or_fetch("users", {}, None, slow_fetch))
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0.05)
+    release.set()
+    assert await asyncio.gather(*pages) == ["a", "a", "a"]
+    assert calls == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_release_on_error(backend: BaseBackend, monkeypatch: Any) -> None:
+    monkeypatch.setattr(cache.settings, "CACHE_LOCK_SECONDS", 60)
+
+    async def failing_fetch() -> str:
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        await cache.get_or_fetch("users", {}, None, failing_fetch)
+    # The lock is gone, so the next caller fetches right away
+    calls: List[str] = []
+    page = cache.get_or_fetch("users", {}, None, counting_fetch(calls, "a"))
+    assert await asyncio.wait_for(page, 1) == "a"
+    assert calls == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_replica_page_not_stored(backend: BaseBackend) -> None:
+    calls: List[str] = []
+    value = await cache.get_or_fetch(
+        "users", {}, None, counting_fetch(calls, "replica"), replica=True
+    )
+    assert value == "replica"
+    value = await cache.get_or_fetch("users", {}, None, counting_fetch(calls, "a"))
+    assert value == "a"
+    assert calls == ["replica", "a"]
@@ -0,0 +1,184 @@
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, AsyncIterator, List
+
+import pytest
+from edgedb import (
+    AsyncIOConnection,
+    InvalidValueError,
+    TransactionDeadlockError,
+    TransactionSerializationError,
+)
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from app import db, singleflight
+from app.config import settings
+
+
+def make_request(method: str = "GET") -> Request:
+    return Request(
+        {
+            "type": "http",
+            "method": method,
+            "path": "/api/v1/items/",
+            "headers": [(b"authorization", b"Bearer token")],
+        }
+    )
+
+
+@asynccontextmanager
+async def ro_con(request: Request) -> AsyncIterator[AsyncIOConnection]:
+    cons = db.get_ro_con(request)
+    try:
+        yield await cons.__anext__()
+    finally:
+        await cons.aclose()
+
+
+async def source(from_pool: Any) -> Any:
+    con = await from_pool.acquire()
+    try:
+        return singleflight.source(con)
+    finally:
+        await from_pool.release(con)
+
+
+async def open_pools(monkeypatch: Any, replica: str) -> AsyncGenerator[None, None]:
+    """
+    Open db.pool on the first of EDGEDB_TEST_DATABASES and db.ro_pool on
+    replica, "host:port/database" like the EDGEDB_SHARDS entries.
+    """
+    names = [n for n in os.environ.get("EDGEDB_TEST_DATABASES", "").split(",") if n]
+    if not names:
+        pytest.skip("EDGEDB_TEST_DATABASES needs a primary")
+    address, _, database = replica.rpartition("/")
+    host, _, port = address.partition(":")
+    monkeypatch.setattr(settings, "EDGEDB_DB", names[0])
+    monkeypatch.setattr(settings, "EDGEDB_RO_HOST", host or settings.EDGEDB_HOST)
+    monkeypatch.setattr(settings, "EDGEDB_RO_PORT", int(port) if port else None)
+    monkeypatch.setattr(settings, "EDGEDB_RO_DB", database)
+    monkeypatch.setattr(db, "ro_pool", None)
+    monkeypatch.setattr(db, "health_check_task", None)
+    monkeypatch.setattr(db, "ro_unhealthy_until", 0.0)
+    monkeypatch.setattr(db, "sticky_sessions", OrderedDict())
+    try:
+        await db.create_pool()
+    except Exception as e:
+        pytest.skip(f"EdgeDB database {names[0]} unavailable: {e}")
+    # The tests mark the replica unhealthy themselves
+    assert db.health_check_task
+    db.health_check_task.cancel()
+    try:
+        yield
+    finally:
+        await db.close_pool()
+
+
+@pytest.fixture
+async def replica(monkeypatch: Any) -> AsyncGenerator[None, None]:
+    """
+    Pools of the primary and of the read replica in EDGEDB_TEST_REPLICA, which
+    can be any other database.
+    """
+    replica = os.environ.get("EDGEDB_TEST_REPLICA")
+    if not replica:
+        pytest.skip("EDGEDB_TEST_REPLICA unset")
+    async for _ in open_pools(monkeypatch, replica):
+        yield
+
+
+@pytest.fixture
+async def replica_down(monkeypatch: Any) -> AsyncGenerator[None, None]:
+    """
+    Pools of the primary and of a read replica that refuses connections.
+    """
+    async for _ in open_pools(monkeypatch, "localhost:1/edgedb"):
+        yield
+
+
+@pytest.mark.asyncio
+async def test_reads_from_replica(replica: None) -> None:
+    assert db.ro_pool
+    replica_source = await source(db.ro_pool)
+    assert replica_source != await source(db.pool)
+    async with ro_con(make_request()) as con:
+        assert singleflight.source(con) == replica_source
+        assert db.is_replica(con)
+        assert await con.query_one("SELECT 1") == 1
+    assert not db.is_replica(con)
+
+
+@pytest.mark.asyncio
+async def test_sticky_session(replica: None, monkeypatch: Any) -> None:
+    primary_source = await source(db.pool)
+    # A write keeps the session's reads on the primary
+    writes = db.get_con(make_request("POST"))
+    await writes.__anext__()
+    await writes.aclose()
+    async with ro_con(make_request()) as con:
+        assert singleflight.source(con) == primary_source
+        assert not db.is_replica(con)
+
+    monkeypatch.setattr(settings, "EDGEDB_RO_STICKY_SECONDS", -1)
+    db.stick_to_primary(make_request("POST"))
+    async with ro_con(make_request()) as con:
+        assert db.is_replica(con)
+
+
+@pytest.mark.asyncio
+async def test_unhealthy_replica(replica: None) -> None:
+    db.mark_ro_unhealthy()
+    async with ro_con(make_request()) as con:
+        assert singleflight.source(con) == await source(db.pool)
+        assert not db.is_replica(con)
+
+
+@pytest.mark.asyncio
+async def test_replica_down(replica_down: None) -> None:
+    async with ro_con(make_request()) as con:
+        assert not db.is_replica(con)
+        assert await con.query_one("SELECT 1") == 1
+    assert db.ro_unhealthy_until > 0
+
+
+def conflicting_write(errors: List[Exception]) -> Any:
+    """
+    A write raising errors in turn, then answering how many times it ran.
+    """
+    runs = 0
+
+    async def write() -> int:
+        nonlocal runs
+        runs += 1
+        if errors:
+            raise errors.pop(0)
+        return runs
+
+    return write
+
+
+@pytest.mark.asyncio
+async def test_retry_conflicts(monkeypatch: Any) -> None:
+    monkeypatch.setattr(settings, "EDGEDB_CONFLICT_BACKOFF_SECONDS", 0.001)
+    errors = [TransactionSerializationError(), TransactionDeadlockError()]
+    assert await db.retry_conflicts(conflicting_write(errors)) == 3
+
+
+@pytest.mark.asyncio
+async def test_retry_conflicts_gives_up(monkeypatch: Any) -> None:
+    monkeypatch.setattr(settings, "EDGEDB_CONFLICT_BACKOFF_SECONDS", 0.001)
+    monkeypatch.setattr(settings, "EDGEDB_CONFLICT_RETRIES", 2)
+    errors: List[Exception] = [TransactionSerializationError() for _ in range(3)]
+    with pytest.raises(HTTPException) as e:
+        await db.retry_conflicts(conflicting_write(errors))
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"]
+
+
+@pytest.mark.asyncio
+async def test_retry_conflicts_only() -> None:
+    errors: List[Exception] = [InvalidValueError()]
+    with pytest.raises(InvalidValueError):
+        await db.retry_conflicts(conflicting_write(errors))
@@ -0,0 +1,193 @@
+import asyncio
+import base64
+import hashlib
+import json
+from typing import Any, Dict, List, Tuple
+
+import pytest
+from starlette.datastructures import Headers
+from starlette.types import Message, Receive, Scope, Send
+
+from app import idempotency
+from app.config import settings
+from app.idempotency import BaseStore, IdempotencyMiddleware, MemoryStore, RedisStore
+
+
+class Endpoint:
+    """
+    Answers 201 with the request body and the number of calls so far, after
+    waiting for release when it is held.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.calls += 1
+        calls = self.calls
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        await self.release.wait()
+        content = json.dumps({"body": body.decode(), "calls": calls}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 201,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": content})
+
+
+def make_scope(idempotency_key: str) -> Scope:
+    return {
+        "type": "http",
+        "method": "POST",
+        "path": "/api/v1/items/",
+        "root_path": "",
+        "query_string": b"",
+        "client": ("127.0.0.1", 1234),
+        "headers": [
+            (b"authorization", b"Bearer token"),
+            (b"idempotency-key", idempotency_key.encode()),
+        ],
+    }
+
+
+async def call(
+    app: Any, body: List[bytes], idempotency_key: str = "key"
+) -> Tuple[int, Headers, Dict[str, Any]]:
+    chunks = list(body)
+    messages: List[Message] = []
+
+    async def receive() -> Message:
+        if chunks:
+            chunk = chunks.pop(0)
+            return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+        await asyncio.Event().wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Message) -> None:
+        messages.append(message)
+
+    await app(make_scope(idempotency_key), receive, send)
+    headers = Headers(raw=messages[0].get("headers", []))
+    content = b"".join(m.get("body", b"") for m in messages[1:])
+    return messages[0]["status"], headers, json.loads(content)
+
+
+@pytest.fixture(params=["memory", "redis"])
+def store(request: Any, redis: Any, monkeypatch: Any) -> BaseStore:
+    store: BaseStore = MemoryStore(100)
+    if request.param == "redis":
+        store = RedisStore(redis)
+    monkeypatch.setattr(idempotency, "store", store)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_ENABLED", True)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_POLL_SECONDS", 0.01)
+    return store
+
+
+@pytest.fixture
+def endpoint() -> Endpoint:
+    return Endpoint()
+
+
+@pytest.mark.asyncio
+async def test_replay(store: BaseStore, endpoint: Endpoint) -> None:
+    app = IdempotencyMiddleware(endpoint)
+    status, headers, content = await call(app, [b"a"])
+    assert status == 201
+    assert "idempotent-replayed" not in headers
+    assert content == {"body": "a", "calls": 1}
+
+    status, headers, content = await call(app, [b"a"])
+    assert status == 201
+    assert headers["idempotent-replayed"] == "true"
+    assert headers["content-type"] == "application/json"
+    assert content == {"body": "a", "calls": 1}
+    assert endpoint.calls == 1
+
+    # Another key runs again
+    status, headers, content = await call(app, [b"a"], idempotency_key="other")
+    assert content == {"body": "a", "calls": 2}
+
+
+@pytest.mark.asyncio
+async def test_different_body(store: BaseStore, endpoint: Endpoint) -> None:
+    app = IdempotencyMiddleware(endpoint)
+    await call(app, [b"a"])
+    status, _, content = await call(app, [b"b"])
+    assert status == 422
+    assert "different request" in content["detail"]
+    assert endpoint.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_wait_for_in_flight(store: BaseStore, endpoint: Endpoint) -> None:
+    app = IdempotencyMiddleware(endpoint)
+    endpoint.release.clear()
+    original = asyncio.ensure_future(call(app, [b"a"]))
+    duplicate = asyncio.ensure_future(call(app, [b"a"]))
+    await asyncio.sleep(0.05)
+    assert endpoint.calls == 1
+    assert not duplicate.done()
+
+    endpoint.release.set()
+    (_, headers, content), (status, duplicate_headers, duplicate_content) = (
+        await original,
+        await duplicate,
+    )
+    assert status == 201
+    assert "idempotent-replayed" not in headers
+    assert duplicate_headers["idempotent-replayed"] == "true"
+    assert content == duplicate_content == {"body": "a", "calls": 1}
+    assert endpoint.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_wait_for_another_worker(store: BaseStore, endpoint: Endpoint) -> None:
+    app = IdempotencyMiddleware(endpoint)
+    # The original began in another worker, so this one polls the store
+    key = idempotency.get_store_key(
+        make_scope("key"), Headers(scope=make_scope("key")), "key"
+    )
+    fingerprint = hashlib.sha256(b"a").hexdigest()
+    marker = json.dumps({"fingerprint": fingerprint, "in_flight": True})
+    assert await store.begin(key, marker, 60) is None
+    duplicate = asyncio.ensure_future(call(app, [b"a"]))
+    await asyncio.sleep(0.05)
+    assert not duplicate.done()
+
+    record = {
+        "fingerprint": fingerprint,
+        "status": 201,
+        "headers": [["content-type", "application/json"]],
+        "body": base64.b64encode(b'{"body": "a", "calls": 1}').decode(),
+    }
+    await store.complete(key, json.dumps(record), 60)
+    status, headers, content = await duplicate
+    assert status == 201
+    assert headers["idempotent-replayed"] == "true"
+    assert content == {"body": "a", "calls": 1}
+    assert endpoint.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_too_large_body(
+    store: BaseStore, endpoint: Endpoint, monkeypatch: Any
+) -> None:
+    monkeypatch.setattr(settings, "IDEMPOTENCY_MAX_REQUEST_SIZE", 4)
+    app = IdempotencyMiddleware(endpoint)
+    # The whole body still reaches the endpoint, which runs every time
+    for calls in (1, 2):
+        status, headers, content = await call(app, [b"abc", b"def", b"gh"])
+        assert status == 201
+        assert "idempotent-replayed" not in headers
+        assert content == {"body": "abcdefgh", "calls": calls}
+    assert endpoint.calls == 2
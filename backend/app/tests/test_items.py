@@ -0,0 +1,36 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any, List
+from uuid import uuid4
+
+import pytest
+from edgedb import AsyncIOConnection
+
+from app import crud, db, schemas, shards
+from app.config import settings
+
+
+@pytest.mark.asyncio
+async def test_concurrent_creates(
+    databases: List[AsyncIOConnection], monkeypatch: Any
+) -> None:
+    monkeypatch.setattr(settings, "EDGEDB_CONFLICT_RETRIES", 20)
+    owner = SimpleNamespace(id=uuid4(), email="owner@example.com", full_name=None)
+    await shards.insert_copy(databases[0], owner)
+
+    async def create(title: str) -> schemas.Item:
+        con = await db.pool.acquire()
+        try:
+            return await crud.item.create(
+                con, obj_in=schemas.ItemCreate(title=title), owner_id=owner.id
+            )
+        finally:
+            await db.pool.release(con)
+
+    # Every create bumps the owner's num_items, conflicting ones are retried
+    items = await asyncio.gather(*(create(f"item {i}") for i in range(10)))
+    assert len({item.id for item in items}) == 10
+    num_items = await databases[0].query_one(
+        "SELECT (SELECT User FILTER .id = <uuid>$id).num_items", id=owner.id
+    )
+    assert num_items == 10
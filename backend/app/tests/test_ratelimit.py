@@ -0,0 +1,40 @@
+from typing import Any
+
+import pytest
+
+from app.ratelimit import BaseStore, MemoryStore, RedisStore
+
+# One token per minute, so no bucket refills during a test
+RATE = 1 / 60
+
+
+@pytest.fixture(params=["memory", "redis"])
+def store(request: Any, redis: Any) -> BaseStore:
+    if request.param == "redis":
+        return RedisStore(redis)
+    return MemoryStore(100)
+
+
+@pytest.mark.asyncio
+async def test_take_until_empty(store: BaseStore) -> None:
+    assert await store.take(["ip"], RATE, 2) == 0
+    assert await store.take(["ip"], RATE, 2) == 0
+    wait = await store.take(["ip"], RATE, 2)
+    assert 0 < wait <= 60
+
+
+@pytest.mark.asyncio
+async def test_take_all_or_none(store: BaseStore) -> None:
+    assert await store.take(["ip", "user:a"], RATE, 2) == 0
+    assert await store.take(["ip", "user:a"], RATE, 2) == 0
+    # The IP bucket is empty, so user:b keeps its tokens
+    assert await store.take(["ip", "user:b"], RATE, 2) > 0
+    assert await store.take(["user:b"], RATE, 2) == 0
+    assert await store.take(["user:b"], RATE, 2) == 0
+    assert await store.take(["user:b"], RATE, 2) > 0
+
+
+@pytest.mark.asyncio
+async def test_wait_for_the_emptiest_bucket(store: BaseStore) -> None:
+    assert await store.take(["ip"], RATE, 1) == 0
+    assert await store.take(["ip", "user:a"], RATE, 1) == pytest.approx(60, abs=1)
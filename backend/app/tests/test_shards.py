@@ -0,0 +1,252 @@
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, List, Optional
+from uuid import UUID, uuid4
+
+import pytest
+from edgedb import AsyncIOConnection
+
+from app import crud, rebalance, schemas, shards
+from app.api import items
+from app.config import settings
+from app.tests.conftest import use_shards
+
+keys = [str(uuid4()) for _ in range(3000)]
+
+
+def test_ring_placement() -> None:
+    ring = shards.Ring(["app", "shard1", "shard2"], 64)
+    placed = Counter(ring.shard_for(key) for key in keys)
+    assert set(placed) == {0, 1, 2}
+    # Roughly a third each
+    assert all(800 < n < 1200 for n in placed.values())
+    assert all(ring.shard_for(key) == ring.shard_for(key) for key in keys)
+
+
+def test_ring_placement_by_name() -> None:
+    names = ["app", "shard1", "shard2"]
+    ring = shards.Ring(names, 64)
+    reordered = ["shard2", "app", "shard1"]
+    other_ring = shards.Ring(reordered, 64)
+    for key in keys:
+        assert names[ring.shard_for(key)] == reordered[other_ring.shard_for(key)]
+
+
+def test_ring_added_shard() -> None:
+    ring = shards.Ring(["app", "shard1"], 64)
+    new_ring = shards.Ring(["app", "shard1", "shard2"], 64)
+    moved = [key for key in keys if ring.shard_for(key) != new_ring.shard_for(key)]
+    # Only the owners the new shard gains move
+    assert all(new_ring.shard_for(key) == 2 for key in moved)
+    assert 800 < len(moved) < 1200
+
+
+def item(title: str, email: Optional[str] = None) -> Any:
+    return SimpleNamespace(title=title, owner=SimpleNamespace(email=email))
+
+
+def titles(objs: List[Any]) -> List[str]:
+    return [obj.title for obj in objs]
+
+
+def test_merge_without_ordering() -> None:
+    pages = [[item("b"), item("a")], [item("d"), item("c")]]
+    assert titles(shards.merge(pages, None, 1, 2)) == ["a", "d"]
+
+
+@pytest.mark.parametrize(
+    "ordering, expected",
+    [
+        ("title", ["a", "b", "c", "d", "e"]),
+        ("-title", ["e", "d", "c", "b", "a"]),
+        # Empty values first ascending and last descending, like EdgeDB
+        ("owner__email,title", ["c", "e", "a", "d", "b"]),
+        ("-owner__email,title", ["b", "d", "a", "c", "e"]),
+        ("owner__email,-title", ["e", "c", "a", "d", "b"]),
+    ],
+)
+def test_merge(ordering: str, expected: List[str]) -> None:
+    objs = [
+        item("a", "a@example.com"),
+        item("b", "z@example.com"),
+        item("c"),
+        item("d", "m@example.com"),
+        item("e"),
+    ]
+    fields = [
+        (field.lstrip("-").split("__"), field.startswith("-"))
+        for field in ordering.split(",")
+    ]
+    # Each shard's page is already sorted on the ordering
+    pages = [
+        sorted(objs[::2], key=lambda obj: shards.OrderKey(obj, fields)),
+        sorted(objs[1::2], key=lambda obj: shards.OrderKey(obj, fields)),
+    ]
+    assert titles(shards.merge(pages, ordering, 0, 5)) == expected
+    assert titles(shards.merge(pages, ordering, 1, 2)) == expected[1:3]
+    assert shards.merge(pages, ordering, 5, 2) == []
+
+
+def test_shard_for_without_shards(monkeypatch: Any) -> None:
+    use_shards(monkeypatch, [])
+    assert shards.shard_for(uuid4()) == 0
+    use_shards(monkeypatch, ["shard1", "shard2"])
+    assert shards.shard_for(None) == 0
+
+
+def id_on(shard: int, old_shard: Optional[int] = None) -> UUID:
+    """
+    An owner id placed on shard, and on old_shard before the last shard was
+    added.
+    """
+    old_ring = shards.Ring(shards.names()[:-1], settings.SHARD_VIRTUAL_NODES)
+    while True:
+        id = uuid4()
+        if shards.shard_for(id) == shard and (
+            old_shard is None or old_ring.shard_for(str(id)) == old_shard
+        ):
+            return id
+
+
+async def create_owner(con: AsyncIOConnection, id: UUID, email: str) -> Any:
+    owner = SimpleNamespace(id=id, email=email, full_name=None)
+    await shards.insert_copy(con, owner)
+    return owner
+
+
+async def create_items(
+    primary: AsyncIOConnection,
+    con: AsyncIOConnection,
+    shard: int,
+    owner: Any,
+    *titles: str,
+) -> None:
+    await shards.ensure_owner(con, shard, owner)
+    for title in titles:
+        await crud.item.create(
+            con, obj_in=schemas.ItemCreate(title=title), owner_id=owner.id
+        )
+    if shard:
+        await crud.user.add_num_items(primary, id=owner.id, delta=len(titles))
+
+
+async def num_items(con: AsyncIOConnection, id: UUID) -> int:
+    return await con.query_one(
+        "SELECT (SELECT User FILTER .id = <uuid>$id).num_items ?? -1", id=id
+    )
+
+
+@pytest.mark.asyncio
+async def test_superuser_scatter(databases: List[AsyncIOConnection]) -> None:
+    primary = databases[0]
+    owners = [
+        await create_owner(primary, id_on(shard), f"owner{shard}@example.com")
+        for shard in range(3)
+    ]
+    await create_items(primary, databases[0], 0, owners[0], "a", "d")
+    await create_items(primary, databases[1], 1, owners[1], "b", "e", "g")
+    await create_items(primary, databases[2], 2, owners[2], "c", "f")
+    superuser = SimpleNamespace(id=uuid4(), is_superuser=True)
+
+    page = await items.read_items(
+        current_user=superuser,
+        con=primary,
+        filtering=schemas.ItemFilterParams(),
+        commons=schemas.CommonQueryParams(ordering="title", offset=1, limit=4),
+    )
+    assert page.count == 7
+    assert [item.title for item in page.data] == ["b", "c", "d", "e"]
+
+    page = await items.read_items(
+        current_user=superuser,
+        con=primary,
+        filtering=schemas.ItemFilterParams(),
+        commons=schemas.CommonQueryParams(ordering="-owner__email,title"),
+    )
+    assert page.count == 7
+    assert [item.title for item in page.data] == ["c", "f", "b", "e", "g", "a", "d"]
+
+    # A user only reads their shard
+    page = await items.read_items(
+        current_user=SimpleNamespace(id=owners[1].id, is_superuser=False),
+        con=primary,
+        filtering=schemas.ItemFilterParams(),
+        commons=schemas.CommonQueryParams(ordering="title"),
+    )
+    assert page.count == 3
+    assert [item.title for item in page.data] == ["b", "e", "g"]
+
+
+@pytest.mark.asyncio
+async def test_ensure_owner(databases: List[AsyncIOConnection]) -> None:
+    primary, shard_con = databases[0], databases[1]
+    owner = await create_owner(primary, id_on(1), "owner@example.com")
+    await shards.ensure_owner(shard_con, 1, owner)
+    await shards.ensure_owner(shard_con, 1, owner)
+    assert (1, owner.id) in shards.known_owners
+    copies = await shard_con.query(
+        "SELECT User { email, is_active } FILTER .id = <uuid>$id", id=owner.id
+    )
+    assert [(c.email, c.is_active) for c in copies] == [("owner@example.com", False)]
+    # The primary holds the users themselves
+    await shards.ensure_owner(primary, 0, owner)
+    assert (0, owner.id) not in shards.known_owners
+
+
+@pytest.mark.asyncio
+async def test_ensure_owner_frees_email(databases: List[AsyncIOConnection]) -> None:
+    primary, shard_con = databases[0], databases[1]
+    # Stale copies: one of a removed user, one of a user whose email changed
+    removed = SimpleNamespace(id=id_on(1), email="old@example.com", full_name=None)
+    await shards.insert_copy(shard_con, removed)
+    renamed = await create_owner(primary, id_on(1), "renamed@example.com")
+    await shards.insert_copy(
+        shard_con,
+        SimpleNamespace(id=renamed.id, email="taken@example.com", full_name=None),
+    )
+
+    owner = await create_owner(primary, id_on(1), "old@example.com")
+    await shards.ensure_owner(shard_con, 1, owner)
+    other_owner = await create_owner(primary, id_on(1), "taken@example.com")
+    await shards.ensure_owner(shard_con, 1, other_owner)
+
+    copies = await shard_con.query("SELECT User { id, email } ORDER BY .email")
+    assert [(c.id, c.email) for c in copies] == [
+        (owner.id, "old@example.com"),
+        (renamed.id, "renamed@example.com"),
+        (other_owner.id, "taken@example.com"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rebalance(databases: List[AsyncIOConnection], monkeypatch: Any) -> None:
+    primary = databases[0]
+    names = shards.names()
+    last = len(names) - 1
+    # Both on the first shard until the last one is added
+    moving_id = id_on(last, old_shard=1)
+    staying_id = id_on(1, old_shard=1)
+    use_shards(monkeypatch, names[1:-1])
+    moving = await create_owner(primary, moving_id, "moving@example.com")
+    staying = await create_owner(primary, staying_id, "staying@example.com")
+    await create_items(primary, databases[1], 1, moving, "a", "b", "c")
+    await create_items(primary, databases[1], 1, staying, "d")
+
+    use_shards(monkeypatch, names[1:])
+    await rebalance.rebalance(databases, dry_run=False, batch_size=2)
+
+    source, target = databases[1], databases[last]
+    moved = await target.query(
+        "SELECT Item.title FILTER Item.owner.id = <uuid>$id ORDER BY Item.title",
+        id=moving.id,
+    )
+    assert list(moved) == ["a", "b", "c"]
+    assert await num_items(target, moving.id) == 3
+    assert await num_items(source, moving.id) == -1
+    assert await num_items(source, staying.id) == 1
+    assert await num_items(primary, moving.id) == 3
+    assert await source.query_one("SELECT count(Item)") == 1
+
+    # Nothing left to move
+    await rebalance.rebalance(databases, dry_run=False, batch_size=2)
+    assert await target.query_one("SELECT count(Item)") == 3
@@ -0,0 +1,317 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import re
+import time
+import urllib.request
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+from edgedb import AsyncIOConnection
+from fastapi.dependencies.models import Dependant
+from fastapi.dependencies.utils import (
+    is_async_gen_callable,
+    is_coroutine_callable,
+    is_gen_callable,
+)
+from fastapi.routing import APIRoute
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+    ) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.start = self.end = 0
+
+    def __enter__(self) -> "Span":
+        self.start = time.time_ns()
+        self.token = current.set(self)
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        self.end = time.time_ns()
+        current.reset(self.token)
+        if exc is not None and not isinstance(exc, asyncio.CancelledError):
+            self.error = f"{exc_type.__name__}: {exc}"
+        buffer.append(self)
+        if len(buffer) > settings.TRACING_MAX_BUFFERED_SPANS:
+            del buffer[0]
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+class NoopSpan:
+    def __enter__(self) -> "NoopSpan":
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        pass
+
+
+noop = NoopSpan()
+
+# Only set inside sampled requests, so unsampled code only pays for a get
+current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+buffer: List[Span] = []
+task: Optional["asyncio.Task[None]"] = None
+
+
+def span(name: str, **attributes: Any) -> Any:
+    """
+    Child span of the current span, a no-op outside a sampled request.
+    """
+    parent = current.get()
+    if parent is None:
+        return noop
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+def traced(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    def decorator(fn: Callable[..., Any]) -> Callable[..., Any]:
+        if is_coroutine_callable(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with span(name):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def trace_dependencies(dependant: Dependant) -> None:
+    for sub in dependant.dependencies:
+        trace_dependencies(sub)
+        # Generators hold a resource across the request, their setup is
+        # traced where they acquire it
+        if sub.call and not is_gen_callable(sub.call):
+            if not is_async_gen_callable(sub.call):
+                name = getattr(sub.call, "__name__", type(sub.call).__name__)
+                sub.call = traced(f"dependency {name}")(sub.call)
+
+
+class TracedRoute(APIRoute):
+    """
+    Route with spans around each of its dependencies and its endpoint.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        trace_dependencies(self.dependant)
+        self.dependant.call = traced(f"endpoint {self.name}")(self.dependant.call)
+
+
+def query_template(query: str) -> str:
+    return " ".join(query.split())[: settings.TRACING_MAX_TEMPLATE_LENGTH]
+
+
+class TracedConnection(AsyncIOConnection):
+    """
+    Connection class of the pools, with a span around each query tagged with
+    its template.
+    """
+
+    async def query(self, query: str, *args: Any, **kwargs: Any) -> Any:
+        if current.get() is None:
+            return await super().query(query, *args, **kwargs)
+        with span("edgedb.query", template=query_template(query)):
+            return await super().query(query, *args, **kwargs)
+
+    async def query_one(self, query: str, *args: Any, **kwargs: Any) -> Any:
+        if current.get() is None:
+            return await super().query_one(query, *args, **kwargs)
+        with span("edgedb.query", template=query_template(query)):
+            return await super().query_one(query, *args, **kwargs)
+
+    async def query_json(self, query: str, *args: Any, **kwargs: Any) -> str:
+        if current.get() is None:
+            return await super().query_json(query, *args, **kwargs)
+        with span("edgedb.query", template=query_template(query)):
+            return await super().query_json(query, *args, **kwargs)
+
+    async def query_one_json(self, query: str, *args: Any, **kwargs: Any) -> str:
+        if current.get() is None:
+            return await super().query_one_json(query, *args, **kwargs)
+        with span("edgedb.query", template=query_template(query)):
+            return await super().query_one_json(query, *args, **kwargs)
+
+
+class TracingMiddleware:
+    """
+    Starts a root span for sampled requests. An incoming W3C traceparent
+    header continues its trace and its sampled flag is honored, other
+    requests are sampled at TRACING_SAMPLE_RATE.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not settings.TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        trace_id = parent_id = None
+        sampled = random.random() < settings.TRACING_SAMPLE_RATE
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                match = TRACEPARENT.match(value.decode("latin-1"))
+                if match:
+                    trace_id, parent_id, flags = match.groups()
+                    sampled = bool(int(flags, 16) & 1)
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+        root = Span(
+            f"{scope['method']} {scope['path']}",
+            trace_id or os.urandom(16).hex(),
+            parent_id,
+            {"http.method": scope["method"], "http.target": scope["path"]},
+        )
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                root.attributes["http.status_code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"traceparent", root.traceparent().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        with root:
+            await self.app(scope, receive, send_wrapper)
+
+
+def to_json(s: Span) -> Dict[str, Any]:
+    return {
+        "trace_id": s.trace_id,
+        "span_id": s.span_id,
+        "parent_id": s.parent_id,
+        "name": s.name,
+        "start": s.start,
+        "end": s.end,
+        "duration_ms": (s.end - s.start) / 1e6,
+        "attributes": s.attributes,
+        "error": s.error,
+    }
+
+
+def to_otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(s: Span) -> Dict[str, Any]:
+    data = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": 2 if s.parent_id is None else 1,
+        "startTimeUnixNano": str(s.start),
+        "endTimeUnixNano": str(s.end),
+        "attributes": [
+            {"key": k, "value": to_otlp_value(v)} for k, v in s.attributes.items()
+        ],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+    if s.parent_id:
+        data["parentSpanId"] = s.parent_id
+    return data
+
+
+def export_json(spans: List[Span]) -> None:
+    with open(settings.TRACING_JSON_PATH, "a") as f:
+        for s in spans:
+            f.write(json.dumps(to_json(s), default=str) + "\n")
+
+
+def export_otlp(spans: List[Span]) -> None:
+    body = {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {
+                            "key": "service.name",
+                            "value": {"stringValue": settings.PROJECT_NAME},
+                        }
+                    ]
+                },
+                "scopeSpans": [
+                    {"scope": {"name": "app"}, "spans": [to_otlp(s) for s in spans]}
+                ],
+            }
+        ]
+    }
+    request = urllib.request.Request(
+        settings.TRACING_OTLP_ENDPOINT,
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    urllib.request.urlopen(request, timeout=settings.TRACING_EXPORT_SECONDS).close()
+
+
+exporters = {"json": export_json, "otlp": export_otlp}
+
+
+async def flush() -> None:
+    global buffer
+    if not buffer:
+        return
+    spans, buffer = buffer, []
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(None, exporters[settings.TRACING_EXPORTER], spans)
+    except Exception as e:
+        logger.error(f"Exporting {len(spans)} spans failed: {e}")
+
+
+async def run_export() -> None:
+    while True:
+        await asyncio.sleep(settings.TRACING_EXPORT_SECONDS)
+        await flush()
+
+
+async def start() -> None:
+    global task
+    if settings.TRACING_ENABLED:
+        task = asyncio.ensure_future(run_export())
+
+
+async def stop() -> None:
+    if task:
+        task.cancel()
+        await flush()
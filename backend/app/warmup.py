@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from edgedb import AsyncIOConnection, AsyncIOPool
+from pydantic import BaseModel
+
+from . import crud, db, schemas, shards
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+ready = False
+task: Optional["asyncio.Task[None]"] = None
+
+dummy_values = {
+    UUID: UUID(int=0),
+    str: "",
+    bool: False,
+    int: 0,
+    schemas.EmailStr: "warmup@example.com",
+}
+
+
+def dummy_filtering(model: BaseModel, fields: List[str]) -> Dict[str, Any]:
+    return {f: dummy_values[model.__fields__[f].type_] for f in fields}
+
+
+async def warm_connection(con: AsyncIOConnection) -> None:
+    # Call the undecorated reads, coalescing would run them on one connection
+    missing = UUID(int=0)
+    await crud.user.get.__wrapped__(con, id=missing)  # type: ignore
+    await crud.user.get_by_email.__wrapped__(con, email="")  # type: ignore
+    await crud.user.get_many(con, ids=[missing])
+    # The email index answers exists_by_email without querying
+    await crud.user.query_exists_by_email(con, email="")
+    await crud.user.authenticate(con, email="", password="")
+    await crud.item.get.__wrapped__(con, id=missing)  # type: ignore
+    await crud.item.get_many(con, ids=[missing])
+    await crud.item.get_changes(con, since=0, limit=0)
+    await crud.item.get_changes(con, since=0, owner_id=missing, limit=0)
+    for template in settings.WARMUP_TEMPLATES:
+        entity = template["entity"]
+        module, filter_model = {
+            "users": (crud.user, schemas.UserFilterParams),
+            "items": (crud.item, schemas.ItemFilterParams),
+        }[entity]
+        await module.get_multi.__wrapped__(  # type: ignore
+            con,
+            filtering=dummy_filtering(filter_model, template.get("filter", [])),
+            ordering=template.get("ordering"),
+            limit=0,
+        )
+
+
+async def warm_pool(pool: AsyncIOPool) -> int:
+    """
+    Open the pool's minimum connections and run the static queries and the
+    hot get_multi templates on each. Returns the number warmed.
+    """
+    # Like db.create_pool, never more than the pool can hand out
+    size = min(settings.EDGEDB_POOL_MIN_SIZE, settings.EDGEDB_POOL_MAX_SIZE)
+    acquires = [asyncio.ensure_future(pool.acquire()) for _ in range(size)]
+    done, pending = await asyncio.wait(
+        acquires, timeout=settings.WARMUP_TIMEOUT_SECONDS
+    )
+    for acquire in pending:
+        acquire.cancel()
+    cons = [acquire.result() for acquire in done if not acquire.exception()]
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(warm_connection(con) for con in cons)),
+            settings.WARMUP_TIMEOUT_SECONDS,
+        )
+    except Exception as e:
+        # A cold query is slow, not broken, so serve anyway
+        logger.error(f"Warm-up failed: {e}")
+    finally:
+        for con in cons:
+            await pool.release(con)
+    return len(cons)
+
+
+async def warm_up() -> None:
+    """
+    Warm the primary, the shards and the read replica, so the first requests
+    don't pay for connecting and compiling, then mark the worker ready.
+    """
+    global ready
+    started = time.perf_counter()
+    pools = [shards.get_pool(shard) for shard in range(shards.count())]
+    if db.ro_pool:
+        pools.append(db.ro_pool)
+    warmed = await asyncio.gather(*(warm_pool(pool) for pool in pools))
+    ready = True
+    elapsed = (time.perf_counter() - started) * 1000
+    logger.info(
+        f"Warmed up {sum(warmed)} connections of {len(pools)} pools in "
+        f"{elapsed:.0f} ms"
+    )
+
+
+async def start() -> None:
+    # In the background, so the server accepts requests and the readiness
+    # probe answers 503 meanwhile
+    global task
+    task = asyncio.ensure_future(warm_up())
+
+
+async def stop() -> None:
+    if task:
+        task.cancel()
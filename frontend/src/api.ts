@@ -1,6 +1,12 @@
 import axios from 'axios';
 import { apiUrl } from '@/env';
-import { IUserProfile, IUserProfiles, IUserProfileUpdate, IUserProfileCreate } from './interfaces';
+import {
+  IUserPageParams,
+  IUserProfile,
+  IUserProfiles,
+  IUserProfileUpdate,
+  IUserProfileCreate,
+} from './interfaces';
 
 function authHeaders(token: string) {
   return {
@@ -24,8 +30,11 @@ export const api = {
   async updateMe(token: string, data: IUserProfileUpdate) {
     return axios.put<IUserProfile>(`${apiUrl}/api/v1/users/me`, data, authHeaders(token));
   },
-  async getUsers(token: string) {
-    return axios.get<IUserProfiles>(`${apiUrl}/api/v1/users/`, authHeaders(token));
+  async getUsers(token: string, params: IUserPageParams) {
+    return axios.get<IUserProfiles>(`${apiUrl}/api/v1/users/`, { ...authHeaders(token), params });
+  },
+  async getUser(token: string, userId: string) {
+    return axios.get<IUserProfile>(`${apiUrl}/api/v1/users/${userId}`, authHeaders(token));
   },
   async updateUser(token: string, userId: string, data: IUserProfileUpdate) {
     return axios.put(`${apiUrl}/api/v1/users/${userId}`, data, authHeaders(token));
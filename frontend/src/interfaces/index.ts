@@ -4,6 +4,7 @@ export interface IUserProfile {
     is_superuser: boolean;
     full_name: string;
     id: string;
+    num_items?: number;
 }
 
 export interface IUserProfiles {
@@ -26,3 +27,16 @@ export interface IUserProfileCreate {
     is_active?: boolean;
     is_superuser?: boolean;
 }
+
+export interface IUserQuery {
+    ordering?: string;
+    email?: string;
+    full_name?: string;
+    is_active?: boolean;
+    is_superuser?: boolean;
+}
+
+export interface IUserPageParams extends IUserQuery {
+    offset: number;
+    limit: number;
+}
@@ -1,22 +1,63 @@
 import { api } from '@/api';
 import { ActionContext } from 'vuex';
-import { IUserProfileCreate, IUserProfileUpdate } from '@/interfaces';
+import { IUserProfileCreate, IUserProfileUpdate, IUserQuery } from '@/interfaces';
 import { State } from '../state';
 import { AdminState } from './state';
 import { getStoreAccessors } from 'typesafe-vuex';
-import { commitSetUsers, commitSetUser } from './mutations';
+import { commitSetUser, commitSetUserPage } from './mutations';
 import { dispatchCheckApiError } from '../main/actions';
 import { commitAddNotification, commitRemoveNotification } from '../main/mutations';
 
 type MainContext = ActionContext<AdminState, State>;
 
+export const USER_PAGE_SIZE = 100;
+// Cached pages are shown right away and refetched in the background
+// once they are older than this
+const USER_PAGE_MAX_AGE = 30 * 1000;
+
+const pendingUserPages = new Set<string>();
+
+export const userQueryKey = (query: IUserQuery) => JSON.stringify(
+    Object.keys(query).sort().filter((key) => query[key] !== undefined && query[key] !== '')
+        .map((key) => [key, query[key]]),
+);
+
 export const actions = {
-    async actionGetUsers(context: MainContext) {
+    async actionGetUserPage(context: MainContext, payload: { query: IUserQuery, page: number }) {
+        const key = userQueryKey(payload.query);
+        const listing = context.state.userListings[key];
+        const cached = listing && listing.pages[payload.page];
+        const pendingKey = `${key}#${payload.page}`;
+        if ((cached && Date.now() - cached.fetchedAt < USER_PAGE_MAX_AGE) || pendingUserPages.has(pendingKey)) {
+            return;
+        }
+        pendingUserPages.add(pendingKey);
         try {
-            const response = await api.getUsers(context.rootState.main.token);
-            if (response) {
-                commitSetUsers(context, response.data.data);
+            const params = {};
+            for (const [name, value] of JSON.parse(key)) {
+                params[name] = value;
             }
+            const response = await api.getUsers(context.rootState.main.token, {
+                ...params,
+                offset: payload.page * USER_PAGE_SIZE,
+                limit: USER_PAGE_SIZE,
+            });
+            commitSetUserPage(context, {
+                query: key,
+                page: payload.page,
+                count: response.data.count,
+                data: response.data.data,
+            });
+        } catch (error) {
+            await dispatchCheckApiError(context, error);
+        } finally {
+            pendingUserPages.delete(pendingKey);
+        }
+    },
+    async actionGetUser(context: MainContext, userId: string) {
+        try {
+            const response = await api.getUser(context.rootState.main.token, userId);
+            commitSetUser(context, response.data);
         } catch (error) {
             await dispatchCheckApiError(context, error);
         }
@@ -56,5 +97,6 @@ export const actions = {
 const { dispatch } = getStoreAccessors<AdminState, State>('');
 
 export const dispatchCreateUser = dispatch(actions.actionCreateUser);
-export const dispatchGetUsers = dispatch(actions.actionGetUsers);
+export const dispatchGetUser = dispatch(actions.actionGetUser);
+export const dispatchGetUserPage = dispatch(actions.actionGetUserPage);
 export const dispatchUpdateUser = dispatch(actions.actionUpdateUser);
@@ -10,9 +10,11 @@ export const getters = {
             return { ...filteredUsers[0] };
         }
     },
+    adminUserListing: (state: AdminState) => (query: string) => state.userListings[query],
 };
 
 const { read } = getStoreAccessors<AdminState, State>('');
 
 export const readAdminOneUser = read(getters.adminOneUser);
 export const readAdminUsers = read(getters.adminUsers);
+export const readAdminUserListing = read(getters.adminUserListing);
@@ -1,8 +1,12 @@
+import Vue from 'vue';
 import { IUserProfile } from '@/interfaces';
 import { AdminState } from './state';
 import { getStoreAccessors } from 'typesafe-vuex';
 import { State } from '../state';
 
+// Listings of other searches are kept to go back to, up to this many
+const MAX_USER_LISTINGS = 10;
+
 export const mutations = {
     setUsers(state: AdminState, payload: IUserProfile[]) {
         state.users = payload;
@@ -11,6 +15,25 @@ export const mutations = {
         const users = state.users.filter((user: IUserProfile) => user.id !== payload.id);
         users.push(payload);
         state.users = users;
+        // Any cached page may now be out of date, refetch on next read
+        for (const listing of Object.values(state.userListings)) {
+            for (const page of Object.values(listing.pages)) {
+                page.fetchedAt = 0;
+            }
+        }
+    },
+    setUserPage(state: AdminState, payload: { query: string, page: number, count: number, data: IUserProfile[] }) {
+        if (!state.userListings[payload.query]) {
+            const queries = Object.keys(state.userListings);
+            for (const query of queries.slice(0, Math.max(0, queries.length + 1 - MAX_USER_LISTINGS))) {
+                Vue.delete(state.userListings, query);
+            }
+            Vue.set(state.userListings, payload.query, { count: payload.count, pages: {} });
+        }
+        const listing = state.userListings[payload.query];
+        listing.count = payload.count;
+        // Pages aren't merged into state.users, the edit view loads its user by id
+        Vue.set(listing.pages, payload.page, { data: payload.data, fetchedAt: Date.now() });
     },
 };
 
@@ -18,3 +41,4 @@ const { commit } = getStoreAccessors<AdminState, State>('');
 
 export const commitSetUser = commit(mutations.setUser);
 export const commitSetUsers = commit(mutations.setUsers);
+export const commitSetUserPage = commit(mutations.setUserPage);
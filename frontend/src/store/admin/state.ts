@@ -1,5 +1,16 @@
 import { IUserProfile } from '@/interfaces';
 
+export interface UserPage {
+    data: IUserProfile[];
+    fetchedAt: number;
+}
+
+export interface UserListing {
+    count: number;
+    pages: { [page: number]: UserPage };
+}
+
 export interface AdminState {
     users: IUserProfile[];
+    userListings: { [query: string]: UserListing };
 }